@@ -1,10 +1,16 @@
 from __future__ import print_function, absolute_import, unicode_literals
 
+# stdlib imports
+import time
+
 # Project imports
 from FIPER.car.channel import TCPStreamer, RCReceiver
 from FIPER.car.component import Commander
 from FIPER.car.probeserver import ProbeServer, ProbeHandshake
+from FIPER.generic.const import RC_SERVER_PORT, STREAM_SERVER_PORT, CAR_METRICS_PORT
 from FIPER.generic.messaging import Messaging
+from FIPER.generic.metrics import MetricsServer
+from FIPER.generic.rpc import RPCEndpoint
 
 
 class TCPCar(object):
@@ -18,16 +24,22 @@ class TCPCar(object):
 
     entity_type = "car"
 
-    def __init__(self, myID, myIP):
+    def __init__(self, myID, myIP, eye=None):
+        """
+        :param eye: CaptureDevice to stream, eg. CaptureDevice.replay() of a
+         recording, the default camera if not set
+        """
         self.ID = myID
         self.ip = myIP
 
-        self.streamer = TCPStreamer()
+        self.streamer = TCPStreamer(eye, myID)
         self.receiver = RCReceiver()
         self.messenger = None  # type: Messaging
         self.commander = None  # type: Commander
+        self.rpc = None  # type: RPCEndpoint
         self.server_ip = None
         self.online = False
+        self.metrics_server = MetricsServer.launch(CAR_METRICS_PORT)
 
     def mainloop(self):
         """
@@ -63,16 +75,23 @@ class TCPCar(object):
             self.server_ip = ip
         mytag = "{}-{}:".format(self.entity_type, self.ID).encode()
         self.messenger = Messaging.connect_to(ip, timeout=1, tag=mytag)
-        ProbeHandshake.perform(self.streamer, self.messenger)
+        options = ProbeHandshake.perform(self.streamer, self.messenger) or {}
 
-        self.receiver.connect(ip)
+        token = options.get("token")
+        self.receiver.connect(ip, int(options.get("rcport", RC_SERVER_PORT)), token)
         self.receiver.start()
 
-        self.streamer.connect(ip)
+        self.streamer.connect(ip, int(options.get("dport", STREAM_SERVER_PORT)), token)
+        self.messenger.subscribe("ping", self.pong)
+        if self.streamer.controller is not None:
+            self.messenger.subscribe("ack", self.streamer.controller.on_ack)
+            self.streamer.controller.on_change = self.report_opstate
 
         self.commander = Commander(
-            self.messenger, stream=self.stream_command, shutdown=self.shutdown
+            self.messenger, stream=self.stream_command, profile=self.profile_command,
+            shutdown=self.shutdown
         )
+        self.rpc = RPCEndpoint(self.messenger, shutdown=self.remote_shutdown)
         self.out("connected to", ip)
         return True
 
@@ -81,6 +100,14 @@ class TCPCar(object):
         sep, end = kw.get(b"sep", " "), kw.get(b"end", "\n")
         print("CAR {}:".format(self.ID), *args, sep=sep, end=end)
 
+    def pong(self, ping):
+        """Answers the server's clock synchronization pings: ping {server time}"""
+        self.messenger.send("pong {} {!r}".format(ping.split(" ")[1], time.time()).encode())
+
+    def report_opstate(self, opstate):
+        """Sends the adaptive stream's operating point to the server"""
+        self.messenger.send(("opstate " + opstate).encode())
+
     def stream_command(self, switch):
         if switch == "on":
             self.streamer.start()
@@ -89,6 +116,18 @@ class TCPCar(object):
         else:
             return
 
+    def profile_command(self, *spec):
+        """Switches the stream profile, eg. profile 320x240 gray roi:320x240+160+120"""
+        try:
+            self.streamer.set_profile(" ".join(spec))
+        except ValueError as E:
+            self.out("invalid stream profile:", E)
+
+    def remote_shutdown(self):
+        """Called by the server: the commander's loop exits and shuts the car down"""
+        self.commander.teardown()
+        return "offline"
+
     def shutdown(self, msg=None):
         if msg is not None:
             self.out(msg)
@@ -96,7 +135,12 @@ class TCPCar(object):
             self.receiver.teardown(0)
         if self.streamer is not None:
             self.streamer.teardown(0)
+        if self.rpc is not None:
+            self.rpc.close()
         if self.messenger is not None:
             self.messenger.send(b"offline")
             self.messenger.teardown(2)
+        if self.metrics_server is not None:
+            self.metrics_server.teardown()
+            self.metrics_server = None
         self.online = False
@@ -8,6 +8,7 @@ from __future__ import absolute_import, unicode_literals, print_function
 import sys
 
 from FIPER.car.car import TCPCar
+from FIPER.car.component import CaptureDevice
 
 
 def readargs():
@@ -22,8 +23,16 @@ def readargs():
 
 
 def debugmain():
+    """
+    Usage: carmain.py [ID] [recording directory] [replay speed]
+    A recording is replayed instead of the camera, if its directory is supplied.
+    """
     ID = "TestCar" if len(sys.argv) == 1 else sys.argv[1]
-    lightning_mcqueen = TCPCar(myID=ID, myIP="127.0.0.1")
+    eye = None
+    if len(sys.argv) > 2:
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.
+        eye = CaptureDevice.replay(sys.argv[2], speed)
+    lightning_mcqueen = TCPCar(myID=ID, myIP="127.0.0.1", eye=eye)
     lightning_mcqueen.mainloop()
 
 
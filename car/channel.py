@@ -5,28 +5,49 @@ import time
 import socket
 import threading as thr
 
-from FIPER.car.component import CaptureDevice, CaptureDeviceMocker
-from FIPER.generic.const import DTYPE, FPS, STREAM_SERVER_PORT, RC_SERVER_PORT
+import numpy as np
+import cv2
+
+from FIPER.car.component import (
+    CaptureDevice, CaptureDeviceMocker, StreamProfile, AdaptiveController
+)
+from FIPER.generic.const import (
+    DTYPE, FPS, ADAPTIVE_STREAM, STREAM_SERVER_PORT, RC_SERVER_PORT
+)
+from FIPER.generic.codec import RawCodec, available, get_codec
+from FIPER.generic.metrics import REGISTRY, SIZE_BUCKETS
+from FIPER.generic.routine import tune_socket
+from FIPER.generic.session import token_preamble
+from FIPER.generic.stream import FrameHeader, FrameRing, DatagramSender, send_packet
 
 
 class ChannelBase(object):
 
     __metaclass__ = abc.ABCMeta
 
+    channel = ""  # type of the channel, selects the socket's options (see routine.tune_socket)
+
     def __init__(self):
         self.sock = None
+        self.cork = False
         self.running = False
         self.worker = None
 
-    def _connectbase(self, IP, port, timeout):
+    def _connectbase(self, IP, port, timeout, token=None):
         self.sock = socket.create_connection((IP, port), timeout=timeout)
+        self.cork = tune_socket(self.sock, self.channel)
+        if token:
+            # Matches this connection to the handshake, see generic/session.py
+            self.sock.sendall(token_preamble(token))
 
     def start(self):
         if self.sock is None:
             print("{}: object unitialized!".format(self.type))
             return
-        if not self.running:
+        if self.worker is None or not self.worker.is_alive():
             print("Starting new {} thread!".format(self.type))
+            # Set here, so a stop() right after the start can't be overridden by run()
+            self.running = True
             self.worker = thr.Thread(target=self.run, name="Streamer")
             self.worker.start()
 
@@ -35,10 +56,20 @@ class ChannelBase(object):
         raise NotImplementedError
 
     def stop(self):
+        """Stops the worker thread and waits for it to exit"""
         self.running = False
-        self.worker = None
+        worker, self.worker = self.worker, None
+        if worker is not None and worker is not thr.current_thread():
+            worker.join()
 
     def teardown(self, sleep=0):
+        self.running = False
+        if self.sock is not None:
+            # Unblocks a worker waiting on the socket
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
         self.stop()
         if self.sock is not None:
             self.sock.close()
@@ -56,17 +87,18 @@ class RCReceiver(ChannelBase):
     Runs in separate thread, started in TCPCar._connect()
     """
 
+    channel = "rc"
+
     def __init__(self):
         super(RCReceiver, self).__init__()
         self._recvbuffer = []
 
-    def connect(self, IP):
-        super(RCReceiver, self)._connectbase(IP, RC_SERVER_PORT, timeout=1)
-        print("RCRECEIVER: connected to {}:{}".format(IP, RC_SERVER_PORT))
+    def connect(self, IP, port=RC_SERVER_PORT, token=None):
+        super(RCReceiver, self)._connectbase(IP, port, timeout=1, token=token)
+        print("RCRECEIVER: connected to {}:{}".format(IP, port))
 
     def run(self):
         print("RC: online")
-        self.running = True
         commands = []
         while self.running:
             try:
@@ -96,21 +128,83 @@ class TCPStreamer(ChannelBase):
     on a remote command from the controller.
     """
 
-    def __init__(self):
+    channel = "stream"
+
+    def __init__(self, eye=None, ID="local"):
+        """
+        :param eye: CaptureDevice to stream, the default camera if not set
+        :param ID: ID of the car, names the streamer's metrics
+        """
         super(TCPStreamer, self).__init__()
         self._frameshape = None
-        self.eye = CaptureDevice()
+        self.codec = get_codec(RawCodec.name)
+        self.datagrams = None  # type: DatagramSender
+        self.ring = None  # type: FrameRing
+        self.fps = FPS
+        self.profile = StreamProfile()
+        self.scale = 1.
+        self.captured = 0
+        self.sent = 0
+        self.capturer = None  # type: thr.Thread
+        self.controller = AdaptiveController(self) if ADAPTIVE_STREAM else None
+        self.eye = CaptureDevice() if eye is None else eye
+        self._setup_metrics(ID)
         self._determine_frame_shape()
         print("TCPSTREAMER: online")
 
-    def connect(self, IP):
-        super(TCPStreamer, self)._connectbase(IP, STREAM_SERVER_PORT, None)
-        print("TCPSTREAMER: connected to {}:{}".format(IP, STREAM_SERVER_PORT))
+    def _setup_metrics(self, ID):
+        """Registers the metrics of the stream, see generic.metrics"""
+        self.metrics = REGISTRY.group("streamer", ID)
+        self._frames = self.metrics.meter("frames")
+        self._bytes = self.metrics.meter("bytes")
+        self._sizes = self.metrics.histogram("frame_size", SIZE_BUCKETS)
+        self._encode_time = self.metrics.histogram("encode_time")
+        self._send_time = self.metrics.histogram("send_time")
+        self.metrics.gauge("captured", lambda: self.captured)
+        self.metrics.gauge("dropped", lambda: self.dropped)
+        self.metrics.gauge("fps", lambda: self.fps)
+        self.metrics.gauge("scale", lambda: self.scale)
+
+    def connect(self, IP, port=STREAM_SERVER_PORT, token=None):
+        super(TCPStreamer, self)._connectbase(IP, port, None, token)
+        print("TCPSTREAMER: connected to {}:{}".format(IP, port))
 
     @property
     def frameshape(self):
         return str(self._frameshape)[1:-1].replace(", ", "x")
 
+    @property
+    def codecs(self):
+        """Names of the codecs this streamer is able to encode with"""
+        return available()
+
+    @property
+    def transports(self):
+        return ["tcp", "udp"] if hasattr(socket.socket, "sendmsg") else ["tcp"]
+
+    def use_datagrams(self, IP, port):
+        """Streams fragmented over UDP instead of the TCP data connection"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        sock.connect((IP, port))
+        self.datagrams = DatagramSender(sock)
+        print("TCPSTREAMER: streaming datagrams to {}:{}".format(IP, port))
+
+    def set_codec(self, name, **params):
+        """Selects the codec used to encode the frames"""
+        self.codec = get_codec(name, **params)
+        print("TCPSTREAMER: encoding with codec", name)
+
+    def set_profile(self, spec):
+        """
+        Selects the stream profile (resolution, colour mode and region of interest),
+        see car.component.StreamProfile. Raises ValueError if the profile is invalid.
+        """
+        profile = StreamProfile.parse(spec)
+        profile.validate(self._frameshape)
+        self.profile = profile
+        print("TCPSTREAMER: stream profile:", profile)
+
     def _determine_frame_shape(self):
         self.eye.open()
         success, frame = self.eye.read()
@@ -124,24 +218,100 @@ class TCPStreamer(ChannelBase):
         self.eye = CaptureDevice(CaptureDeviceMocker)
         return self.eye.read()
 
+    @property
+    def dropped(self):
+        return 0 if self.ring is None else self.ring.dropped
+
+    def _capture(self):
+        """
+        Reads the capture device with deadline-based pacing and feeds
+        the ring buffer. Runs in its own thread, so a slow network
+        never stalls the camera: the sender just misses frames.
+        """
+        deadline = time.time()
+        while self.running:
+            success, frame = self.eye.read()
+            captured = time.time()
+            if success:
+                self.ring.put((captured, frame))
+                self.captured += 1
+            period = 1. / self.fps
+            deadline += period
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                # Fell behind by more than a frame, don't try to catch up in a burst
+                deadline = time.time()
+        self.ring.close()
+
     def run(self):
         """
-        Obtain frames from the capture device via OpenCV.
-        Send the frames to the UDP client (the main server)
+        Obtain frames from the capture device via OpenCV in a separate
+        capture thread. Send the latest captured frames to the server.
         """
-        pushed = 0
         self.eye.open()
-        self.running = True
-        for success, frame in self.eye.stream():
-            ##########################################
-            # Data preprocessing has to be done here #
-            serial = frame.astype(DTYPE).tostring()  #
-            ##########################################
-            self.sock.sendall(serial)
-            pushed += 1
-            print("Pushed {:>3} frames".format(pushed))
-            if not self.running:
-                break
-            time.sleep(1. / FPS)
-        self.eye.close()
+        self.codec.force_keyframe()
+        self.ring = FrameRing(capacity=2)
+        if self.controller is not None:
+            self.controller.reset(FPS)
+        capturer = self.capturer = thr.Thread(target=self._capture, name="Streamer-capture")
+        capturer.start()
+        try:
+            while self.running:
+                item = self.ring.get(timeout=0.5)
+                if item is None:
+                    continue
+                captured, frame = item
+                ##########################################
+                # Data preprocessing has to be done here #
+                if not self.profile.identity:
+                    frame = self.profile.apply(frame)
+                if self.scale != 1.:
+                    frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                                       interpolation=cv2.INTER_AREA)
+                serial = np.ascontiguousarray(frame, dtype=DTYPE)
+                start = time.time()
+                payload, flags = self.codec.encode(serial)
+                self._encode_time.observe(time.time() - start)
+                ##########################################
+                header = FrameHeader(self.sent, captured, serial.shape, serial.dtype,
+                                     codec=self.codec.ID, flags=flags)
+                start = time.time()
+                if self.datagrams is not None:
+                    self.datagrams.send(header, payload)
+                else:
+                    send_packet(self.sock, header, payload, self.cork)
+                sent = time.time() - start
+                if self.controller is not None:
+                    self.controller.record_send(self.sent, captured, sent)
+                self._send_time.observe(sent)
+                self._frames.mark()
+                self._bytes.mark(FrameHeader.size + header.length)
+                self._sizes.observe(header.length)
+                self.sent += 1
+                if self.sent % FPS == 0:
+                    print("TCPSTREAMER: sent {:>5} frames, dropped {:>4}"
+                          .format(self.sent, self.dropped))
+        except socket.error as E:
+            if self.running:
+                print("TCPSTREAMER: sending failed:", E)
+        finally:
+            # The capture thread exits with the sender, it would read the camera forever
+            self.running = False
+            self.ring.close()
+            capturer.join()
+            self.eye.close()
         print("TCPStreamer: socket and worker deleted! Exiting...")
+
+    def stop(self):
+        super(TCPStreamer, self).stop()
+        capturer, self.capturer = self.capturer, None
+        if capturer is not None:
+            capturer.join()
+
+    def teardown(self, sleep=0):
+        if self.datagrams is not None:
+            self.datagrams.sock.close()
+            self.datagrams = None
+        super(TCPStreamer, self).teardown(sleep)
@@ -2,11 +2,15 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 # stdlib imports
 import os
+import time
+from collections import OrderedDict, deque
 
 # 3rd party imports
 import cv2
 
 # Project imports
+from FIPER.generic.const import TARGET_LATENCY
+from FIPER.generic.recording import RecordingCapture
 from FIPER.generic.util import CaptureDeviceMocker
 from FIPER.generic.abstract import AbstractCommander
 
@@ -30,6 +34,14 @@ class CaptureDevice(object):
 
         self._eye = None
 
+    @classmethod
+    def replay(cls, directory, speed=1., loop=True):
+        """
+        Capture device, which replays a recording instead of a camera,
+        see generic.recording.RecordingCapture.
+        """
+        return cls(lambda: RecordingCapture(directory, speed, loop))
+
     def open(self):
         self._eye = self.device()
 
@@ -65,3 +77,223 @@ class Commander(AbstractCommander):
             return None, ()
         m = m.split(" ")
         return m[0], m[1:]
+
+
+class StreamProfile(object):
+
+    """
+    Preprocessing done by the streamer before encoding: a region of
+    interest crop, a conversion to grayscale and a resize, in this order.
+    Profiles are described by tokens, separated by spaces or commas:
+    - WxH: size of the sent frames, eg. 320x240
+    - gray or color: colour mode
+    - roi:WxH+X+Y: region of interest in capture coordinates, eg. roi:320x240+160+120
+    - full: the unprocessed capture, same as an empty profile
+    """
+
+    def __init__(self, size=None, gray=False, roi=None):
+        """
+        :param size: (width, height) of the sent frames, None keeps the capture's size
+        :param gray: whether to convert the frames to single channel grayscale
+        :param roi: (width, height, x, y) region of interest, None sends the full frame
+        """
+        self.size = size
+        self.gray = gray
+        self.roi = roi
+
+    @classmethod
+    def parse(cls, spec):
+        """Builds a profile from its string description. Raises ValueError if invalid."""
+        profile = cls()
+        for token in spec.replace(",", " ").split():
+            token = token.lower()
+            if token == "full":
+                profile = cls()
+            elif token in ("gray", "grey", "color", "colour"):
+                profile.gray = token in ("gray", "grey")
+            elif token.startswith("roi:"):
+                size, _, offset = token[4:].partition("+")
+                x, _, y = offset.partition("+")
+                profile.roi = cls._parse_size(size) + (int(x or 0), int(y or 0))
+            else:
+                profile.size = cls._parse_size(token)
+        return profile
+
+    @staticmethod
+    def _parse_size(token):
+        try:
+            width, height = (int(d) for d in token.split("x"))
+        except ValueError:
+            raise ValueError("Invalid profile token: " + token)
+        if width < 1 or height < 1:
+            raise ValueError("Invalid profile token: " + token)
+        return width, height
+
+    def validate(self, frameshape):
+        """Raises ValueError if the region of interest doesn't fit into frames of <frameshape>"""
+        if self.roi is None:
+            return
+        width, height, x, y = self.roi
+        if x + width > frameshape[1] or y + height > frameshape[0]:
+            raise ValueError("ROI {} exceeds the {}x{} capture!".format(
+                self._roi_token(), frameshape[1], frameshape[0]))
+
+    def _roi_token(self):
+        return "roi:{}x{}+{}+{}".format(*self.roi)
+
+    @property
+    def identity(self):
+        return self.size is None and not self.gray and self.roi is None
+
+    def apply(self, frame):
+        if self.roi is not None:
+            width, height, x, y = self.roi
+            frame = frame[y:y+height, x:x+width]
+        if self.gray and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.size is not None and self.size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def __str__(self):
+        tokens = []
+        if self.size is not None:
+            tokens.append("{}x{}".format(*self.size))
+        if self.gray:
+            tokens.append("gray")
+        if self.roi is not None:
+            tokens.append(self._roi_token())
+        return " ".join(tokens) if tokens else "full"
+
+
+class AdaptiveController(object):
+
+    """
+    Adapts a streamer's operating point (frame rate, JPEG quality and
+    downscale factor) to the capacity of the link.
+
+    Inputs are the duration of the blocking sends (socket backpressure),
+    the frames dropped by the streamer's ring buffer and the lag of the
+    acknowledgements sent by the receiver over the messaging channel.
+    The lag is measured on the car's clock: ack arrival - capture time.
+    Its minimum over the last few acks is used, which filters out the
+    messaging channel's own jitter.
+
+    The operating points form a ladder from the best to the cheapest.
+    The JPEG qualities of the ladder are the codec's configured quality
+    and its 3/4 and 1/2.
+    The controller steps down the ladder if the stream is congested
+    and steps back up after a few calm periods.
+    """
+
+    def __init__(self, streamer, target=TARGET_LATENCY, interval=1., calm_periods=3):
+        """
+        :param streamer: TCPStreamer instance to control
+        :param target: lag to stay under, in seconds
+        :param interval: minimal time between two adaptation decisions
+        :param calm_periods: number of calm intervals before stepping up
+        """
+        self.streamer = streamer
+        self.target = target
+        self.interval = interval
+        self.calm_periods = calm_periods
+        self.on_change = None  # callback(opstate), opstate is a string
+        self.ladder = []
+        self.level = 0
+        self._codec = None
+        self._quality = None  # configured quality of the codec
+        self._captured = OrderedDict()
+        self._lags = deque(maxlen=4)
+        self._send_time = 0.
+        self._dropped = 0
+        self._last_decision = time.time()
+        self._calm = 0
+
+    def reset(self, fps):
+        """Builds the ladder for the streamer's codec and the given base frame rate"""
+        codec = self.streamer.codec
+        if codec is not self._codec:
+            # The controller itself lowers the quality, so it is read only from a new codec
+            self._codec, self._quality = codec, getattr(codec, "quality", None)
+        top = self._quality
+        if top is None:
+            qualities = [None]
+        else:
+            qualities = sorted({top, max(1, top * 3 // 4), max(1, top // 2)}, reverse=True)
+        lowest = qualities[-1]
+        ladder = [(fps, q, 1.) for q in qualities]
+        ladder += [(fps, lowest, scale) for scale in (0.75, 0.5)]
+        ladder += [(fps * ratio, lowest, 0.5) for ratio in (0.66, 0.5, 0.33)]
+        self.ladder = ladder
+        self.level = 0
+        self._lags.clear()
+        self._calm = 0
+        self._dropped = self.streamer.dropped
+        self._apply()
+
+    @property
+    def lag(self):
+        return min(self._lags) if self._lags else None
+
+    @property
+    def opstate(self):
+        fps, quality, scale = self.ladder[self.level]
+        lag = self.lag
+        return ("fps={:.1f} quality={} scale={} level={} lag={} send_ms={:.1f}"
+                .format(fps, quality if quality is not None else "-", scale, self.level,
+                        "-" if lag is None else "{:.3f}".format(lag), self._send_time * 1000))
+
+    def record_send(self, seq, captured, duration):
+        """Called by the streamer after every sent frame"""
+        self._captured[seq] = captured
+        if len(self._captured) > 256:
+            self._captured.popitem(last=False)
+        self._send_time = 0.9 * self._send_time + 0.1 * duration
+        now = time.time()
+        if now - self._last_decision >= self.interval:
+            self._decide()
+            self._last_decision = now
+
+    def on_ack(self, message):
+        """Messaging callback for acknowledgements: ack {seq}"""
+        seq = int(message.split(" ")[1])
+        captured = self._captured.get(seq)
+        if captured is not None:
+            self._lags.append(time.time() - captured)
+
+    def _decide(self):
+        fps = self.ladder[self.level][0]
+        period = 1. / fps
+        dropped = self.streamer.dropped - self._dropped
+        self._dropped = self.streamer.dropped
+        lag = self.lag
+        # More than 10% of the frames were dropped by the ring buffer
+        overflowing = dropped > 0.1 * fps * self.interval
+        congested = ((lag is not None and lag > self.target) or
+                     self._send_time > 0.8 * period or overflowing)
+        calm = ((lag is None or lag < self.target / 2) and
+                self._send_time < 0.4 * period and not dropped)
+        if congested:
+            self._calm = 0
+            if self.level < len(self.ladder) - 1:
+                self.level += 1
+                self._apply()
+        elif calm:
+            self._calm += 1
+            if self._calm >= self.calm_periods and self.level > 0:
+                self._calm = 0
+                self.level -= 1
+                self._apply()
+        else:
+            self._calm = 0
+
+    def _apply(self):
+        fps, quality, scale = self.ladder[self.level]
+        self.streamer.fps = fps
+        self.streamer.scale = scale
+        if quality is not None:
+            self.streamer.codec.quality = quality
+        self._lags.clear()
+        print("ADAPTIVE: operating point:", self.opstate)
+        if self.on_change is not None:
+            self.on_change(self.opstate)
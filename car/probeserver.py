@@ -2,7 +2,7 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 import socket
 
-from FIPER.generic.routine import srvsock
+from FIPER.generic.routine import srvsock, parse_options, format_options
 
 
 class ProbeServer(object):
@@ -69,15 +69,21 @@ class ProbeHandshake(object):
 
     @classmethod
     def perform(cls, streamer, messenger):
+        """Returns the options of the server's response or None if the handshake failed"""
         cls._send_introduction(streamer, messenger)
         hello = cls._read_response(messenger)
         if not cls._validate_response(hello):
             print("PROBESRV: invalid server response:", hello)
             return None
+        options = parse_options(hello.split(";")[1:])
+        cls._apply_options(streamer, options, messenger.sock.getpeername()[0])
+        return options
 
     @staticmethod
     def _send_introduction(streamer, messenger):
-        introduction = ("HELLO;" + streamer.frameshape).encode()
+        options = format_options(codecs=",".join(streamer.codecs),
+                                 transports=",".join(streamer.transports))
+        introduction = ("HELLO;" + streamer.frameshape + ";" + options).encode()
         print("PROBESRV: sending introduction:", introduction)
         messenger.send(introduction)
 
@@ -92,4 +98,28 @@ class ProbeHandshake(object):
 
     @staticmethod
     def _validate_response(hello):
-        return hello == "HELLO"
+        return hello is not None and hello.split(";")[0] == "HELLO"
+
+    @staticmethod
+    def _apply_options(streamer, options, server_ip):
+        """
+        Response looks like this:
+        HELLO;codec={name};quality={JPEG quality};transport={tcp/udp};port={UDP port};
+        profile={stream profile, eg. 320x240,gray};dport={data port};rcport={RC port};
+        token={session token}
+        The data and RC ports are announced by sharded servers only.
+        The session token is sent back on the data and RC connections, see Car.connect()
+        """
+        if options.get("transport") == "udp":
+            streamer.use_datagrams(server_ip, int(options["port"]))
+        if options.get("profile"):
+            try:
+                streamer.set_profile(options["profile"])
+            except ValueError as E:
+                print("PROBESRV: ignoring stream profile:", E)
+        if "codec" not in options:
+            return
+        params = {}
+        if "quality" in options:
+            params["quality"] = int(options["quality"])
+        streamer.set_codec(options["codec"], **params)
@@ -94,12 +94,12 @@ class DirectConnection(object):
         if self.interface is None:
             print("DC: no interface! Build a connection first!")
             return
-        self.interface.send(b"stream on")
+        self.interface.acquire_stream("display")
         self.streaming = True
         self.streamer = StreamDisplayer(self.interface)  # launches the thread!
 
     def stop_stream(self):
-        self.interface.send(b"stream off")
+        self.interface.release_stream("display")
         if self.streamer is not None:
             self.streamer.teardown(0)
             self.streamer = None
@@ -122,10 +122,9 @@ class DirectConnection(object):
             self.master = master
 
         def callback(self, msock):
-            self.master.interface = InterfaceFactory(
-                msock, self.dlistener, self.rclistener
-            ).get()
+            self.master.interface = InterfaceFactory(msock, self.broker).get()
             self.running = False  # Break the mainloop in AbstractListener
+            return self.master.interface
 
 
 def run():
@@ -2,44 +2,89 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 import socket
 
-from FIPER.generic.const import (
-    MESSAGE_SERVER_PORT, STREAM_SERVER_PORT, RC_SERVER_PORT)
+from FIPER.generic.const import HANDSHAKE_TIMEOUT, STREAM_SERVER_PORT, RC_SERVER_PORT
 from FIPER.generic.messaging import Messaging
+from FIPER.generic.routine import parse_options
+from FIPER.generic.rpc import RPCEndpoint
+from FIPER.generic.session import token_preamble
 
 
 class ServerConnection(object):
 
+    """
+    Connection of a client to a FIPER server.
+    The client introduces itself on the messaging channel, then opens the
+    data and RC connections, which start with the session token of the
+    server's response (see generic/session.py).
+    """
+
     entity_type = "client"
 
-    def __init__(self, serverIP, ID):
+    def __init__(self, serverIP, ID, state="active"):
+        """
+        :param serverIP: IP address of the server
+        :param ID: the client's unique ID
+        :param state: the RC commands of an "active" client are forwarded to its car
+        """
         self.ID = ID
         self.serverIP = serverIP
-        self.messaging = Messaging(socket.create_connection((serverIP, MESSAGE_SERVER_PORT))[0],
-                                   tag=b"{}-{}:".format(self.entity_type, self.ID))
+        self.messaging = Messaging.connect_to(
+            serverIP, tag="{}-{}:".format(self.entity_type, self.ID).encode())
+        self.rpc = RPCEndpoint(self.messaging)
 
         # Validation should be done via the messaging channel:
         # - username/password check
         # - version check?
         # - server validation?
 
-        self.dsocket = socket.create_connection((serverIP, STREAM_SERVER_PORT))[0]
-        self.rcsocket = socket.create_connection((serverIP, RC_SERVER_PORT))[0]
+        options = self._introduce(state)
+        if options is None:
+            self.messaging.teardown(0)
+            raise RuntimeError("no valid response from the server")
+        token = options.get("token")
+        self.dsocket = self._connect(int(options.get("dport", STREAM_SERVER_PORT)), token)
+        self.rcsocket = self._connect(int(options.get("rcport", RC_SERVER_PORT)), token)
+
+    def _introduce(self, state):
+        """
+        Introduction: HELLO;{state}
+        Returns the options of the server's response or None if there is no valid response.
+        """
+        self.messaging.send("HELLO;{}".format(state).encode())
+        hello = self.messaging.recv(timeout=HANDSHAKE_TIMEOUT)
+        if hello is None or hello.split(";")[0] != "HELLO":
+            print("CLIENT: invalid server response:", hello)
+            return None
+        return parse_options(hello.split(";")[1:])
 
-    def _sendcmd(self, cmd, timeout=3):
-        self.messaging.send(cmd)
-        response = self.messaging.recv(timeout=timeout)
-        return response
+    def _connect(self, port, token):
+        sock = socket.create_connection((self.serverIP, port))
+        if token:
+            sock.sendall(token_preamble(token))
+        return sock
+
+    def _sendcmd(self, cmd, *args, **kw):
+        """Calls a command of the server's ClientInterface, returns its result"""
+        return self.rpc.call(cmd, *args, timeout=kw.get("timeout", 3))
 
     def request_car_list(self):
-        cars = self._sendcmd(b"cmd|cars", 3).split(", ")
+        cars = self._sendcmd("cars")
         print(cars)
-        return cars.split(", ")
+        return cars
 
     def request_car_connection(self, carID):
-        framestring = self._sendcmd(b"cmd|connect {}".format(carID), 3)
-        frameshape = framestring.split("x")
-        print("DIRECT_CONN: frameshape received:", framestring)
+        frameshape = self._sendcmd("connect", carID)
+        print("DIRECT_CONN: frameshape received:", frameshape)
+        return frameshape
 
     def observe_someone_else(self, ID):
-        status = self._sendcmd(b"cmd|watch {}".format(ID), 3)
-        print("DIRECT_CONN: status received:", status)
+        """Receives the stream of a car without controlling it"""
+        frameshape = self._sendcmd("watch", ID)
+        print("DIRECT_CONN: frameshape received:", frameshape)
+        return frameshape
+
+    def teardown(self, sleep=0):
+        self.rpc.close()
+        self.messaging.teardown(sleep)
+        self.dsocket.close()
+        self.rcsocket.close()
@@ -4,8 +4,11 @@ import abc
 import time
 import socket
 import subprocess
+import threading as thr
 
+from .latency import LatencyTracker
 from .routine import srvsock
+from .session import SessionBroker
 
 
 class AbstractCommander(object):
@@ -118,6 +121,9 @@ class AbstractListener(object):
     """
     Abstract base class for an entity which acts like a server,
     eg. client in DirectConnection and FleetHandler server.
+    Every incoming messaging connection is handshaked in a thread of
+    its own. The data and RC connections are matched to their
+    handshakes by the SessionBroker.
     """
 
     __metaclass__ = abc.ABCMeta
@@ -126,10 +132,16 @@ class AbstractListener(object):
         self.mlistener = srvsock(myIP, "messaging", timeout=3)
         self.dlistener = srvsock(myIP, "stream")
         self.rclistener = srvsock(myIP, "rc", timeout=1)
+        self.broker = SessionBroker(self.dlistener, self.rclistener)
+        self.handshakes = LatencyTracker()
         self.running = False
 
     @abc.abstractmethod
     def callback(self, msock):
+        """
+        Performs the handshake on a messaging connection.
+        Should return the built interface or None if the handshake failed.
+        """
         raise NotImplementedError
 
     def mainloop(self):
@@ -138,6 +150,7 @@ class AbstractListener(object):
         """
         print("ABS_LISTENER: online")
         self.running = True
+        self.broker.start()
         while self.running:
             try:
                 conn, addr = self.mlistener.accept()
@@ -146,15 +159,20 @@ class AbstractListener(object):
             else:
                 print("ABS_LISTENER: received connection from {}:{}"
                       .format(*addr))
-                self.callback(conn)
+                thr.Thread(target=self._handshake, args=(conn,),
+                           name="Handshake-{}:{}".format(*addr)).start()
         print("ABS_LISTENER: Exiting...")
 
+    def _handshake(self, conn):
+        start = time.time()
+        ifc = self.callback(conn)
+        self.handshakes.add("handshake" if ifc else "failed", time.time() - start)
+
     def teardown(self, sleep=2):
         self.running = False
         time.sleep(sleep)
         self.mlistener.close()
-        self.dlistener.close()
-        self.rclistener.close()
+        self.broker.teardown()
 
     def __del__(self):
         if self.running:
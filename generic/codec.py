@@ -0,0 +1,334 @@
+"""
+Frame codecs used on the A/V stream's data channel.
+Codecs are registered by name and by their numeric ID, which is
+transmitted in every FrameHeader (see generic.stream).
+
+Run "python -m FIPER.generic.codec" to benchmark the codecs.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import time
+import zlib
+
+import numpy as np
+
+from .const import DTYPE, JPEG_QUALITY, PNG_COMPRESSION, ZLIB_LEVEL, KEYFRAME_INTERVAL
+from .stream import FLAG_KEYFRAME, FrameHeader
+
+_codecs_by_name = {}
+_codecs_by_ID = {}
+
+
+def register(codec_class):
+    """Class decorator, registers a codec by its name and ID"""
+    if codec_class.ID in _codecs_by_ID:
+        raise RuntimeError("Codec ID {} is already taken by {}"
+                           .format(codec_class.ID, _codecs_by_ID[codec_class.ID].name))
+    _codecs_by_name[codec_class.name] = codec_class
+    _codecs_by_ID[codec_class.ID] = codec_class
+    return codec_class
+
+
+def get_codec(name, **params):
+    """Instantiates a codec by its name. Raises KeyError on unknown names."""
+    return _codecs_by_name[name](**params)
+
+
+def available():
+    """Returns the names of the codecs usable on this machine"""
+    return [name for name, cls in sorted(_codecs_by_name.items(), key=lambda it: it[1].ID)
+            if cls.usable()]
+
+
+def negotiate(offered, preference):
+    """
+    Selects the first codec from preference, which is also offered
+    by the remote entity and usable locally. Falls back to raw.
+    """
+    usable = available()
+    for name in preference:
+        if name in offered and name in usable:
+            return name
+    return RawCodec.name
+
+
+class Codec(object):
+
+    """
+    Base class of the frame codecs.
+    encode() returns a (payload, flags) tuple, where payload is a
+    bytes-like object. decode() reconstructs the frame from a
+    FrameHeader and its payload.
+    """
+
+    ID = None
+    name = ""
+    # Whether decode() returns a persistent buffer, overwritten by the next frame
+    reuses_buffer = False
+
+    @staticmethod
+    def usable():
+        return True
+
+    def force_keyframe(self):
+        """Stateful codecs send a keyframe next. No-op for the others."""
+        pass
+
+    def encode(self, frame):
+        raise NotImplementedError
+
+    def decode(self, header, payload):
+        raise NotImplementedError
+
+
+@register
+class RawCodec(Codec):
+
+    """Sends the frame's bytes as they are. Decoding is zero-copy."""
+
+    ID = 0
+    name = "raw"
+
+    def encode(self, frame):
+        return np.ascontiguousarray(frame), FLAG_KEYFRAME
+
+    def decode(self, header, payload):
+        return np.frombuffer(payload, dtype=header.dtype).reshape(header.shape)
+
+
+class _OpenCVCodec(Codec):
+
+    """Base class of the image codecs implemented with cv2.imencode"""
+
+    extension = ""
+
+    @staticmethod
+    def usable():
+        try:
+            import cv2
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import cv2
+        self._cv2 = cv2
+        self.params = []
+
+    def encode(self, frame):
+        success, encoded = self._cv2.imencode(self.extension, frame, self.params)
+        if not success:
+            raise RuntimeError("{} encoding failed!".format(self.name))
+        return encoded, FLAG_KEYFRAME
+
+    def decode(self, header, payload):
+        buffer = np.frombuffer(payload, dtype=np.uint8)
+        return self._cv2.imdecode(buffer, self._cv2.IMREAD_UNCHANGED)
+
+
+@register
+class JPEGCodec(_OpenCVCodec):
+
+    """Lossy JPEG compression, the quality is in the range 0-100"""
+
+    ID = 1
+    name = "jpeg"
+    extension = ".jpg"
+
+    def __init__(self, quality=JPEG_QUALITY):
+        super(JPEGCodec, self).__init__()
+        self.quality = quality
+
+    @property
+    def quality(self):
+        return self.params[1]
+
+    @quality.setter
+    def quality(self, value):
+        self.params = [self._cv2.IMWRITE_JPEG_QUALITY, int(value)]
+
+
+@register
+class PNGCodec(_OpenCVCodec):
+
+    """Lossless PNG compression, the level is in the range 0-9"""
+
+    ID = 2
+    name = "png"
+    extension = ".png"
+
+    def __init__(self, level=PNG_COMPRESSION):
+        super(PNGCodec, self).__init__()
+        self.params = [self._cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+
+
+@register
+class ZlibCodec(Codec):
+
+    """Lossless zlib compression of the raw frame bytes"""
+
+    ID = 3
+    name = "zlib"
+
+    def __init__(self, level=ZLIB_LEVEL):
+        self.level = level
+
+    def encode(self, frame):
+        return zlib.compress(np.ascontiguousarray(frame), self.level), FLAG_KEYFRAME
+
+    def decode(self, header, payload):
+        data = zlib.decompress(payload)
+        return np.frombuffer(data, dtype=header.dtype).reshape(header.shape)
+
+
+@register
+class DeltaCodec(Codec):
+
+    """
+    Keyframe + residual coding for mostly static scenes.
+    Frames are sent as the wrapping difference from the previous
+    frame, with a full keyframe after every KEYFRAME_INTERVAL residuals.
+    Both are zlib compressed, unchanged pixels compress to almost nothing.
+    Lossless. The decoder reconstructs the frames into a persistent
+    buffer, so the returned frame is overwritten by the next one.
+    """
+
+    ID = 4
+    name = "delta"
+    reuses_buffer = True
+
+    def __init__(self, level=ZLIB_LEVEL, keyframe_interval=KEYFRAME_INTERVAL):
+        self.level = level
+        self.keyframe_interval = keyframe_interval
+        self._base = None
+        self._residual = None
+        self._since_keyframe = 0
+        self._last_seq = None
+
+    def force_keyframe(self):
+        """The next encoded frame will be a keyframe"""
+        self._base = None
+
+    def _is_keyframe_due(self, frame):
+        return (self._base is None or
+                self._base.shape != frame.shape or
+                self._base.dtype != frame.dtype or
+                self._since_keyframe >= self.keyframe_interval)
+
+    def encode(self, frame):
+        frame = np.ascontiguousarray(frame)
+        if self._is_keyframe_due(frame):
+            self._base = frame.copy()
+            self._residual = np.empty_like(frame)
+            self._since_keyframe = 0
+            return zlib.compress(frame, self.level), FLAG_KEYFRAME
+        np.subtract(frame, self._base, out=self._residual)
+        np.copyto(self._base, frame)
+        self._since_keyframe += 1
+        return zlib.compress(self._residual, self.level), 0
+
+    def decode(self, header, payload):
+        data = np.frombuffer(zlib.decompress(payload), dtype=header.dtype)
+        data = data.reshape(header.shape)
+        in_sequence = self._last_seq is not None and header.seq == self._last_seq + 1
+        self._last_seq = header.seq
+        if header.keyframe:
+            if self._base is None or self._base.shape != data.shape:
+                self._base = np.empty_like(data)
+            np.copyto(self._base, data)
+            return self._base
+        if self._base is None or not in_sequence or self._base.shape != data.shape:
+            # Residual without a valid base, wait for the next keyframe
+            self._base = None
+            return None
+        np.add(self._base, data, out=self._base)
+        return self._base
+
+
+class FrameDecoder(object):
+
+    """
+    Decodes the packets of one stream with the codec named in
+    their headers. Codec instances are created on demand and
+    kept for the lifetime of the stream.
+    """
+
+    def __init__(self):
+        self._codecs = {}
+        self._unknown = set()
+
+    def decode(self, header, payload, copy=False):
+        """
+        Returns the decoded frame or None if the codec is unknown.
+
+        :param copy: return a frame of its own, also if the codec decodes
+         into a buffer, which is overwritten by the next frame
+        """
+        codec = self._codecs.get(header.codec)
+        if codec is None:
+            if header.codec not in _codecs_by_ID:
+                if header.codec not in self._unknown:
+                    print("FRAME_DECODER: unknown codec ID:", header.codec)
+                    self._unknown.add(header.codec)
+                return None
+            codec = _codecs_by_ID[header.codec]()
+            self._codecs[header.codec] = codec
+        frame = codec.decode(header, payload)
+        if copy and codec.reuses_buffer and frame is not None:
+            frame = frame.copy()
+        return frame
+
+
+def _synthetic_frames(shape, n):
+    """A moving gradient with mild noise, less pathological than white noise"""
+    Y, X = shape[:2]
+    ramp = np.add.outer(np.arange(Y), np.arange(X)).astype(np.float64)
+    frames = []
+    for i in range(n):
+        frame = (ramp + 4 * i) % 256 + np.random.randn(Y, X) * 3
+        if len(shape) == 3:
+            frame = np.repeat(frame[..., None], shape[2], axis=2)
+        frames.append(np.clip(frame, 0, 255).astype(DTYPE))
+    return frames
+
+
+def benchmark(shape=(480, 640, 3), n=30, frames=None):
+    """
+    Reports the mean payload size and the mean encoding/decoding
+    time of every usable codec.
+
+    :param shape: shape of the synthetic test frames
+    :param n: number of synthetic test frames
+    :param frames: optionally, a list of real frames to use instead
+    """
+    from .util import Table
+
+    if frames is None:
+        frames = _synthetic_frames(shape, n)
+    rawsize = frames[0].nbytes
+    tab = Table(["codec", "bytes/frame", "ratio", "encode ms", "decode ms"],
+                [10, 13, 9, 11, 11])
+    for name in available():
+        codec = get_codec(name)
+        decoder = FrameDecoder()
+        size = enc = dec = 0.
+        for seq, frame in enumerate(frames):
+            start = time.time()
+            payload, flags = codec.encode(frame)
+            enc += time.time() - start
+            payload = memoryview(payload).cast("B")
+            header = FrameHeader(seq, start, frame.shape, frame.dtype, codec.ID,
+                                 len(payload), flags)
+            start = time.time()
+            decoder.decode(header, payload)
+            dec += time.time() - start
+            size += len(payload)
+        N = len(frames)
+        tab.add(name, int(size / N), "{:.3f}".format(size / N / rawsize),
+                "{:.2f}".format(enc / N * 1000), "{:.2f}".format(dec / N * 1000))
+    print(tab.get())
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -6,8 +6,108 @@ MESSAGE_SERVER_PORT = 1234
 CAR_PROBE_PORT = 1233
 RC_SERVER_PORT = 1232
 
+# The server runs its network I/O on an asyncio event loop instead of
+# threads (see host/asyncbridge.py). Needs Python 3.7+.
+ASYNC_SERVER = False
+# Number of worker processes of the sharded server (see host/shard.py),
+# 0 runs a single process server. The workers share MESSAGE_SERVER_PORT.
+SHARD_WORKERS = 0
+# Seconds to wait for a handshake's messages and connections
+HANDSHAKE_TIMEOUT = 5.
+# Pending connections queued by the listening sockets, the handshakes of
+# this many cars connecting at the same time are served without a refusal
+LISTEN_BACKLOG = 64
+
+# Framing of the sent messages: "length" prefixes every message with its length,
+# "delimited" terminates them with ROGER, the format of older entities.
+# Both are understood on the receiving side. Longer messages are refused.
+MESSAGE_FRAMING = "length"
+MESSAGE_SIZE_LIMIT = 16 << 20
+# TCP options of the connections by channel (see routine.tune_socket): "nodelay" sends
+# every write at once, "cork" holds the writes of a packet back until the whole packet
+# is written, so it leaves in full-sized segments. Messages and RC commands are small
+# and latency bound, stream packets are large.
+SOCKET_TUNING = {"messaging": "nodelay", "rc": "nodelay", "stream": "cork"}
+# Default seconds to wait for the reply of a call over the messaging channel (see generic/rpc.py)
+RPC_TIMEOUT = 3.
+
 # Stream's tick time:
 FPS = 15
 
+# Adaptive streaming (off by default, the stream keeps its quality): the car
+# lowers the JPEG quality, the resolution and the frame rate to keep the
+# stream's lag under TARGET_LATENCY seconds.
+# The receiver acknowledges a frame every ACK_INTERVAL seconds. The lag
+# includes the ack's trip over the messaging channel.
+ADAPTIVE_STREAM = False
+TARGET_LATENCY = 0.3
+ACK_INTERVAL = 0.5
+# The server estimates the cars' clock offset with a ping every PING_INTERVAL seconds
+PING_INTERVAL = 5.
+
+# Transport of the A/V stream: "tcp" or "udp".
+# UDP is used only if the car supports it.
+TRANSPORT = "tcp"
+# Maximal size of a stream datagram, including the headers
+DATAGRAM_SIZE = 1400
+# Playout delay of the datagram jitter buffer in seconds
+JITTER_DELAY = 0.05
+# A packet header announcing a payload longer than this many times the
+# raw frame size is taken for corrupted and the receiver resynchronizes
+PAYLOAD_LIMIT = 4
+
+# Stream profile requested from the cars in the handshake, eg. "320x240,gray".
+# The car crops, converts and resizes the frames before encoding them.
+# Empty string means the full capture. See car.component.StreamProfile.
+STREAM_PROFILE = ""
+
+# Viewers of a car's stream (displays, clients) get the packets through a
+# bounded queue of SUBSCRIBER_DEPTH packets. If a viewer falls behind,
+# "drop-oldest" discards the oldest packet, "keyframe" discards the queue
+# and resumes at the next keyframe.
+SUBSCRIBER_DEPTH = 4
+SUBSCRIBER_POLICY = "keyframe"
+
+# Recordings of the cars' streams (see generic/recording.py) are written
+# under RECORD_DIR, into segment files of at most RECORD_SEGMENT_SIZE bytes.
+# RECORD_MODE "encoded" stores the packets as received, "raw" the decoded frames.
+# At most RECORD_BUFFER bytes are held in memory per recording, packets are
+# dropped beyond that. Buffered packets are written every RECORD_FLUSH_INTERVAL seconds.
+RECORD_DIR = "recordings"
+RECORD_MODE = "encoded"
+RECORD_SEGMENT_SIZE = 64 << 20
+RECORD_BUFFER = 32 << 20
+RECORD_FLUSH_INTERVAL = 0.5
+
+# Host-side frame processing pipelines (see generic/pipeline.py) run in a pool
+# of PIPELINE_WORKERS processes, 0 means one per CPU core. A pipeline keeps at
+# most PIPELINE_DEPTH frames in flight, 0 means one more than the workers.
+PIPELINE_WORKERS = 0
+PIPELINE_DEPTH = 0
+
+# Every watched car gets a window of its own. True tiles them into one window
+# of MOSAIC_SIZE (width, height) pixels instead, refreshed MOSAIC_FPS times
+# a second (see generic/subsystem.py).
+MOSAIC_DISPLAY = False
+MOSAIC_SIZE = (1280, 720)
+MOSAIC_FPS = 30
+
+# Metrics of the streams (see generic/metrics.py) are served as JSON on
+# http://127.0.0.1:METRICS_PORT/metrics by the server, on CAR_METRICS_PORT
+# by the cars. 0 doesn't serve them, eg. METRICS_PORT = 9180 enables the server's.
+METRICS_PORT = 0
+CAR_METRICS_PORT = 0
+
 # Standard RGB data type, 0-255 unsigned int
 DTYPE = np.uint8
+
+# Stream codecs, in order of preference. The first one,
+# which is supported by both ends is selected in the handshake.
+# Every car supports raw, so the codecs after it are only used if they are
+# moved before it, eg. ("jpeg", "raw") opts into the smaller, lossy JPEG stream.
+CODEC_PREFERENCE = ("raw", "delta", "zlib", "jpeg")
+JPEG_QUALITY = 80
+PNG_COMPRESSION = 3
+ZLIB_LEVEL = 1
+# A full frame is sent by the delta codec after this many residuals
+KEYFRAME_INTERVAL = 30
@@ -3,14 +3,26 @@ from __future__ import print_function, absolute_import, unicode_literals
 import abc
 import time
 import socket
-from threading import Thread
+import threading as thr
 
 import numpy as np
 
-from .const import DTYPE
-from .abstract import AbstractCommander
+from .const import (
+    DTYPE, ACK_INTERVAL, CODEC_PREFERENCE, JPEG_QUALITY, PING_INTERVAL, RECORD_DIR, RECORD_MODE,
+    STREAM_PROFILE, SUBSCRIBER_DEPTH, SUBSCRIBER_POLICY, TRANSPORT
+)
+from .codec import FrameDecoder, JPEGCodec, RawCodec, negotiate
+from .latency import ClockOffsetEstimator, LatencyTracker
 from .messaging import Messaging
-from .subsystem import Forwarder
+from .metrics import REGISTRY, SIZE_BUCKETS
+from .pipeline import Pipeline
+from .recording import StreamRecorder, recording_path
+from .routine import parse_options, format_options, tune_socket
+from .rpc import RPCEndpoint, RPCError
+from .session import new_token
+from .shmring import SharedFrameRing
+from .stream import FrameHeader, PacketReceiver, DatagramReceiver
+from .subsystem import Forwarder, PacketSender, StreamHub
 
 
 class InterfaceFactory(object):
@@ -24,39 +36,59 @@ class InterfaceFactory(object):
     has to be able to connect to a remote car on the network.
     """
 
-    def __init__(self, msock, dlistener, rclistener, recv_retries=10):
+    def __init__(self, msock, broker, recv_retries=10, messenger=None):
         """
         :param msock: connected socket, connected to a remote car
-        :param dlistener: unconnected server socket awaiting data connections
-        :param rclistener: unconnected server socket awaiting RC connections
+        :param broker: SessionBroker, which accepts the data and RC connections
+        :param messenger: messenger to use instead of wrapping msock in a Messaging
         """
 
-        self.messenger = Messaging(msock)
-        self.dlistener = dlistener
-        self.rclistener = rclistener
+        self.messenger = Messaging(msock) if messenger is None else messenger
+        self.broker = broker
+        self.token = new_token()  # matches the data and RC connections to this session
         self.introduction = None
         self.parsed = None
         self.etype = None
         self.ID = None
         self.info = None
+        self.options = {}
+        self.codec = RawCodec.name
+        self.udpsock = None
+        self.announce = {}  # extra options of the response, eg. the data and RC ports
         self.retries = recv_retries
 
     def get(self):
         if not self._read_introduction():
             return
+        response = self.accept_introduction(self.introduction)
+        if response is None:
+            return
+        self.messenger.send(response)
+        print("IFC_BUILDER: valid introduction!")
+        ifc = self._instantiate_interface()
+        if not ifc.initiated:
+            print("IFC_BUILDER: didn't receive the data and RC connections!")
+            ifc.teardown(0)
+            return None
+        return ifc
+
+    def accept_introduction(self, introduction):
+        """
+        Validates and parses an introduction.
+        Returns the response to send or None, if the introduction is invalid.
+        """
+        self.introduction = introduction
         if not self._valid_introduction():
             print("IFC_BUILDER: invalid introduction @ validation:", self.introduction)
-            return
-        self.messenger.send(b"HELLO")
+            return None
         if not self._parse_introductory_string():
             print("IFC_BUILDER: invalid introduction @ parsing:", self.introduction)
-            return
-        print("IFC_BUILDER: valid introduction!")
-        return self._instantiate_interface()
+            return None
+        return self._response()
 
     @property
     def _args(self):
-        return self.ID, self.dlistener, self.rclistener, self.messenger, self.info
+        return self.ID, self.broker, self.token, self.messenger, self.info
 
     def _read_introduction(self):
         tries = 0
@@ -76,7 +108,7 @@ class InterfaceFactory(object):
     def _valid_frame_shape(self, framestring):
         try:
             frameshape = [int(sp) for sp in framestring.split("x")]
-        except TypeError:
+        except (TypeError, ValueError):
             return False
         if len(frameshape) not in (2, 3):
             return False
@@ -86,21 +118,59 @@ class InterfaceFactory(object):
     def _parse_introductory_string(self):
         """
         Introduction looks like this:
-        {entity_type}-{ID}:HELLO;{frY}x{frX}x{frC}
+        {entity_type}-{ID}:HELLO;{frY}x{frX}x{frC};{key}={value};...
+        Cars advertise the codecs they can encode in the codecs option,
+        eg. codecs=jpeg,zlib,raw
+        Clients send their state instead of the frame shape:
+        client-{ID}:HELLO;{active/passive}
         """
 
         handshake, info = self.introduction.split(":HELLO;")
         self.etype, self.ID = handshake.split("-")
+        info = info.split(";")
+        self.options = parse_options(info[1:])
 
-        if self.etype == "car" and not self._valid_frame_shape(info):
-            return False
+        if self.etype == "car":
+            if not self._valid_frame_shape(info[0]):
+                return False
+            offered = self.options.get("codecs", RawCodec.name).split(",")
+            self.codec = negotiate(offered, CODEC_PREFERENCE)
+            if TRANSPORT == "udp" and "udp" in self.options.get("transports", "tcp").split(","):
+                self._open_datagram_socket()
+        else:
+            self.info = info[0]
         return True
 
+    def _open_datagram_socket(self):
+        """Binds a UDP socket on an ephemeral port for the car's stream"""
+        self.udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udpsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.udpsock.bind((self.messenger.sock.getsockname()[0], 0))
+
+    def _response(self):
+        """
+        Response to a valid introduction:
+        HELLO;{key}={value};...
+        The token option has to be sent back as the first bytes
+        of the data and RC connections, see generic/session.py
+        """
+        if self.etype != "car":
+            return ("HELLO;" + format_options(token=self.token, **self.announce)).encode()
+        options = {"codec": self.codec, "token": self.token}
+        if self.codec == JPEGCodec.name:
+            options["quality"] = JPEG_QUALITY
+        if self.udpsock is not None:
+            options["transport"] = "udp"
+            options["port"] = self.udpsock.getsockname()[1]
+        if STREAM_PROFILE:
+            options["profile"] = STREAM_PROFILE.replace(" ", ",")
+        options.update(self.announce)
+        return ("HELLO;" + format_options(**options)).encode()
+
     def _instantiate_interface(self):
-        ifc = {"car": _CarInterface,
-               "client": _ClientInterface
-               }[self.etype](*self._args)
-        return ifc
+        if self.etype == "car":
+            return _CarInterface(*self._args, codec=self.codec, udpsock=self.udpsock)
+        return _ClientInterface(*self._args)
 
 
 class _Interface(object):
@@ -119,24 +189,29 @@ class _Interface(object):
 
     entity_type = ""
 
-    def __init__(self, ID, dlistener, rclistener, messenger):
+    def __init__(self, ID, broker, token, messenger):
         self.ID = ID
         self.messenger = messenger
+        self.messenger.remote_tag = "{}-{}:".format(self.entity_type, ID)
         self.send = messenger.send
         self.recv = messenger.recv
+        self.rpc = RPCEndpoint(messenger)
         self.remote_ip = None
+        self.dsocket = None
+        self.rcsocket = None
+        self.dcork = False
         self.initiated = False
         try:
-            self._accept_connection_and_validate_ip_addresses(dlistener, "Data")
-            self._accept_connection_and_validate_ip_addresses(rclistener, "RC")
+            self._claim_connection_and_validate_ip_addresses(broker, token, "Data")
+            self._claim_connection_and_validate_ip_addresses(broker, token, "RC")
         except socket.timeout:
             self.initiated = False
         else:
             self.initiated = True
 
-    def _accept_connection_and_validate_ip_addresses(self, sock, typ):
+    def _claim_connection_and_validate_ip_addresses(self, broker, token, typ):
         self.out("Awaiting {} connection...".format(typ))
-        conn, addr = sock.accept()
+        conn, addr = broker.claim(token, typ)
         self.out("{} connection from {}:{}".format(typ, *addr))
         if self.remote_ip:
             if self.remote_ip != addr[0]:
@@ -149,8 +224,10 @@ class _Interface(object):
             self.remote_ip = addr[0]
         if typ == "Data":
             self.dsocket = conn
+            self.dcork = tune_socket(conn, "stream")
         else:
             self.rcsocket = conn
+            tune_socket(conn, "rc")
 
     def out(self, *args, **kw):
         """Wrapper for print(). Appends car's ID to every output line"""
@@ -160,9 +237,11 @@ class _Interface(object):
               *args, sep=sep, end=end)
 
     def teardown(self, sleep):
+        self.rpc.close()
         self.messenger.teardown(sleep)
-        self.dsocket.close()
-        self.rcsocket.close()
+        for sock in (self.dsocket, self.rcsocket):
+            if sock is not None:
+                sock.close()
 
 
 class _CarInterface(_Interface):
@@ -176,43 +255,290 @@ class _CarInterface(_Interface):
 
     entity_type = "car"
 
-    def __init__(self, ID, dlistener, rclistener, messenger, frameshape):
+    def __init__(self, ID, broker, token, messenger, frameshape, codec="raw",
+                 udpsock=None):
         """
         :param ID: the ID of the remote car 
-        :param dlistener: serving TCP socket on STREAM_SERVER_PORT
+        :param broker: SessionBroker, which accepts the data and RC connections
+        :param token: session token of the handshake
         :param messenger: a Messaging instance (see generic.messaging)
         :param frameshape: string descriping the video frame shape: {}x{}x{}
+        :param codec: name of the codec negotiated in the handshake
+        :param udpsock: bound UDP socket, if the stream is transported over UDP
         """
 
-        super(_CarInterface, self).__init__(ID, dlistener, rclistener, messenger)
-        self.out("Frameshape:", frameshape)
+        super(_CarInterface, self).__init__(ID, broker, token, messenger)
+        self._setup_stream(frameshape, codec, udpsock)
+
+    def _setup_stream(self, frameshape, codec, udpsock):
+        """Sets up the state of the car's A/V stream"""
+        self.out("Frameshape:", frameshape, "codec:", codec,
+                 "transport:", "tcp" if udpsock is None else "udp")
         self.frameshape = frameshape
+        self.codec = codec
+        self.udpsock = udpsock
+        self.last_header = None  # type: FrameHeader
+        self.opstate = {}
+        self.messenger.subscribe("opstate", self._on_opstate)
+        self.clock = ClockOffsetEstimator()
+        self.latency = LatencyTracker()
+        self.last_received = None
+        self._last_ack = 0.
+        self._last_ping = 0.
+        self.messenger.subscribe("pong", self._on_pong)
+        self.shmring = None  # type: SharedFrameRing
+        self.hub = None  # type: StreamHub
+        self.recorder = None  # type: StreamRecorder
+        self.pipeline = None  # type: Pipeline
+        self.consumers = set()  # of the car's stream, see acquire_stream()
+        self._consumers_lock = thr.Lock()
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        """Registers the metrics of the car's stream, see generic.metrics"""
+        self.metrics = REGISTRY.group("car", self.ID)
+        self._frames = self.metrics.meter("frames")
+        self._bytes = self.metrics.meter("bytes")
+        self._sizes = self.metrics.histogram("frame_size", SIZE_BUCKETS)
+        self.decode_time = self.metrics.histogram("decode_time")
+        self.metrics.gauge("queue_depth", lambda: {
+            sub.name or str(i): len(sub) for i, sub in enumerate(self._subscribers())
+            if hasattr(sub, "__len__")})
+        self.metrics.gauge("dropped", lambda: sum(
+            getattr(sub, "dropped", 0) for sub in self._subscribers()))
+        self.metrics.gauge("rtt", lambda: self.clock.rtt)
+        self.metrics.gauge("capture->host", lambda: self.latency.report("capture->host"))
+
+    def _subscribers(self):
+        return list(self.hub.subscribers) if self.hub is not None else []
+
+    def _on_opstate(self, message):
+        """Messaging callback, stores the car's adaptive stream operating point"""
+        self.opstate = parse_options(message.split(" ")[1:])
+
+    def packets(self, buffers=2):
+        """
+        Generator function that yields the received (header, payload) packets.
+        Acknowledges the packets and keeps the car's clock estimate up to date.
+        Payloads are views of reused receive buffers, see
+        generic.stream.PacketReceiver for their lifetime.
 
-    def framestream(self):
+        :param buffers: number of receive buffers to rotate among
         """
-        Generator function that yields the received video frames
+        if self.udpsock is not None:
+            receiver = DatagramReceiver(self.udpsock)
+        else:
+            receiver = PacketReceiver(self.dsocket, self.frameshape, buffers)
+        self.sync_clock()
+        for header, payload in receiver:
+            self._received(header)
+            yield header, payload
+
+    def _received(self, header):
+        """Bookkeeping of a received packet: acknowledgement, clock sync and latency"""
+        self.last_header = header
+        self.last_received = now = time.time()
+        self._frames.mark()
+        self._bytes.mark(FrameHeader.size + header.length)
+        self._sizes.observe(header.length)
+        if now - self._last_ack >= ACK_INTERVAL:
+            self.send("ack {}".format(header.seq).encode())
+            self._last_ack = now
+        if now - self._last_ping >= PING_INTERVAL:
+            self.sync_clock()
+        if self.clock.ready:
+            self.latency.add("capture->host", now - self.clock.to_local(header.timestamp))
+
+    def framestream(self, buffers=2):
         """
-        datalen = np.prod(self.frameshape)
-        data = b""
-        while 1:
-            while len(data) < datalen:
-                data += self.dsocket.recv(1024)
+        Generator that yields the received video frames, processed
+        by the car's pipeline if one is set (see set_pipeline()).
+        Reads the data connection directly, use subscribe() if the
+        stream has more than one consumer.
+
+        :param buffers: number of receive buffers to rotate among
+        """
+        return self.process(self._decoded_frames(buffers))
+
+    def _decoded_frames(self, buffers):
+        decoder = FrameDecoder()
+        for header, payload in self.packets(buffers):
             # Car RPM data is not yet transmitted.
             # It is intended to be the last [n] byte of <data>
+            start = time.time()
+            frame = decoder.decode(header, payload)
+            self.decode_time.observe(time.time() - start)
+            if frame is None:
+                continue
+            if self.shmring is not None:
+                self.shmring.publish(frame, header.timestamp)
+            yield frame
+
+    def set_pipeline(self, *specs):
+        """
+        Sets the host-side processing of the car's frames, eg.
+        set_pipeline("resize:320x240", "gray"), see generic.pipeline.
+        Without specs the pipeline is removed. Raises ValueError on invalid specs.
+        """
+        pipeline = Pipeline.parse(self.ID, self.frameshape, *specs) if specs else None
+        previous, self.pipeline = self.pipeline, pipeline
+        if previous is not None:
+            previous.close()
+
+    def process(self, frames):
+        """
+        Generator, which runs <frames> through the car's processing pipeline.
+        Follows the changes of the pipeline, see set_pipeline().
+        """
+        frames = iter(frames)
+        while 1:
+            pipeline = self.pipeline
+            if pipeline is not None:
+                for frame in pipeline.map(frames):
+                    yield frame
+                if not pipeline.closed:
+                    return  # the stream ended
+                continue
+            for frame in frames:
+                yield frame
+                if self.pipeline is not None:
+                    break
+            else:
+                return
+
+    def subscribe(self, depth=SUBSCRIBER_DEPTH, policy=SUBSCRIBER_POLICY, name=""):
+        """
+        Subscribes to the car's stream. The stream is read once by a StreamHub,
+        every subscriber gets the packets through its own bounded queue.
+        Returns a generic.subsystem.StreamSubscription.
+        """
+        self._start_hub()
+        return self.hub.subscribe(depth, policy, name)
+
+    def snapshot(self, timeout=0.):
+        """
+        Returns the latest frame of the car's stream as (header, frame) from the
+        hub's frame cache, without waiting for the next frame. Starts the hub,
+        if it's not running, and waits up to <timeout> seconds if no frame is
+        cached yet. Returns None if there is no frame. The frame is read-only.
+        """
+        self._start_hub()
+        if timeout and self.hub.cache.latest is None:
+            self.hub.cache.wait(timeout)
+        return self.hub.cache.frame()
 
-            # time.sleep(1. / fps)  # set FPS -> this is not right
-            # we need timestamps for the frames.
+    def acquire_stream(self, consumer):
+        """
+        Registers a consumer of the car's stream (a display, a recording, a client...),
+        the car is asked to start streaming for the first one.
+        :param consumer: name of the consumer, eg. "watch" or "client-{ID}"
+        """
+        with self._consumers_lock:
+            if consumer in self.consumers:
+                return
+            self.consumers.add(consumer)
+            if len(self.consumers) == 1:
+                self.send(b"stream on")
+
+    def release_stream(self, consumer):
+        """Unregisters a consumer, the car is asked to stop streaming after the last one"""
+        with self._consumers_lock:
+            if consumer not in self.consumers:
+                return
+            self.consumers.discard(consumer)
+            if not self.consumers:
+                self.send(b"stream off")
+
+    def _start_hub(self):
+        if self.hub is None or not self.hub.is_alive():
+            self.hub = StreamHub(self)
+            self.hub.start()
+
+    def publish_shm(self, slots=4):
+        """
+        Publishes the decoded frames of the car's stream into a shared memory
+        ring named fiper-{ID}, so local processes can attach to it with
+        generic.shmring.SharedFrameRing.attach() and read them without copying.
+        Returns the name of the ring.
+        """
+        if self.shmring is None:
+            slot_size = int(np.prod(self.frameshape)) * np.dtype(DTYPE).itemsize
+            self.shmring = SharedFrameRing.create("fiper-{}".format(self.ID), slot_size, slots)
+            self.acquire_stream("shm")
+        self._start_hub()
+        return self.shmring.name
+
+    def unpublish_shm(self):
+        if self.shmring is not None:
+            shmring, self.shmring = self.shmring, None
+            shmring.close()
+            self.release_stream("shm")
+
+    def record(self, mode=RECORD_MODE, directory=RECORD_DIR):
+        """
+        Records the car's stream into segment files under <directory>,
+        see generic.recording. Returns the path of the recording.
+
+        :param mode: "encoded" stores the packets as received, "raw" the decoded frames
+        """
+        if self.recorder is None or self.recorder.closed:
+            self._start_hub()
+            recorder = StreamRecorder(self.hub, recording_path(self.ID, directory), mode)
+            self.recorder = self.hub.attach(recorder, prime=False)
+            self.acquire_stream("record")
+        return self.recorder.directory
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+            self.release_stream("record")
+
+    def sync_clock(self):
+        """Sends a ping, the pong is used to estimate the car's clock offset"""
+        self._last_ping = time.time()
+        self.send("ping {!r}".format(self._last_ping).encode())
+
+    def _on_pong(self, message):
+        """Messaging callback for pongs: pong {host time} {car time}"""
+        received = time.time()
+        sent, remote = (float(t) for t in message.split(" ")[1:3])
+        self.clock.add(sent, remote, received)
+
+    def mark_displayed(self):
+        """
+        Called by display routines after the last yielded frame
+        got on screen. Records the host->display latency.
+        """
+        if self.last_received is not None:
+            self.latency.add("host->display", time.time() - self.last_received)
 
-            # # # # FRAME PREPROCESSING SHOULD BE DONE HERE # # # #
-            yield np.fromstring(data[:datalen], dtype=DTYPE).reshape(self.frameshape)
-            # #####################################################
-            data = data[datalen:]
+    def latencies(self):
+        """
+        Returns the latency statistics of this car's stream:
+        percentiles of the capture->host and host->display latencies
+        in seconds, the estimated clock offset (car - host) and the
+        round trip time of the messaging channel.
+        """
+        return {
+            "capture->host": self.latency.report("capture->host"),
+            "host->display": self.latency.report("host->display"),
+            "clock_offset": self.clock.offset,
+            "rtt": self.clock.rtt
+        }
 
     def perform_remote_shutdown(self, await_remote=2):
-        self.send(b"shutdown")
-        time.sleep(await_remote)
-        status = self.recv()
-        errcode = status if status is None else (status == "car-{}:offline".format(self.ID))
+        """
+        Calls the car's shutdown method, returns as soon as it answers.
+        :param await_remote: max. seconds to wait for the answer
+        :return: True if the car went offline, False on an unknown status, None on no answer
+        """
+        try:
+            status = self.rpc.call("shutdown", timeout=await_remote)
+        except RPCError as E:
+            print("CARIFC-{}: shutdown failed: {}".format(self.ID, E))
+            status = None
+        errcode = status if status is None else (status == "offline")
         msgs = {None: "no corpse response",
                 True: "shut down as expected",
                 False: "unknown status"}
@@ -221,7 +547,15 @@ class _CarInterface(_Interface):
 
     def teardown(self, sleep=3):
         success = self.perform_remote_shutdown(await_remote=2)
+        if self.hub is not None:
+            self.hub.teardown()
         super(_CarInterface, self).teardown(max(0, sleep-2))
+        if self.udpsock is not None:
+            self.udpsock.close()
+        self.unpublish_shm()
+        self.stop_recording()
+        self.set_pipeline()
+        REGISTRY.remove("car", self.ID)
         self.out("Teardown finished!")
         return success
 
@@ -236,80 +570,79 @@ class _ClientInterface(_Interface):
     Groups together two concepts:
     - the message connection, implemented by a Messaging object
     - TCP or UDP or RTP connection, used to send the A/V stream
+    The client's commands are calls over the messaging channel (see generic/rpc.py):
+    cars, connect <carID>, watch <carID> and disconnect.
     """
 
     entity_type = "client"
 
-    def __init__(self, ID, dlistener, rclistener, messenger, state):
+    def __init__(self, ID, broker, token, messenger, state):
         """
         :param ID: the client's unique ID
-        :param dlistener: serving TCP socket on STREAM_SERVER_PORT
+        :param broker: SessionBroker, which accepts the data and RC connections
+        :param token: session token of the handshake
         :param messenger: Messaging object
         """
-        super(_ClientInterface, self).__init__(ID, dlistener, rclistener, messenger)
+        super(_ClientInterface, self).__init__(ID, broker, token, messenger)
         self.stream_worker = None
         self.rc_worker = None
         self.carifc = None
         self.state = state
-        self.commander = self.__class__.Commander(
-            messenger, master_name="CarIfc-{}".format(ID),
-            shutdown=self.teardown,
-            cars=lambda: "Lightning McQueen",
-            connect=self.attach,
-            disconnect=self.detach
-        )
-        self.commander.start()
+        self.control = False  # whether the client's RC commands are forwarded to the car
+        self.cars = {}  # the server's cars, set by the Listener
+        self.rpc.serve("cars", self.list_cars)
+        self.rpc.serve("connect", self.connect)
+        self.rpc.serve("watch", self.watch)
+        self.rpc.serve("disconnect", self.detach)
+
+    def list_cars(self):
+        """IDs of the cars available on the server"""
+        return sorted(self.cars)
+
+    def connect(self, ID, control=True):
+        """Attaches the client to a car, returns the car's frame shape"""
+        if ID not in self.cars:
+            raise KeyError("no such car: {}".format(ID))
+        self.attach(self.cars[ID])
+        self.control = control
+        self.forward()
+        return list(self.carifc.frameshape)
+
+    def watch(self, ID):
+        """Attaches the client to a car's stream only, the client can't control the car"""
+        return self.connect(ID, control=False)
 
     def attach(self, carifc):
         if self.carifc is not None:
-            print("ClientInterface already connected to", self.carifc.ID)
-            return
+            raise RuntimeError("already connected to {}".format(self.carifc.ID))
         self.carifc = carifc
-        self.stream_worker = Forwarder(carifc.dsocket, self.dsocket, name="CliFace-Stream")
+        carifc._start_hub()
+        carifc.acquire_stream("client-{}".format(self.ID))
+        self.stream_worker = PacketSender(carifc.hub, self.dsocket, name="CliFace-Stream",
+                                          cork=self.dcork)
         self.rc_worker = Forwarder(carifc.rcsocket, self.rcsocket, name="CliFace-RC")
-        self.send(b"x".join(bytes(d) for d in carifc.frameshape))
 
     def forward(self):
         if self.carifc is None:
             print("No CarInterface connected!")
             return
         self.stream_worker.start()
-        if self.state == "active":
+        if self.state == "active" and self.control:
             self.rc_worker.start()
 
     def detach(self):
         if self.carifc is None:
             return
+        # Runs in the messaging thread as the disconnect call, so nothing waits here
         self.stream_worker.teardown(0)
-        self.rc_worker.teardown(1)
+        self.rc_worker.teardown(0)
+        self.carifc.release_stream("client-{}".format(self.ID))
         self.carifc = None
 
     def teardown(self, sleep=1):
         if self.carifc:
             self.detach()
-        self.commander.teardown()
         super(_ClientInterface, self).teardown(sleep)
 
     def __del__(self):
         self.teardown()
-
-    class Commander(Thread, AbstractCommander):
-
-        """
-        Nested class, which defines the command parser.
-        Commands are received from the client's messaging channel.
-        """
-
-        def __init__(self, messenger, master_name, **commands):
-            Thread.__init__(self, name=master_name + "-Commander")
-            AbstractCommander.__init__(self, master_name, **commands)
-            self.messenger = messenger  # type: Messaging
-
-        def read_cmd(self):
-            found = self.messenger.recv(1, timeout=1)
-            if found is None:
-                return "idle", ""
-            found = found.split(" ")
-            cmd = found[0].lower()
-            args = found[1:] if len(found) > 1 else ""
-            return cmd, args
@@ -0,0 +1,75 @@
+from __future__ import print_function, absolute_import, unicode_literals
+
+from collections import deque
+
+import numpy as np
+
+
+class ClockOffsetEstimator(object):
+
+    """
+    Estimates the offset of a remote clock from ping/pong round trips,
+    the way NTP does: offset = remote_time - (sent + received) / 2.
+    The sample with the smallest round trip time among the recent ones
+    is trusted, since it suffered the least from queueing delays.
+    """
+
+    def __init__(self, window=8):
+        self._samples = deque(maxlen=window)
+
+    def add(self, sent, remote, received):
+        """
+        :param sent: local time the ping was sent
+        :param remote: remote time the pong was sent
+        :param received: local time the pong arrived
+        """
+        rtt = received - sent
+        self._samples.append((rtt, remote - (sent + received) / 2.))
+
+    @property
+    def ready(self):
+        return bool(self._samples)
+
+    @property
+    def rtt(self):
+        return min(self._samples)[0] if self._samples else None
+
+    @property
+    def offset(self):
+        """Remote clock minus local clock in seconds, None if not yet estimated"""
+        return min(self._samples)[1] if self._samples else None
+
+    def to_local(self, remote_time):
+        return remote_time - (self.offset or 0.)
+
+
+class LatencyTracker(object):
+
+    """
+    Keeps the recent samples of named latency series,
+    eg. capture->host and host->display, and reports their percentiles.
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, window=512):
+        self.window = window
+        self.series = {}
+
+    def add(self, name, seconds):
+        if name not in self.series:
+            self.series[name] = deque(maxlen=self.window)
+        self.series[name].append(seconds)
+
+    def report(self, name):
+        """
+        Returns a dictionary with the percentiles (p50, p90, p99)
+        of a series in seconds and the number of samples (n).
+        """
+        samples = self.series.get(name)
+        if not samples:
+            return {"n": 0}
+        values = np.percentile(np.array(samples), self.percentiles)
+        report = {"p{}".format(p): v for p, v in zip(self.percentiles, values)}
+        report["n"] = len(samples)
+        return report
@@ -1,10 +1,131 @@
 from __future__ import print_function, absolute_import, unicode_literals
 
+import os
 import socket
+import struct
 import threading as thr
 import time
+from collections import deque
+from queue import Queue
 
-from .const import MESSAGE_SERVER_PORT
+from .const import MESSAGE_SERVER_PORT, MESSAGE_FRAMING, MESSAGE_SIZE_LIMIT
+from .routine import tune_socket
+
+# Delimiter of the messages in the "delimited" framing
+DELIMITER = b"ROGER"
+# First byte of the messages in the "length" framing, followed by the length of
+# the message as uint32. 0xFB never starts a UTF-8 text, so it can't start a
+# delimited message: receivers tell the two framings apart message by message.
+FRAME_MARK = 0xFB
+_prefix = struct.Struct("!BI")
+
+
+# Buffers written by one scatter-gather call at most
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+def message_parts(msg, tag=b"", framing=MESSAGE_FRAMING):
+    """Returns the buffers of a tagged message in <framing>, to be written in one scatter-gather write"""
+    if framing == "length":
+        return [_prefix.pack(FRAME_MARK, len(tag) + len(msg)), tag, msg]
+    return [tag, msg, DELIMITER]
+
+
+def frame_message(msg, framing=MESSAGE_FRAMING):
+    """Returns the wire format of a message (bytes) in <framing>: "length" or "delimited"."""
+    return b"".join(message_parts(msg, framing=framing))
+
+
+class MessageParser(object):
+
+    """
+    Incremental parser of the received messages, in both framings.
+    Data is received into a reusable buffer (see space() and received()),
+    every byte is looked at once: length-prefixed messages are sliced out by
+    their length, delimiters are searched for in the new bytes only.
+    The buffer grows to fit the largest message, up to <limit> bytes.
+    """
+
+    def __init__(self, size=1 << 16, limit=MESSAGE_SIZE_LIMIT):
+        self.limit = limit
+        self._buffer = bytearray(size)
+        self._start = 0  # first byte of the pending message
+        self._end = 0  # end of the received data
+        self._scanned = 0  # the delimiter is not in [_start, _scanned)
+        self.delimited = False  # whether a delimited message was received
+
+    @property
+    def pending(self):
+        """Bytes of the incomplete message"""
+        return bytes(self._buffer[self._start:self._end])
+
+    def space(self):
+        """
+        Returns a writable memoryview of the free space of the buffer, receive
+        into it and pass the number of received bytes to received().
+        """
+        if self._end == len(self._buffer):
+            if self._start:
+                # Moving the incomplete message to the front
+                pending = self._end - self._start
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+                self._scanned -= self._start
+                self._start, self._end = 0, pending
+            if self._end == len(self._buffer):
+                self._buffer.extend(bytes(len(self._buffer)))
+        return memoryview(self._buffer)[self._end:]
+
+    def received(self, n):
+        """Parses <n> bytes received into space(), returns the completed messages as bytes"""
+        self._end += n
+        return self._parse()
+
+    def feed(self, data):
+        """Copies <data> into the buffer and returns the completed messages as bytes"""
+        data = memoryview(data)
+        msgs = []
+        while len(data):
+            view = self.space()
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            view.release()
+            msgs.extend(self.received(n))
+            data = data[n:]
+        return msgs
+
+    def _parse(self):
+        msgs = []
+        buf = self._buffer
+        while self._start < self._end:
+            start = self._start
+            if buf[start] == FRAME_MARK:
+                if self._end - start < _prefix.size:
+                    break
+                length = _prefix.unpack_from(buf, start)[1]
+                if length > self.limit:
+                    raise ValueError("Message of {} bytes exceeds the limit".format(length))
+                begin = start + _prefix.size
+                if self._end - begin < length:
+                    break
+                msgs.append(bytes(buf[begin:begin + length]))
+                self._start = begin + length
+            else:
+                found = buf.find(DELIMITER, max(start, self._scanned), self._end)
+                if found < 0:
+                    # The delimiter may be cut in half by the end of the data
+                    self._scanned = max(start, self._end - len(DELIMITER) + 1)
+                    if self._end - start > self.limit:
+                        raise ValueError("Delimiter not found in {} bytes".format(self.limit))
+                    break
+                msgs.append(bytes(buf[start:found]))
+                self._start = found + len(DELIMITER)
+                self.delimited = True
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+        return msgs
 
 
 class Messaging(object):
@@ -12,25 +133,36 @@ class Messaging(object):
     """
     Wraps a TCP socket, which will be used for two-way
     message-passing between the car and the server.
+    Messages are sent as soon as they are queued, the ones queued
+    meanwhile are coalesced into one scatter-gather write. A blocking
+    recv() returns as soon as a message arrives. Received messages
+    may be in either framing (see MessageParser).
     """
 
-    def __init__(self, conn, tag=b"", sendtick=0.5):
+    def __init__(self, conn, tag=b"", framing=MESSAGE_FRAMING):
         """
         :param conn: socket, around which the Messenger is wrapped
         :param tag: optional tag, concatenated to the beginning of every message
+        :param framing: framing of the sent messages, "length" (length-prefixed)
+         or "delimited" (terminated by ROGER, understood by older peers). Falls back
+         to "delimited" if the remote entity sends delimited messages.
         """
         self.tag = tag
-        self.sendtick = sendtick
-        self.recvbuffer = []
-        self.sendbuffer = []
+        self.framing = framing
+        self.remote_tag = ""
+        self.recvbuffer = deque()
+        self.sendbuffer = Queue()
+        self.handlers = {}
         self.sock = conn
+        self._cond = thr.Condition()
         self.job_in = thr.Thread(target=self._flow_in)
         self.job_out = thr.Thread(target=self._flow_out)
 
-        if self.sock.gettimeout() <= 0:
+        if not self.sock.gettimeout():  # blocking (None) or non-blocking (0.0)
             print("MESSENGER: socket received has timeout:", self.sock.gettimeout())
             print("MESSENGER: setting it to 1")
             self.sock.settimeout(1)
+        tune_socket(self.sock, "messaging")
 
         self.running = True
         self.job_in.start()
@@ -45,18 +177,56 @@ class Messaging(object):
     def _flow_out(self):
         """
         This method is responsible for the sending of
-        messages from the send buffer.
+        messages from the send buffer. It sleeps until a message
+        is queued, then sends every queued message in one write.
         This is intended to run in a separate thread.
         """
         print("MESSENGER: flow_out online!")
-        while self.running:
-            if self.sendbuffer:
-                msg = self.sendbuffer.pop(0)
-                for slc in (msg[i:i+1024] for i in range(0, len(msg), 1024)):
-                    self.sock.send(slc)
-            time.sleep(self.sendtick)
+        closing = False
+        while self.running and not closing:
+            buffers = []
+            item = self.sendbuffer.get()
+            while item is not None:
+                buffers.extend(item)
+                if self.sendbuffer.empty():
+                    break
+                item = self.sendbuffer.get_nowait()
+            closing = item is None
+            try:
+                self._flush(buffers)
+            except socket.error as E:
+                print("MESSENGER: caught socket exception:", E)
+                break
         print("MESSENGER: flow_out exiting...")
 
+    def _flush(self, buffers):
+        """
+        Writes the buffers with as few system calls as possible: sendmsg()
+        writes up to IOV_MAX of them at once. Partial writes are resumed,
+        write timeouts are retried while the Messaging is running.
+        """
+        buffers = [b for b in buffers if b]
+        if not hasattr(self.sock, "sendmsg"):
+            buffers = [b"".join(buffers)] if buffers else []
+        buffers = [memoryview(b) for b in buffers]
+        i = 0
+        while i < len(buffers):
+            try:
+                if len(buffers) - i == 1:
+                    sent = self.sock.send(buffers[i])
+                else:
+                    sent = self.sock.sendmsg(buffers[i:i + IOV_MAX])
+            except socket.timeout:
+                if not self.running:
+                    raise
+                continue
+            while sent:
+                if sent < len(buffers[i]):
+                    buffers[i] = buffers[i][sent:]
+                    break
+                sent -= len(buffers[i])
+                i += 1
+
     def _flow_in(self):
         """
         This method is responsible to receive and chop up the
@@ -64,72 +234,184 @@ class Messaging(object):
         buffer.
         """
         print("MESSENGER: flow_in online!")
+        parser = MessageParser()
         while self.running:
-            data = b""
-            while data[-5:] != b"ROGER" and self.running:
-                try:
-                    slc = self.sock.recv(1024)
-                except socket.timeout:
-                    time.sleep(0.1)
-                except socket.error as E:
+            try:
+                n = self.sock.recv_into(parser.space())
+                if not n:
+                    break  # closed by the remote entity
+                msgs = parser.received(n)
+            except socket.timeout:
+                continue
+            except socket.error as E:
+                if self.running:
                     print("MESSENGER: caught socket exception:", E)
-                    self.teardown(1)
-                except Exception as E:
-                    print("MESSENGER: generic exception:", E)
-                    self.teardown(1)
-                else:
-                    data += slc
-            if not self.running:
-                if data:
-                    print("MESSENGER: data left hanging:" + data[:-5].decode("utf8"))
-                    return
-            data = data[:-5].decode("utf8")
-            self.recvbuffer.extend(data.split("ROGER"))
+                break
+            except ValueError as E:
+                print("MESSENGER: invalid message:", E)
+                break
+            self._check_framing(parser)
+            for msg in msgs:
+                self._deliver(msg)
+        if parser.pending:
+            print("MESSENGER: data left hanging:" + parser.pending.decode("utf8", "replace"))
+        self.running = False
+        self.sendbuffer.put(None)
+        with self._cond:
+            self._cond.notify_all()
         print("MESSENGER: flow_in exiting...")
 
+    def _check_framing(self, parser):
+        """An older remote entity only understands delimited messages"""
+        if parser.delimited and self.framing != "delimited":
+            print("MESSENGER: remote sends delimited messages, switching to them")
+            self.framing = "delimited"
+
+    def subscribe(self, keyword, callback):
+        """
+        Messages, whose first word is <keyword> are passed to
+        callback(message) instead of the receive buffer.
+        The remote entity's tag (see remote_tag) is stripped before matching.
+        Callbacks are run in the receiving thread, so they should be quick.
+        Matching messages, which arrived before the subscription and are
+        still in the receive buffer, are passed to the callback right away.
+        """
+        with self._cond:
+            self.handlers[keyword] = callback
+            early = [msg for msg in self.recvbuffer if self._body(msg).split(" ", 1)[0] == keyword]
+            for msg in early:
+                self.recvbuffer.remove(msg)
+        for msg in early:
+            self._handle(callback, self._body(msg))
+
+    def _body(self, msg):
+        """The message without the remote entity's tag"""
+        if self.remote_tag and msg.startswith(self.remote_tag):
+            return msg[len(self.remote_tag):]
+        return msg
+
+    def _deliver(self, data):
+        """Decodes a received message and hands it to its handler or the receive buffer"""
+        try:
+            msg = data.decode("utf8")
+        except UnicodeDecodeError:
+            print("MESSENGER: dropped a message, which is not valid UTF-8:", repr(data[:64]))
+            return
+        body = self._body(msg)
+        handler = self.handlers.get(body.split(" ", 1)[0])
+        if handler is None:
+            self._store(msg)
+            return
+        self._handle(handler, body)
+
+    @staticmethod
+    def _handle(handler, body):
+        try:
+            handler(body)
+        except Exception as E:
+            print("MESSENGER: handler of [{}] raised: {}".format(body, E))
+
+    def _store(self, msg):
+        """Puts a message into the receive buffer and wakes up the waiting recv() calls"""
+        with self._cond:
+            self.recvbuffer.append(msg)
+            self._cond.notify()
+
     def send(self, *msgs):
         """
         This method prepares and stores the messages in the
-        send buffer for sending.
+        send buffer for sending. They are sent right away
+        by the sender thread.
         
         :param msgs: the actual messages to send
         """
         assert all(isinstance(m, bytes) for m in msgs)
-        self.sendbuffer.extend([self.tag + m + b"ROGER" for m in msgs])
+        buffers = []
+        for m in msgs:
+            buffers.extend(message_parts(m, self.tag, self.framing))
+        self.sendbuffer.put(buffers)
 
     def recv(self, n=1, timeout=0):
         """
         This method, when called, returns messages available in
         the receive buffer. The messages are returned in a
-        Last-In-First-Out (queue-like) order.
+        First-In-First-Out (queue-like) order.
         
         :param n: the number of messages to retreive at once 
-        :param timeout: set timeout if no messages are available
+        :param timeout: max. seconds to wait for the messages, returns as soon as they arrive
         :return: returns the decoded (UTF-8) message or a list of messages
         """
         msgs = []
-        for i in range(n):
-            try:
-                m = self.recvbuffer.pop(0)
-            except IndexError:
-                if timeout:
-                    time.sleep(timeout)
-                    try:
-                        m = self.recvbuffer.pop(0)
-                    except IndexError:
-                        msgs.append(None)
+        deadline = time.time() + timeout
+        with self._cond:
+            for i in range(n):
+                while not self.recvbuffer:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not self.running:
                         break
-                else:
+                    self._cond.wait(remaining)
+                if not self.recvbuffer:
                     msgs.append(None)
                     break
-            msgs.append(m)
+                msgs.append(self.recvbuffer.popleft())
         return msgs if len(msgs) > 1 else msgs[0]
 
     def teardown(self, sleep=0):
         self.running = False
+        self.sendbuffer.put(None)
+        with self._cond:
+            self._cond.notify_all()
         time.sleep(sleep)
         self.sock.close()
 
     def __del__(self):
         if self.running:
             self.teardown()
+
+
+def benchmark(n=200):
+    """
+    Reports the round trip time of command/response pairs between two
+    Messaging objects on the loopback interface. The responder answers
+    from a recv() loop, the way Commanders do.
+
+    :param n: number of round trips
+    """
+    from .latency import LatencyTracker
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    conn = socket.create_connection(listener.getsockname(), timeout=1)
+    accepted, addr = listener.accept()
+    listener.close()
+    accepted.settimeout(1)
+    requester, responder = Messaging(conn), Messaging(accepted)
+
+    def respond():
+        while responder.running:
+            msg = responder.recv(timeout=1)
+            if msg is not None:
+                responder.send(("re: " + msg).encode())
+
+    worker = thr.Thread(target=respond)
+    worker.start()
+    tracker = LatencyTracker(window=n)
+    lost = 0
+    for i in range(n):
+        start = time.time()
+        requester.send("cmd {}".format(i).encode())
+        if requester.recv(timeout=3) is None:
+            lost += 1
+            continue
+        tracker.add("rtt", time.time() - start)
+    requester.teardown()
+    responder.teardown()
+    worker.join()
+    report = tracker.report("rtt")
+    print("MESSAGING: {} round trips, {} lost, rtt p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms"
+          .format(report["n"], lost, *[report[p] * 1000 for p in ("p50", "p90", "p99")]))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,267 @@
+"""
+Metrics of the fleet's streams.
+
+The metrics are kept in groups, eg. REGISTRY.group("car", ID), and are
+updated in the hot loops of the streams, so they are made cheap: every
+metric is written by a single thread (the one owning the loop) with plain
+integer arithmetic, without locks. Readers may see a slightly stale value,
+but never block the writers.
+
+The registry is read by the metrics console command and served as JSON by
+a MetricsServer (http://127.0.0.1:METRICS_PORT/metrics) for dashboards.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import json
+import time
+import threading as thr
+from bisect import bisect_left
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from .const import METRICS_PORT
+
+# Upper bounds of the histograms' buckets
+SIZE_BUCKETS = tuple(1 << e for e in range(10, 23))  # 1 kB - 4 MB
+TIME_BUCKETS = (.0005, .001, .002, .005, .01, .02, .05, .1, .2, .5)
+
+
+class Counter(object):
+
+    """A monotonic count"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def collect(self):
+        return self.value
+
+
+class Meter(object):
+
+    """
+    A count and its rate per second over the last <window> whole seconds,
+    counted in per-second buckets.
+    """
+
+    __slots__ = ("total", "window", "_counts", "_stamps", "_first")
+
+    def __init__(self, window=5):
+        self.total = 0
+        self.window = window
+        self._counts = [0] * (window + 1)
+        self._stamps = [0] * (window + 1)
+        self._first = None
+
+    def mark(self, n=1):
+        self.total += n
+        second = int(time.time())
+        if self._first is None:
+            self._first = second
+        i = second % len(self._counts)
+        if self._stamps[i] != second:
+            self._stamps[i] = second
+            self._counts[i] = 0
+        self._counts[i] += n
+
+    def rate(self):
+        current = int(time.time())
+        if self._first is None or self._first >= current:
+            return 0.
+        counted = sum(count for stamp, count in zip(self._stamps, self._counts)
+                      if current - self.window <= stamp < current)
+        # A young meter is averaged over the seconds it has seen
+        return counted / float(min(self.window, current - self._first))
+
+    def collect(self):
+        return {"total": self.total, "rate": round(self.rate(), 3)}
+
+
+class Histogram(object):
+
+    """Distribution of values in fixed buckets: the counts of the values <= each bound"""
+
+    __slots__ = ("bounds", "counts", "n", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.n = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.sum += value
+
+    def collect(self):
+        buckets = dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts))
+        return {"n": self.n, "mean": self.sum / self.n if self.n else None, "buckets": buckets}
+
+
+class Gauge(object):
+
+    """A value read from a callable at collection time, eg. a queue's length"""
+
+    __slots__ = ("read",)
+
+    def __init__(self, read):
+        self.read = read
+
+    def collect(self):
+        try:
+            return self.read()
+        except Exception:  # the owner is being torn down
+            return None
+
+
+class MetricGroup(object):
+
+    """The metrics of one entity, eg. a car, by their names"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, name, factory):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = factory()
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def meter(self, name):
+        return self._get(name, Meter)
+
+    def histogram(self, name, bounds=TIME_BUCKETS):
+        return self._get(name, lambda: Histogram(bounds))
+
+    def gauge(self, name, read):
+        self.metrics[name] = Gauge(read)
+        return self.metrics[name]
+
+    def collect(self):
+        return {name: metric.collect() for name, metric in list(self.metrics.items())}
+
+
+class MetricsRegistry(object):
+
+    """
+    Groups of metrics by kind and ID, eg. ("car", "Car1"), and collectors,
+    callables returning the metrics of a kind computed at collection time.
+    """
+
+    def __init__(self):
+        self.groups = {}  # kind: {ID: MetricGroup}
+        self.collectors = {}
+        self._lock = thr.Lock()
+
+    def group(self, kind, ID):
+        """Returns the group of an entity, creates it on first use"""
+        with self._lock:
+            groups = self.groups.setdefault(kind, {})
+            if ID not in groups:
+                groups[ID] = MetricGroup()
+            return groups[ID]
+
+    def remove(self, kind, ID):
+        with self._lock:
+            self.groups.get(kind, {}).pop(ID, None)
+
+    def collector(self, kind, collect):
+        """Registers a callable returning the metrics of <kind> as a dict, None removes it"""
+        with self._lock:
+            if collect is None:
+                self.collectors.pop(kind, None)
+            else:
+                self.collectors[kind] = collect
+
+    def collect(self):
+        """All metrics as a JSON serializable dict: {kind: {ID: {name: value}}}"""
+        with self._lock:
+            groups = {kind: dict(members) for kind, members in self.groups.items()}
+            collectors = dict(self.collectors)
+        metrics = {kind: {ID: group.collect() for ID, group in members.items()}
+                   for kind, members in groups.items()}
+        for kind, collect in collectors.items():
+            try:
+                metrics[kind] = collect()
+            except Exception as E:
+                metrics[kind] = {"error": "{}: {}".format(E.__class__.__name__, E)}
+        metrics["time"] = time.time()
+        return metrics
+
+
+# The registry of the process
+REGISTRY = MetricsRegistry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.registry.collect(), default=str).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes are not worth a line on the console
+
+
+class MetricsServer(object):
+
+    """Serves the registry as JSON over HTTP in a separate thread"""
+
+    def __init__(self, port=METRICS_PORT, host="127.0.0.1", registry=REGISTRY):
+        """
+        :param port: TCP port to listen on, 0 picks a free one
+        :param host: address to bind to, the loopback interface by default
+        """
+        handler = type(str("MetricsHandler"), (_MetricsHandler,), {"registry": registry})
+        self.httpd = _ThreadingHTTPServer((host, port), handler)
+        self.address = self.httpd.server_address
+        self.worker = thr.Thread(target=self.httpd.serve_forever, name="Metrics-HTTP")
+        self.worker.daemon = True
+
+    @classmethod
+    def launch(cls, port=METRICS_PORT, host="127.0.0.1", registry=REGISTRY):
+        """
+        Starts a server, returns it or None, if <port> is 0 (disabled) or can't be bound.
+        A failed bind leaves the process running without the endpoint.
+        """
+        if not port:
+            return None
+        try:
+            server = cls(port, host, registry)
+        except (OSError, IOError) as E:
+            print("METRICS: warning: can't serve on {}:{}: {}".format(host, port, E))
+            return None
+        return server.start()
+
+    def start(self):
+        self.worker.start()
+        print("METRICS: serving on http://{}:{}/metrics".format(*self.address))
+        return self
+
+    def teardown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,369 @@
+"""
+Host-side frame processing pipeline.
+
+A Pipeline is a chain of stages (resize, colour conversion, overlays,
+detectors...), run on the frames of a car in a pool of worker processes,
+so heavy CV work uses every core and leaves the receiving threads alone.
+Frames are handed over to the workers through a shared memory block of
+the pipeline, only the frame's slot number and shape travel through the
+pool's pipes. Frames of a car are yielded in their original order.
+
+Stages are picklable callables with the signature stage(frame, meta) -> frame,
+where meta is a dict of the car's ID and the frame's number (n). Stages are
+named in specs, eg. "resize:320x240 gray overlay", new ones can be added with
+register_stage(). Stages run in the worker processes, so they can't keep
+state across frames (consecutive frames go to different workers).
+
+Needs Python 3.8+ (multiprocessing.shared_memory).
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import time
+import threading as thr
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from .const import DTYPE, PIPELINE_WORKERS, PIPELINE_DEPTH
+from .latency import LatencyTracker
+from .shmring import shared_memory, attach_shared_memory
+
+_stages = {}
+
+
+def register_stage(name, factory):
+    """
+    Makes a stage available in the specs. The factory gets the argument of
+    the spec (the part after the colon, "" if none) and returns the stage.
+    Factories and stages have to be picklable, eg. module-level classes.
+    """
+    _stages[name] = factory
+    return factory
+
+
+def _stage(name):
+    def decorator(factory):
+        return register_stage(name, factory)
+    return decorator
+
+
+@_stage("resize")
+class Resize(object):
+
+    """resize:WxH resizes the frames"""
+
+    def __init__(self, arg):
+        try:
+            self.size = tuple(int(d) for d in arg.split("x"))
+        except ValueError:
+            self.size = ()
+        if len(self.size) != 2 or min(self.size) <= 0:
+            raise ValueError("Invalid resize stage argument: {}".format(arg))
+
+    def __call__(self, frame, meta):
+        import cv2
+        return cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+
+
+@_stage("gray")
+class Grayscale(object):
+
+    """gray converts colour frames to grayscale"""
+
+    def __init__(self, arg=""):
+        pass
+
+    def __call__(self, frame, meta):
+        import cv2
+        if frame.ndim == 2:
+            return frame
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+@_stage("edges")
+class Edges(object):
+
+    """edges[:low,high] runs a Canny edge detector"""
+
+    def __init__(self, arg=""):
+        low, _, high = (arg or "100,200").partition(",")
+        self.thresholds = float(low), float(high or 2 * float(low))
+
+    def __call__(self, frame, meta):
+        import cv2
+        return cv2.Canny(frame, *self.thresholds)
+
+
+@_stage("overlay")
+class Overlay(object):
+
+    """overlay[:text] draws the car's ID and the frame number, or <text> onto the frames"""
+
+    def __init__(self, arg=""):
+        self.text = arg
+
+    def __call__(self, frame, meta):
+        import cv2
+        if not frame.flags.writeable:
+            frame = frame.copy()
+        text = self.text or "{ID} #{n}".format(**meta)
+        cv2.putText(frame, text, (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 255, 2)
+        return frame
+
+
+def parse_stages(*specs):
+    """
+    Builds the stages of specs like "resize:320x240", "gray", separated
+    by whitespace. Raises ValueError on unknown stages or invalid arguments.
+    """
+    stages = []
+    for token in " ".join(specs).split():
+        name, _, arg = token.partition(":")
+        if name not in _stages:
+            raise ValueError("Unknown pipeline stage: {} (available: {})"
+                             .format(name, ", ".join(sorted(_stages))))
+        stages.append((name, _stages[name](arg)))
+    return stages
+
+
+class StageError(Exception):
+    """A stage raised an exception on a frame, the message names the stage and the frame"""
+
+
+# Shared memory blocks attached by a worker process, by name
+_attached = OrderedDict()
+
+# Names of the blocks unlinked by finished map() calls (in the pipeline's process),
+# sent along with every task, so the workers detach from them
+_released = deque(maxlen=64)
+
+
+def _block(name):
+    shm = _attached.get(name)
+    if shm is None:
+        # Pool workers share the resource tracker of the pipeline's process
+        shm = _attached[name] = attach_shared_memory(name, shared_tracker=True)
+        while len(_attached) > 16:
+            _close(_attached.popitem(last=False)[1])
+    return shm
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass  # A result still references the block, it is closed when released
+
+
+def _detach(names):
+    """Runs in a worker process: closes the worker's handles of the blocks in <names>"""
+    for name in names:
+        shm = _attached.pop(name, None)
+        if shm is not None:
+            _close(shm)
+
+
+def _process(name, slot, slot_size, shape, dtype, stages, meta, released=()):
+    """
+    Runs in a worker process: reads the frame from the input area of the slot,
+    runs the stages and writes the result to the output area of the slot.
+    Returns ((shape, dtype), timings) or (frame, timings) if the result
+    doesn't fit into the output area. Raises StageError if a stage fails.
+    :param released: names of unlinked blocks, the worker detaches from them first
+    """
+    _detach(released)
+    buf = _block(name).buf
+    offset = 2 * slot * slot_size
+    frame = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+    timings = []
+    for stage_name, stage in stages:
+        start = time.time()
+        try:
+            frame = stage(frame, meta)
+        except Exception as E:
+            raise StageError("stage {} failed: {}: {}".format(stage_name, E.__class__.__name__, E))
+        timings.append((stage_name, time.time() - start))
+    if frame.nbytes > slot_size:
+        return frame, timings
+    result = frame.shape, frame.dtype.str
+    target = np.ndarray(frame.shape, dtype=frame.dtype, buffer=buf, offset=offset + slot_size)
+    np.copyto(target, frame)
+    return result, timings
+
+
+class Pipeline(object):
+
+    """
+    Processing pipeline of one car's frames. map() runs the stages
+    on a stream of frames in the shared process pool, with up to
+    <depth> frames in flight, and yields the results in order.
+    """
+
+    _executor = None
+    _executor_lock = thr.Lock()
+
+    def __init__(self, ID, frameshape, stages, depth=PIPELINE_DEPTH):
+        """
+        :param ID: ID of the car
+        :param frameshape: the car's full frame shape, sets the size of the handoff slots
+        :param stages: list of (name, stage) pairs, see parse_stages()
+        :param depth: maximal number of frames in flight, 0 is one more than the workers
+        """
+        if shared_memory is None:
+            raise RuntimeError("The processing pipeline needs Python 3.8+!")
+        self.ID = ID
+        self.stages = stages
+        self.depth = depth or self.workers() + 1
+        self.slot_size = int(np.prod(frameshape)) * np.dtype(DTYPE).itemsize
+        # Every slot has an input and an output area, one more slot is held by the consumer
+        self.slots = self.depth + 1
+        self.timing = LatencyTracker()
+        self.inflight = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_error = None
+        self.closed = False
+
+    @classmethod
+    def parse(cls, ID, frameshape, *specs):
+        """Pipeline of the stages in <specs>, eg. Pipeline.parse(ID, shape, "resize:320x240", "gray")"""
+        return cls(ID, frameshape, parse_stages(*specs))
+
+    @property
+    def spec(self):
+        return " ".join(name for name, stage in self.stages)
+
+    @staticmethod
+    def workers():
+        return PIPELINE_WORKERS or os.cpu_count() or 1
+
+    @classmethod
+    def executor(cls):
+        """The process pool shared by every pipeline, started on first use"""
+        from concurrent.futures import ProcessPoolExecutor
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(max_workers=cls.workers())
+            return cls._executor
+
+    @classmethod
+    def shutdown(cls):
+        """Stops the worker processes"""
+        with cls._executor_lock:
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=True)
+                cls._executor = None
+
+    def map(self, frames):
+        """
+        Generator of the processed frames of <frames>, in order. The yielded frames
+        are views of the shared memory, valid until the next one is requested.
+        Frames, which failed in a stage, are skipped, they are counted in failed
+        and the reason of the last one is kept in last_error. Every call has a handoff
+        block of its own, so a pipeline may be used by several consumers.
+        """
+        executor = self.executor()
+        shm = shared_memory.SharedMemory(create=True, size=2 * self.slot_size * self.slots)
+        pending = deque()  # (slot, frame number, submission time, future)
+        run = self._run(executor, shm, iter(frames), pending)
+        try:
+            for frame in run:
+                yield frame
+        finally:
+            run.close()
+            for slot, n, submitted, future in pending:
+                future.cancel()
+            self.inflight = 0
+            _close(shm)
+            shm.unlink()
+            self._release(executor, shm.name)
+
+    def _release(self, executor, name):
+        """
+        Makes the workers detach from the unlinked block <name>. The name goes along
+        with the following tasks of every pipeline, and a detach task is sent to the
+        idle workers, so they don't keep the dead mappings until their next frame.
+        """
+        _released.append(name)
+        try:
+            for _ in range(self.workers()):
+                executor.submit(_detach, (name,))
+        except RuntimeError:
+            pass  # The pool is shut down, its workers are gone
+
+    def _skip(self, n, reason):
+        self.failed += 1
+        self.last_error = "frame #{}: {}".format(n, reason)
+        print("PIPELINE {}: skipped {}".format(self.ID, self.last_error))
+
+    def _run(self, executor, shm, source, pending):
+        free = deque(range(self.slots))
+        held = None
+        n = 0
+        exhausted = False
+        while not self.closed:
+            while not exhausted and len(pending) < self.depth:
+                try:
+                    frame = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                number, n = n, n + 1
+                if frame.nbytes > self.slot_size:
+                    self._skip(number, "larger than the car's frame shape {}".format(frame.shape))
+                    continue
+                slot = free.popleft()
+                frame = np.ascontiguousarray(frame)
+                handoff = np.ndarray(frame.shape, frame.dtype, buffer=shm.buf,
+                                     offset=2 * slot * self.slot_size)
+                np.copyto(handoff, frame)
+                del handoff
+                future = executor.submit(_process, shm.name, slot, self.slot_size,
+                                         frame.shape, frame.dtype.str, self.stages,
+                                         {"ID": self.ID, "n": number}, tuple(_released))
+                pending.append((slot, number, time.time(), future))
+            self.inflight = len(pending)
+            if not pending:
+                break
+            slot, number, submitted, future = pending.popleft()
+            try:
+                result, timings = future.result()
+            except StageError as E:
+                self._skip(number, E)
+                free.append(slot)
+                continue
+            except Exception as E:
+                self._skip(number, "processing failed: {}: {}".format(E.__class__.__name__, E))
+                free.append(slot)
+                continue
+            # The previously yielded frame is released now
+            if held is not None:
+                free.append(held)
+            held = slot
+            for name, seconds in timings:
+                self.timing.add(name, seconds)
+            self.timing.add("total", time.time() - submitted)
+            self.processed += 1
+            if isinstance(result, np.ndarray):
+                yield result
+            else:
+                shape, dtype = result
+                yield np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                                 offset=(2 * slot + 1) * self.slot_size)
+
+    def stats(self):
+        """Timing percentiles of the stages (and of the whole pipeline as total) and the counters"""
+        return {
+            "stages": OrderedDict((name, self.timing.report(name))
+                                  for name in [name for name, stage in self.stages] + ["total"]),
+            "inflight": self.inflight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "last_error": self.last_error
+        }
+
+    def close(self):
+        """Stops the running map() calls"""
+        self.closed = True
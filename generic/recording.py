@@ -0,0 +1,473 @@
+"""
+Recordings of the cars' streams.
+
+A recording is a directory with a recording.json metadata file and
+numbered segments. Every segment is a pair of files:
+- NNNNN.seg holds the packets (FrameHeader + payload) back to back,
+  exactly as they travel on the data channel,
+- NNNNN.idx is the per-frame index, an array of INDEX_DTYPE records:
+  sequence number, capture timestamp, offset and length of the packet
+  in the segment and the keyframe flag.
+A new segment is started when the next packet would make the current
+one larger than the segment size. The index is always written after
+the packets it points to, so an interrupted recording stays readable.
+
+Recordings are played back through memory maps of the segments, see
+RecordingReader and RecordingCapture.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import mmap
+import json
+import time
+import threading as thr
+from collections import deque
+
+import numpy as np
+
+from .codec import FrameDecoder, RawCodec
+from .const import (
+    FPS, RECORD_DIR, RECORD_MODE, RECORD_SEGMENT_SIZE, RECORD_BUFFER, RECORD_FLUSH_INTERVAL
+)
+from .stream import FLAG_KEYFRAME, FrameHeader
+
+INDEX_DTYPE = np.dtype([("seq", "<u8"), ("timestamp", "<f8"), ("offset", "<u8"),
+                        ("length", "<u4"), ("keyframe", "u1")])
+META_FILE = "recording.json"
+
+
+def segment_paths(directory, number):
+    """Paths of the packet and index files of segment <number>"""
+    base = os.path.join(directory, "{:05d}".format(number))
+    return base + ".seg", base + ".idx"
+
+
+def recording_path(ID, directory=RECORD_DIR):
+    """Directory of a new recording of car <ID>: {directory}/{ID}-{date}-{time}"""
+    return os.path.join(directory, "{}-{}".format(ID, time.strftime("%Y%m%d-%H%M%S")))
+
+
+class StreamRecorder(object):
+
+    """
+    Records the stream of a car. It is attached to the car's StreamHub as
+    a subscriber: put() only queues the packets, they are written in bulk
+    by the shared RecordingWriter thread, so recording never blocks the
+    reception of the stream. If the writer can't keep up and more than
+    <buffer_size> bytes are queued, packets are dropped.
+
+    mode="encoded" stores the packets as received, mode="raw" stores
+    the decoded frames (decoded in the writer thread).
+    """
+
+    MODES = ("encoded", "raw")
+
+    def __init__(self, hub, directory, mode=RECORD_MODE, segment_size=RECORD_SEGMENT_SIZE,
+                 buffer_size=RECORD_BUFFER):
+        """
+        :param hub: StreamHub of the recorded car
+        :param directory: directory of the recording, it must not exist yet
+        :param mode: "encoded" or "raw"
+        :param segment_size: maximal size of a segment file in bytes
+        :param buffer_size: maximal number of bytes queued for writing
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown recording mode: {}".format(mode))
+        self.hub = hub
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.mode = mode
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.frames = 0
+        self.written = 0
+        self.dropped = 0
+        self.segments = 0
+        self.closed = False
+        self._queue = deque()
+        self._queued = 0
+        self._lock = thr.Lock()
+        self._decoder = FrameDecoder() if mode == "raw" else None
+        self._segment = None
+        self._index = None
+        self._offset = 0
+        os.makedirs(directory)
+        self._write_meta(hub.interface)
+        self.writer = RecordingWriter.shared()
+        self.writer.add(self)
+
+    def _write_meta(self, carint):
+        meta = {"ID": carint.ID, "frameshape": list(carint.frameshape), "mode": self.mode,
+                "codec": carint.codec if self.mode == "encoded" else RawCodec.name,
+                "segment_size": self.segment_size, "created": time.time()}
+        with open(os.path.join(self.directory, META_FILE), "w") as handle:
+            json.dump(meta, handle, indent=1)
+
+    def put(self, item):
+        """Queues a (header, payload) packet. Never blocks."""
+        payload = item[1]
+        with self._lock:
+            if self.closed:
+                return
+            if self._queued + len(payload) > self.buffer_size:
+                self.dropped += 1
+                return
+            self._queue.append(item)
+            self._queued += len(payload)
+
+    def close(self):
+        """Stops the recording, the queued packets are still written"""
+        if self.closed:
+            return
+        with self._lock:
+            self.closed = True
+        self.hub.unsubscribe(self)
+        self.writer.wakeup()
+
+    def flush(self):
+        """
+        Writes the queued packets, called by the RecordingWriter thread.
+        Returns True if the recording is finished.
+        """
+        with self._lock:
+            items, self._queue = self._queue, deque()
+            self._queued = 0
+            closed = self.closed
+        chunks, records = [], []
+        for header, payload in items:
+            if self._decoder is not None:
+                header, payload = self._decoded(header, payload)
+                if header is None:
+                    continue
+            length = FrameHeader.size + len(payload)
+            if self._segment is None or (self._offset and self._offset + length > self.segment_size):
+                self._write(chunks, records)
+                chunks, records = [], []
+                self._next_segment()
+            chunks.extend((header.pack(), payload))
+            records.append((header.seq, header.timestamp, self._offset, length, header.keyframe))
+            self._offset += length
+        self._write(chunks, records)
+        if closed:
+            self.abort()
+        return closed
+
+    def _decoded(self, header, payload):
+        """Raw packet of a decoded frame"""
+        frame = self._decoder.decode(header, payload)
+        if frame is None:
+            return None, None
+        # A copy: decoders may reuse the frame's buffer (eg. delta) before it is written
+        payload = frame.tobytes()
+        header = FrameHeader(header.seq, header.timestamp, frame.shape, frame.dtype,
+                             codec=RawCodec.ID, length=len(payload), flags=FLAG_KEYFRAME)
+        return header, payload
+
+    def _write(self, chunks, records):
+        if not records:
+            return
+        self._segment.writelines(chunks)
+        self._segment.flush()
+        self._index.write(np.array(records, dtype=INDEX_DTYPE).tobytes())
+        self._index.flush()
+        self.frames += len(records)
+        self.written += sum(r[3] for r in records)
+
+    def _next_segment(self):
+        self._close_files()
+        segpath, idxpath = segment_paths(self.directory, self.segments)
+        self._segment = open(segpath, "wb", buffering=1 << 20)
+        self._index = open(idxpath, "wb")
+        self.segments += 1
+        self._offset = 0
+
+    def _close_files(self):
+        for handle in (self._segment, self._index):
+            if handle is not None:
+                handle.close()
+        self._segment = self._index = None
+
+    def abort(self):
+        """Stops the recording immediately, the queued packets are discarded"""
+        with self._lock:
+            self.closed = True
+            self._queue.clear()
+            self._queued = 0
+        self.hub.unsubscribe(self)
+        self._close_files()
+
+
+class RecordingWriter(thr.Thread):
+
+    """
+    Writes the queued packets of every StreamRecorder of the process
+    in a single thread, in bulk, every <interval> seconds.
+    """
+
+    _shared = None
+    _shared_lock = thr.Lock()
+
+    def __init__(self, interval=RECORD_FLUSH_INTERVAL, name="RecordingWriter"):
+        thr.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.interval = interval
+        self.recorders = []
+        self.running = False
+        self._cond = thr.Condition()
+
+    @classmethod
+    def shared(cls, create=True):
+        """The process-wide writer, started on first use. None if not <create> and not started yet."""
+        with cls._shared_lock:
+            if not create:
+                return cls._shared
+            if cls._shared is None or not cls._shared.is_alive():
+                cls._shared = cls()
+                cls._shared.start()
+            return cls._shared
+
+    def add(self, recorder):
+        with self._cond:
+            self.recorders.append(recorder)
+
+    def wakeup(self):
+        """Makes the writer flush right away, eg. to finish a closed recording"""
+        with self._cond:
+            self._cond.notify()
+
+    def stats(self):
+        """Counters of the running recordings"""
+        return [{"name": rec.name, "mode": rec.mode, "frames": rec.frames, "written": rec.written,
+                 "segments": rec.segments, "dropped": rec.dropped} for rec in list(self.recorders)]
+
+    def run(self):
+        print("RECORDING_WRITER: online")
+        self.running = True
+        while self.running:
+            with self._cond:
+                self._cond.wait(self.interval)
+                recorders = list(self.recorders)
+            for recorder in recorders:
+                try:
+                    finished = recorder.flush()
+                except (IOError, OSError) as E:
+                    print("RECORDING_WRITER: writing {} failed: {}".format(recorder.name, E))
+                    recorder.abort()
+                    finished = True
+                if finished:
+                    with self._cond:
+                        self.recorders.remove(recorder)
+                    print("RECORDING_WRITER: finished {}, {} frames in {} segments"
+                          .format(recorder.name, recorder.frames, recorder.segments))
+        print("RECORDING_WRITER: Exiting...")
+
+    def teardown(self, sleep=0):
+        """Finishes every recording and stops the thread"""
+        for recorder in list(self.recorders):
+            recorder.close()
+        while self.recorders and self.is_alive():
+            self.wakeup()
+            time.sleep(0.05)
+        self.running = False
+        self.wakeup()
+        time.sleep(sleep)
+
+
+class RecordingReader(object):
+
+    """
+    Reads a recording through read-only memory maps of its segments.
+    The per-frame indices of the segments are concatenated, so frames are
+    addressed by their position in the recording and seek() finds the
+    position of a timestamp with a binary search.
+    Packet payloads are memoryviews of the maps, frames of raw recordings
+    are decoded without copying (read-only numpy views of the maps).
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory of the recording
+        """
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as handle:
+            self.meta = json.load(handle)
+        self._maps = []
+        indices, segments = [], []
+        number = 0
+        while 1:
+            segpath, idxpath = segment_paths(directory, number)
+            if not (os.path.exists(segpath) and os.path.exists(idxpath)):
+                break
+            index = self._read_index(idxpath, os.path.getsize(segpath))
+            with open(segpath, "rb") as handle:
+                self._maps.append(mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                                  if len(index) else None)
+            indices.append(index)
+            segments.append(np.full(len(index), number, dtype=np.uint32))
+            number += 1
+        self.index = np.concatenate(indices) if indices else np.zeros(0, dtype=INDEX_DTYPE)
+        self.segment = np.concatenate(segments) if segments else np.zeros(0, dtype=np.uint32)
+        self._views = [None if mm is None else memoryview(mm) for mm in self._maps]
+        # Binary search needs ascending keys, capture timestamps are not guaranteed to be
+        self._keys = np.maximum.accumulate(self.index["timestamp"]) if len(self) else self.index["timestamp"]
+        self._keyframes = np.flatnonzero(self.index["keyframe"])
+
+    @staticmethod
+    def _read_index(path, segsize):
+        """Index of a segment without the records of packets, which didn't make it to the disk"""
+        with open(path, "rb") as handle:
+            data = handle.read()
+        data = data[:len(data) - len(data) % INDEX_DTYPE.itemsize]
+        index = np.frombuffer(data, dtype=INDEX_DTYPE)
+        return index[index["offset"] + index["length"] <= segsize]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def start(self):
+        """Capture timestamp of the first frame"""
+        return float(self._keys[0]) if len(self) else 0.
+
+    @property
+    def duration(self):
+        """Seconds between the first and the last frame"""
+        return float(self._keys[-1]) - self.start if len(self) else 0.
+
+    def seek(self, timestamp):
+        """Position of the first frame captured at or after <timestamp> (a capture timestamp)"""
+        return min(int(np.searchsorted(self._keys, timestamp, side="left")), max(len(self) - 1, 0))
+
+    def position_at(self, timestamp):
+        """Position of the last frame captured at or before <timestamp>, -1 if none"""
+        return int(np.searchsorted(self._keys, timestamp, side="right")) - 1
+
+    def keyframe_before(self, pos):
+        """Position of the last keyframe at or before <pos>, decoding has to start there"""
+        i = int(np.searchsorted(self._keyframes, pos, side="right")) - 1
+        return int(self._keyframes[i]) if i >= 0 else pos
+
+    def packet(self, pos):
+        """The (header, payload) packet at position <pos>, payload is a view of the map"""
+        view = self._views[self.segment[pos]]
+        record = self.index[pos]
+        offset, length = int(record["offset"]), int(record["length"])
+        header = FrameHeader.unpack(view[offset:offset + FrameHeader.size])
+        return header, view[offset + FrameHeader.size:offset + length]
+
+    def packets(self, start=0, stop=None):
+        """Generator of the packets between positions <start> and <stop>"""
+        for pos in range(start, len(self) if stop is None else stop):
+            yield self.packet(pos)
+
+    def framestream(self, start=0., speed=1., loop=False):
+        """
+        Generator of the decoded frames, a drop-in replacement of
+        CarInterface.framestream().
+
+        :param start: seconds from the beginning of the recording to start at
+        :param speed: replay speed, 1 keeps the recorded timing, 2 is twice as fast,
+         0 yields the frames as fast as they are decoded
+        :param loop: start over at the end of the recording
+        """
+        if not len(self):
+            return
+        pos = self.seek(self.start + start)
+        while 1:
+            decoder = FrameDecoder()
+            # Delta coded frames can only be decoded from the preceding keyframe
+            for header, payload in self.packets(self.keyframe_before(pos), pos):
+                decoder.decode(header, payload)
+            clock0, timestamp0 = time.time(), self.index["timestamp"][pos]
+            for header, payload in self.packets(pos):
+                if speed:
+                    delay = (header.timestamp - timestamp0) / speed - (time.time() - clock0)
+                    if delay > 0:
+                        time.sleep(delay)
+                frame = decoder.decode(header, payload)
+                if frame is not None:
+                    yield frame
+            if not loop:
+                break
+            pos = 0
+
+    def close(self):
+        """Closes the maps. Maps still referenced by frames are closed by the garbage collector."""
+        self._views = []
+        for mm in self._maps:
+            if mm is None:
+                continue
+            try:
+                mm.close()
+            except BufferError:
+                pass
+        self._maps = []
+
+
+class RecordingCapture(object):
+
+    """
+    Mocks the interface of cv2.VideoCapture, replays a recording.
+    Can be used as the capture device of a TCPStreamer, see
+    car.component.CaptureDevice.replay().
+
+    With speed > 0, read() returns the frame due at the replay clock, so the
+    recorded timeline is kept whatever rate the device is read at. With
+    speed=0, read() returns the frames one after another.
+    """
+
+    def __init__(self, directory, speed=1., loop=True):
+        """
+        :param directory: directory of the recording
+        :param speed: replay speed, 1 keeps the recorded timing
+        :param loop: start over at the end of the recording, read() fails at the end otherwise
+        """
+        self.reader = RecordingReader(directory)
+        self.speed = speed
+        self.loop = loop
+        self._decoder = FrameDecoder()
+        self._pos = -1
+        self._frame = None
+        self._clock0 = None
+
+    def read(self):
+        if not len(self.reader):
+            return False, None
+        if self._clock0 is None:
+            self._clock0 = time.time()
+        if self.speed:
+            elapsed = (time.time() - self._clock0) * self.speed
+            target = max(self.reader.position_at(self.reader.start + elapsed), 0)
+            if elapsed > self.reader.duration + 1. / FPS:
+                target = len(self.reader)
+        else:
+            target = self._pos + 1
+        if target >= len(self.reader):
+            if not self.loop:
+                return False, None
+            self._clock0, self._pos, target = time.time(), -1, 0
+            self._decoder = FrameDecoder()
+        if target > self._pos:
+            self._frame = self._advance(target)
+        return self._frame is not None, self._frame
+
+    def _advance(self, target):
+        """
+        Decodes up to position <target>, skipping to the last keyframe before it.
+        The returned frame is a copy with stateful codecs, the streamer may still
+        be encoding it when the decoder reconstructs the next one.
+        """
+        start = max(self._pos + 1, self.reader.keyframe_before(target))
+        last = None
+        for packet in self.reader.packets(start, target + 1):
+            if last is not None:
+                self._decoder.decode(*last)
+            last = packet
+        self._pos = target
+        return None if last is None else self._decoder.decode(*last, copy=True)
+
+    def release(self):
+        self._frame = None
+        self.reader.close()
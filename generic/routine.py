@@ -5,7 +5,8 @@ import socket
 import numpy as np
 
 from .const import (
-    DTYPE, STREAM_SERVER_PORT, MESSAGE_SERVER_PORT, RC_SERVER_PORT, CAR_PROBE_PORT
+    DTYPE, STREAM_SERVER_PORT, MESSAGE_SERVER_PORT, RC_SERVER_PORT, CAR_PROBE_PORT,
+    LISTEN_BACKLOG, SOCKET_TUNING
 )
 
 
@@ -24,18 +25,63 @@ def my_ip():
     return address
 
 
-def srvsock(ip, channel, timeout=None):
+def parse_options(parts):
+    """
+    Parses handshake options of the form key=value into a dictionary.
+    Parts without an equal sign are stored with an empty string value.
+    """
+    options = {}
+    for part in parts:
+        if not part:
+            continue
+        key, _, value = part.partition("=")
+        options[key] = value
+    return options
+
+
+def format_options(**options):
+    """Builds the key=value;key=value string of handshake options"""
+    return ";".join("{}={}".format(k, v) for k, v in sorted(options.items()))
+
+
+def tune_socket(sock, channel):
+    """
+    Sets the TCP options of a connected socket by the type of its channel,
+    see SOCKET_TUNING. Returns whether the writer should cork the socket
+    around its packets (see stream.send_packet). Where TCP_CORK is not
+    available, corked channels get TCP_NODELAY instead.
+    :param channel: "messaging", "stream" or "rc"
+    """
+    cork = SOCKET_TUNING.get(channel) == "cork" and hasattr(socket, "TCP_CORK")
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 if cork else 1)
+    except socket.error as E:
+        print("TUNE_SOCKET: couldn't set the options of a {} socket: {}".format(channel, E))
+        return False
+    return cork
+
+
+def srvsock(ip, channel, timeout=None, port=None, reuse_port=False, backlog=LISTEN_BACKLOG):
+    """
+    Creates a listening TCP socket for a channel.
+    :param port: overrides the channel's port, 0 binds an ephemeral port
+    :param reuse_port: sets SO_REUSEPORT, so several processes can listen on the port
+    :param backlog: number of pending connections queued by the socket
+    """
     assert channel[0] in "dsmrp"
-    port = {
-        "d": STREAM_SERVER_PORT,
-        "s": STREAM_SERVER_PORT,
-        "m": MESSAGE_SERVER_PORT,
-        "r": RC_SERVER_PORT,
-        "p": CAR_PROBE_PORT
-    }[channel[0]]
+    if port is None:
+        port = {
+            "d": STREAM_SERVER_PORT,
+            "s": STREAM_SERVER_PORT,
+            "m": MESSAGE_SERVER_PORT,
+            "r": RC_SERVER_PORT,
+            "p": CAR_PROBE_PORT
+        }[channel[0]]
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     if timeout is not None:
         s.settimeout(timeout)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.bind((ip, port))
-    s.listen(1)
+    s.listen(backlog)
     return s
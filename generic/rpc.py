@@ -0,0 +1,201 @@
+"""
+Request/response calls over a Messaging connection.
+
+A call is sent as a message of its own and answered by the remote
+entity's RPCEndpoint with the ID of the call:
+
+    rpc {id} {method} {JSON list of the arguments}
+    rpc-re {id} ok {JSON result}
+    rpc-re {id} error {message}
+
+Calls are matched to their replies by their IDs, not by their order, so
+any number of them can be in flight on one connection, and a call is
+completed in the receiving thread as soon as its reply arrives. The
+messages are handled through Messaging.subscribe(), the plain messages
+and commands of the channel are not affected.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import json
+import threading as thr
+from itertools import count
+
+from .const import RPC_TIMEOUT
+
+
+class RPCError(Exception):
+    """The remote method raised or the call can't be made"""
+
+
+class RPCTimeout(RPCError):
+    """No reply arrived in time"""
+
+
+class RPCFuture(object):
+
+    """The pending result of a call, completed by the endpoint"""
+
+    def __init__(self, method):
+        self.method = method
+        self.ID = None
+        self._done = thr.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = thr.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits <timeout> seconds (None: forever) for the reply, raises RPCTimeout if none arrives"""
+        if not self._done.wait(timeout):
+            raise RPCTimeout("no reply to [{}] in {} seconds".format(self.method, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except RPCError as E:
+            return E
+        return None
+
+    def add_done_callback(self, callback):
+        """callback(future) is called when the call is completed, right away if it already is"""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result=None, exception=None):
+        with self._lock:
+            if self.done():
+                return False
+            self._result, self._exception = result, exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as E:
+                print("RPC: callback of [{}] raised: {}".format(self.method, E))
+        return True
+
+
+class RPCEndpoint(object):
+
+    """
+    Makes calls to the remote entity and serves the calls of the remote
+    entity on one Messaging connection. Served methods are run in the
+    receiving thread (in the event loop with an AsyncMessaging), so they
+    should be quick, like the callbacks of Messaging.subscribe().
+    """
+
+    def __init__(self, messenger, **methods):
+        """
+        :param messenger: Messaging or AsyncMessaging object
+        :param methods: the served methods by name, see serve()
+        """
+        self.messenger = messenger
+        self.methods = dict(methods)
+        self.pending = {}  # call ID: RPCFuture
+        self._ids = count(1)
+        self._lock = thr.Lock()
+        messenger.subscribe("rpc", self._on_request)
+        messenger.subscribe("rpc-re", self._on_reply)
+
+    def serve(self, name, method):
+        """Serves method(*args) as <name>, its return value has to be JSON serializable"""
+        self.methods[name] = method
+
+    def call_async(self, method, *args, **kw):
+        """
+        Calls a remote method without waiting for the reply.
+
+        :param method: name of the remote method
+        :param args: JSON serializable arguments
+        :param callback: optional, callback(future) is called with the completed future
+        :param timeout: optional, the call fails with RPCTimeout after <timeout> seconds
+        :return: RPCFuture of the result
+        """
+        callback, timeout = kw.get("callback"), kw.get("timeout")
+        future = RPCFuture(method)
+        if callback is not None:
+            future.add_done_callback(callback)
+        if not self.messenger.running:
+            future._complete(exception=RPCError("connection closed"))
+            return future
+        with self._lock:
+            future.ID = ID = next(self._ids)
+            self.pending[ID] = future
+        if timeout is not None:
+            timer = thr.Timer(timeout, self._expire, (ID, timeout))
+            timer.daemon = True
+            timer.start()
+            future.add_done_callback(lambda f: timer.cancel())
+        self.messenger.send("rpc {} {} {}".format(ID, method, json.dumps(args)).encode())
+        return future
+
+    def call(self, method, *args, **kw):
+        """
+        Calls a remote method and returns its result as soon as the reply arrives.
+        Raises RPCError if the remote method raised, RPCTimeout if no reply
+        arrived in <timeout> seconds (keyword argument, RPC_TIMEOUT by default).
+        """
+        timeout = kw.get("timeout", RPC_TIMEOUT)
+        future = self.call_async(method, *args)
+        try:
+            return future.result(timeout)
+        except RPCTimeout:
+            self._expire(future.ID, timeout)
+            raise
+
+    def _expire(self, ID, timeout):
+        with self._lock:
+            future = self.pending.pop(ID, None)
+        if future is not None:
+            future._complete(exception=RPCTimeout(
+                "no reply to [{}] in {} seconds".format(future.method, timeout)))
+
+    def _on_reply(self, message):
+        parts = message.split(" ", 3)
+        try:
+            ID, status, payload = int(parts[1]), parts[2], parts[3]
+        except (IndexError, ValueError):
+            print("RPC: invalid reply:", message)
+            return
+        with self._lock:
+            future = self.pending.pop(ID, None)
+        if future is None:
+            return  # expired
+        if status == "ok":
+            future._complete(result=json.loads(payload))
+        else:
+            future._complete(exception=RPCError(payload))
+
+    def _on_request(self, message):
+        parts = message.split(" ", 3)
+        if len(parts) < 3:
+            print("RPC: invalid request:", message)
+            return
+        ID, name = parts[1], parts[2]
+        method = self.methods.get(name)
+        try:
+            if method is None:
+                raise RPCError("unknown method: {}".format(name))
+            args = json.loads(parts[3]) if len(parts) > 3 else []
+            reply = "rpc-re {} ok {}".format(ID, json.dumps(method(*args), default=str))
+        except Exception as E:
+            reply = "rpc-re {} error {}: {}".format(ID, E.__class__.__name__, E)
+        self.messenger.send(reply.encode())
+
+    def close(self):
+        """Fails the calls in flight"""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future._complete(exception=RPCError("connection closed"))
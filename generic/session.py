@@ -0,0 +1,152 @@
+"""
+Session tokens of the handshakes.
+The listener sends a random token in its HELLO response on the messaging
+channel. The remote entity sends it back as the first bytes of its data and
+RC connections, so these connections are matched to their session, even if
+several handshakes are in progress at the same time.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import time
+import socket
+import binascii
+import threading as thr
+
+from .const import HANDSHAKE_TIMEOUT
+
+TOKEN_MAGIC = b"FPRT"
+TOKEN_BYTES = 8
+PREAMBLE_SIZE = len(TOKEN_MAGIC) + 2 * TOKEN_BYTES
+
+
+def new_token():
+    """Returns a random session token as a hex string"""
+    return binascii.hexlify(os.urandom(TOKEN_BYTES)).decode()
+
+
+def token_preamble(token):
+    """Bytes to send first on the data and RC connections of a session"""
+    return TOKEN_MAGIC + token.encode()
+
+
+def parse_preamble(data):
+    """Returns the token of a preamble or None, if <data> is not a valid preamble"""
+    if len(data) != PREAMBLE_SIZE or not data.startswith(TOKEN_MAGIC):
+        return None
+    token = data[len(TOKEN_MAGIC):]
+    try:
+        binascii.unhexlify(token)
+    except (TypeError, ValueError):
+        return None
+    return token.decode()
+
+
+def read_token(sock, timeout=HANDSHAKE_TIMEOUT):
+    """Reads the preamble of a connection, returns its token or None"""
+    sock.settimeout(timeout)
+    data = b""
+    try:
+        while len(data) < PREAMBLE_SIZE:
+            chunk = sock.recv(PREAMBLE_SIZE - len(data))
+            if not chunk:
+                return None
+            data += chunk
+    except (socket.timeout, socket.error):
+        return None
+    finally:
+        sock.settimeout(None)
+    return parse_preamble(data)
+
+
+class SessionBroker(object):
+
+    """
+    Accepts the data and RC connections on behalf of the handshakes
+    in progress and hands them out by their session tokens.
+    Every listening socket is served by an acceptor thread, the token
+    of an accepted connection is read in a short-lived thread of its own,
+    so a slow or silent peer doesn't hold up the others.
+    """
+
+    def __init__(self, dlistener, rclistener):
+        """
+        :param dlistener: unconnected server socket awaiting data connections
+        :param rclistener: unconnected server socket awaiting RC connections
+        """
+        self.listeners = {"Data": dlistener, "RC": rclistener}
+        self.running = False
+        self._arrived = {}  # (token, type): (conn, addr, arrival time)
+        self._cond = thr.Condition()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for typ, listener in self.listeners.items():
+            listener.settimeout(1)
+            worker = thr.Thread(target=self._accept, args=(typ, listener),
+                                name="SessionBroker-" + typ)
+            worker.daemon = True
+            worker.start()
+
+    def _accept(self, typ, listener):
+        while self.running:
+            try:
+                conn, addr = listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break  # closed by teardown
+            thr.Thread(target=self._identify, args=(typ, conn, addr),
+                       name="SessionBroker-Token").start()
+
+    def _identify(self, typ, conn, addr):
+        token = read_token(conn)
+        if token is None:
+            print("BROKER: {} connection from {}:{} didn't present a session token!"
+                  .format(typ, *addr))
+            conn.close()
+            return
+        with self._cond:
+            self._expire()
+            self._arrived[(token, typ)] = (conn, addr, time.time())
+            self._cond.notify_all()
+
+    def _expire(self):
+        """Closes the connections nobody claimed in time. Call it holding the lock."""
+        deadline = time.time() - 2 * HANDSHAKE_TIMEOUT
+        for key, (conn, addr, arrived) in list(self._arrived.items()):
+            if arrived < deadline:
+                print("BROKER: dropping unclaimed {} connection from {}:{}"
+                      .format(key[1], *addr))
+                conn.close()
+                del self._arrived[key]
+
+    def claim(self, token, typ, timeout=HANDSHAKE_TIMEOUT):
+        """
+        Waits for the connection of a session.
+        :param token: the session's token
+        :param typ: "Data" or "RC"
+        :return: (conn, addr) of the connection
+        :raise socket.timeout: if the connection didn't arrive in time
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while (token, typ) not in self._arrived:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("no {} connection for the session".format(typ))
+                self._cond.wait(remaining)
+            conn, addr, arrived = self._arrived.pop((token, typ))
+        return conn, addr
+
+    def teardown(self):
+        self.running = False
+        for listener in self.listeners.values():
+            listener.close()
+        with self._cond:
+            for conn, addr, arrived in self._arrived.values():
+                conn.close()
+            self._arrived.clear()
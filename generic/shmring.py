@@ -0,0 +1,181 @@
+"""
+Shared-memory ring of decoded frames for consumers on the same host.
+A CarInterface publishes its frames into the ring, other local processes
+(displays, recorders, analytics) attach to it by name and read the latest
+frame as a numpy view, without copying and without a socket hop.
+
+Needs Python 3.8+ (multiprocessing.shared_memory).
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import time
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # Python < 3.8
+    shared_memory = resource_tracker = None
+
+MAGIC = b"FPRSHM1"
+
+_HEAD = np.dtype([("magic", "S8"), ("slots", "<u4"), ("slot_size", "<u8"), ("latest", "<u8")])
+_META = np.dtype([("begin", "<u8"), ("end", "<u8"), ("timestamp", "<f8"), ("ndim", "<u4"),
+                  ("shape", "<u4", (3,)), ("dtype", "S8"), ("nbytes", "<u8")])
+
+
+def _aligned(n, alignment=64):
+    return -(-n // alignment) * alignment
+
+
+def attach_shared_memory(name, shared_tracker=False):
+    """
+    Opens a shared memory block created by another process. The creator
+    owns the block, this process' resource tracker must not unlink it.
+    :param shared_tracker: this process is a child of the creator and shares
+     its resource tracker (eg. a pool worker), the block must stay registered
+    """
+    if shared_memory is None:
+        raise RuntimeError("Shared memory needs Python 3.8+!")
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if not shared_tracker:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedFrameRing(object):
+
+    """
+    Ring of frame slots in a named shared memory block.
+
+    Every slot is guarded by a pair of sequence counters (a seqlock):
+    the writer sets <begin> before and <end> after writing the slot.
+    A reader's view of a frame is valid as long as valid(seq) is True,
+    ie. for about slots-1 frame periods after it was published.
+    Readers holding frames longer than that have to copy them.
+
+    Use SharedFrameRing.create() in the publishing process and
+    SharedFrameRing.attach() in the consumer processes.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        self.head = np.ndarray((), dtype=_HEAD, buffer=shm.buf)
+        if self.head["magic"] != MAGIC:
+            raise ValueError("{} is not a FIPER frame ring!".format(self.name))
+        self.slots = int(self.head["slots"])
+        self.slot_size = int(self.head["slot_size"])
+        metaoffset = _aligned(_HEAD.itemsize)
+        self.meta = np.ndarray((self.slots,), dtype=_META, buffer=shm.buf, offset=metaoffset)
+        self._dataoffset = _aligned(metaoffset + self.slots * _META.itemsize)
+        self.data = np.ndarray((self.slots, self.slot_size), dtype=np.uint8,
+                               buffer=shm.buf, offset=self._dataoffset)
+
+    @classmethod
+    def create(cls, name, slot_size, slots=4):
+        """
+        Creates a new ring.
+        :param name: name of the shared memory block, eg. fiper-{carID}
+        :param slot_size: maximal size of a frame in bytes
+        :param slots: number of frame slots
+        """
+        if shared_memory is None:
+            raise RuntimeError("Shared memory frame rings need Python 3.8+!")
+        metaoffset = _aligned(_HEAD.itemsize)
+        size = _aligned(metaoffset + slots * _META.itemsize) + slots * slot_size
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        head = np.ndarray((), dtype=_HEAD, buffer=shm.buf)
+        head["slots"], head["slot_size"], head["latest"] = slots, slot_size, 0
+        head["magic"] = MAGIC
+        del head
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attaches to an existing ring, published by another process"""
+        return cls(attach_shared_memory(name), owner=False)
+
+    @property
+    def latest_seq(self):
+        """Sequence number of the latest published frame, 0 if none yet"""
+        return int(self.head["latest"])
+
+    def publish(self, frame, timestamp):
+        """
+        Copies a frame into the next slot. Returns its sequence number
+        or None if the frame doesn't fit into a slot.
+        """
+        if frame.nbytes > self.slot_size or frame.ndim > 3:
+            return None
+        seq = self.latest_seq + 1
+        slot = seq % self.slots
+        meta = self.meta[slot]
+        meta["begin"] = seq
+        target = self.data[slot, :frame.nbytes].view(frame.dtype).reshape(frame.shape)
+        np.copyto(target, frame)
+        meta["timestamp"] = timestamp
+        meta["ndim"] = frame.ndim
+        meta["shape"] = tuple(frame.shape) + (0,) * (3 - frame.ndim)
+        meta["dtype"] = frame.dtype.str.encode()
+        meta["nbytes"] = frame.nbytes
+        meta["end"] = seq
+        self.head["latest"] = seq
+        return seq
+
+    def valid(self, seq):
+        """Whether the slot of frame <seq> still holds that frame"""
+        meta = self.meta[seq % self.slots]
+        return int(meta["begin"]) == seq and int(meta["end"]) == seq
+
+    def read(self, seq):
+        """
+        Returns (timestamp, frame) of frame <seq>, where frame is a view
+        into the shared memory. Returns None if the frame was overwritten.
+        """
+        if not seq or not self.valid(seq):
+            return None
+        meta = self.meta[seq % self.slots]
+        timestamp = float(meta["timestamp"])
+        shape = tuple(int(d) for d in meta["shape"][:int(meta["ndim"])])
+        dtype = np.dtype(meta["dtype"].decode())
+        frame = self.data[seq % self.slots, :int(meta["nbytes"])].view(dtype).reshape(shape)
+        if not self.valid(seq):
+            return None
+        return timestamp, frame
+
+    def latest(self):
+        """Returns (seq, timestamp, frame) of the latest frame or None"""
+        seq = self.latest_seq
+        got = self.read(seq)
+        if got is None:
+            return None
+        return (seq,) + got
+
+    def frames(self, poll=0.002):
+        """
+        Generator of (seq, timestamp, frame) tuples, following the
+        publisher. Frames are skipped if the reader falls behind.
+        """
+        last = self.latest_seq
+        while 1:
+            seq = self.latest_seq
+            if seq == last:
+                time.sleep(poll)
+                continue
+            got = self.read(seq)
+            last = seq
+            if got is not None:
+                yield (seq,) + got
+
+    def close(self):
+        """Detaches from the ring. The publisher also removes it."""
+        del self.head, self.meta, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
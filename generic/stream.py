@@ -0,0 +1,602 @@
+from __future__ import print_function, absolute_import, unicode_literals
+
+import heapq
+import socket
+import struct
+import time
+import threading as thr
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from .const import DTYPE, DATAGRAM_SIZE, JITTER_DELAY, PAYLOAD_LIMIT
+
+FRAME_MAGIC = b"FPRF"
+FRAME_VERSION = 1
+FRAGMENT_MAGIC = b"FPRD"
+
+# Header flags
+FLAG_KEYFRAME = 1
+
+_DTYPE_CODES = {0: np.dtype(np.uint8), 1: np.dtype(np.uint16), 2: np.dtype(np.float32)}
+_DTYPE_IDS = {dt: code for code, dt in _DTYPE_CODES.items()}
+
+# A sequence number this far behind the newest one, or this many frames in a row
+# behind it mean that the sender restarted (its sequence numbers start over)
+RESYNC_GAP = 256
+RESYNC_FRAMES = 3
+
+
+def seq_diff(a, b):
+    """
+    a - b of uint32 sequence numbers in serial number arithmetic (RFC 1982),
+    so sequence numbers stay ordered when they wrap around. In [-2**31, 2**31).
+    """
+    return (a - b + (1 << 31)) % (1 << 32) - (1 << 31)
+
+
+def payload_limit(shape, dtype=DTYPE):
+    """Longest valid payload of a frame in bytes: PAYLOAD_LIMIT times its raw size"""
+    return PAYLOAD_LIMIT * max(1, int(np.prod(shape))) * np.dtype(dtype).itemsize
+
+
+class FrameHeader(object):
+
+    """
+    Binary header, which precedes every frame on the data channel.
+    Layout, in network byte order:
+    magic (4 bytes), version, codec ID, dtype code, flags (1 byte each),
+    sequence number (uint32), capture timestamp (float64, seconds),
+    frame shape Y, X, C (uint16 each, C is 0 for 2D frames),
+    payload length (uint32)
+    """
+
+    layout = struct.Struct("!4sBBBBIdHHHI")
+    size = layout.size
+
+    def __init__(self, seq, timestamp, shape, dtype=DTYPE, codec=0,
+                 length=0, flags=FLAG_KEYFRAME):
+        """
+        :param seq: sequence number of the frame
+        :param timestamp: capture time according to the sender's clock
+        :param shape: shape of the decoded frame, 2D or 3D
+        :param dtype: data type of the decoded frame
+        :param codec: ID of the codec, the payload is encoded with (0 is raw),
+         see generic.codec
+        :param length: length of the payload in bytes
+        :param flags: bitfield, see the FLAG_* constants
+        """
+        self.seq = seq
+        self.timestamp = timestamp
+        self.shape = tuple(int(d) for d in shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.length = length
+        self.flags = flags
+
+    @property
+    def keyframe(self):
+        return bool(self.flags & FLAG_KEYFRAME)
+
+    def pack(self):
+        Y, X = self.shape[:2]
+        C = self.shape[2] if len(self.shape) == 3 else 0
+        return self.layout.pack(
+            FRAME_MAGIC, FRAME_VERSION, self.codec, _DTYPE_IDS[self.dtype],
+            self.flags, self.seq & 0xFFFFFFFF, self.timestamp, Y, X, C, self.length
+        )
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Parses a header from a bytes-like object of FrameHeader.size length.
+        Raises ValueError if the data is not a valid header.
+        """
+        (magic, version, codec, dtypecode, flags, seq,
+         timestamp, Y, X, C, length) = cls.layout.unpack(bytes(data))
+        if magic != FRAME_MAGIC:
+            raise ValueError("Invalid magic: {}".format(magic))
+        if version != FRAME_VERSION:
+            raise ValueError("Unsupported frame header version: {}".format(version))
+        if dtypecode not in _DTYPE_CODES:
+            raise ValueError("Unknown dtype code: {}".format(dtypecode))
+        shape = (Y, X, C) if C else (Y, X)
+        return cls(seq, timestamp, shape, _DTYPE_CODES[dtypecode], codec, length, flags)
+
+    def __repr__(self):
+        return ("FrameHeader(seq={}, timestamp={:.3f}, shape={}, codec={}, length={})"
+                .format(self.seq, self.timestamp, self.shape, self.codec, self.length))
+
+
+def send_packet(sock, header, payload, cork=False):
+    """
+    Sends a header and its payload over a stream socket.
+    Uses a single scatter-gather write where the platform supports it.
+
+    :param header: FrameHeader instance, its length is set here
+    :param payload: bytes-like object, eg. a C-contiguous numpy array
+    :param cork: whether to cork the socket while the packet is written
+     (see routine.tune_socket), so partial writes don't leave in short segments
+    """
+    if cork:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            send_packet(sock, header, payload)
+        finally:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        return
+    payload = memoryview(payload).cast("B")
+    header.length = len(payload)
+    data = header.pack()
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(data)
+        sock.sendall(payload)
+        return
+    sent = sock.sendmsg([data, payload])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+        sock.sendall(payload)
+    else:
+        sock.sendall(payload[sent - len(data):])
+
+
+class FrameRing(object):
+
+    """
+    Bounded, thread-safe ring buffer with latest-frame-wins semantics.
+    Putting into a full ring discards the oldest item, so a slow
+    consumer never blocks the producer, it just misses frames.
+    """
+
+    def __init__(self, capacity=2):
+        self.capacity = capacity
+        self._items = deque()
+        self._cond = thr.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.capacity:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest item in the ring. Blocks until an item is
+        available, the ring is closed or the timeout expires, in the
+        latter two cases None is returned.
+        """
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class _ReceiverBase(object):
+
+    """
+    Groups the common machinery of the receivers:
+    a rotation of reusable buffers and exact reads with recv_into().
+
+    With buffers=N the receiver rotates among N buffers, so the
+    data returned last and the N-1 pieces before it stay intact.
+    A consumer holding on to more than that has to copy.
+    """
+
+    def __init__(self, sock, bufsize, buffers=1):
+        """
+        :param sock: connected stream socket to read from
+        :param bufsize: initial size of the buffers in bytes
+        :param buffers: number of buffers to rotate among
+        """
+        self.sock = sock
+        self._buffers = [bytearray(bufsize) for _ in range(max(1, buffers))]
+        self._views = [memoryview(buf) for buf in self._buffers]
+        self._current = -1
+
+    def _next_buffer(self, size):
+        """
+        Steps the rotation and returns a view of the next
+        buffer, which is grown if it is smaller than size.
+        """
+        self._current = (self._current + 1) % len(self._buffers)
+        if len(self._buffers[self._current]) < size:
+            self._buffers[self._current] = bytearray(size)
+            self._views[self._current] = memoryview(self._buffers[self._current])
+        return self._views[self._current][:size]
+
+    def _fill(self, view):
+        """
+        Reads exactly len(view) bytes into view.
+        Returns False if the connection was closed or reset.
+        """
+        size = len(view)
+        got = 0
+        while got < size:
+            try:
+                n = self.sock.recv_into(view[got:], size - got)
+            except socket.timeout:
+                continue
+            except socket.error as E:
+                print("RECEIVER: connection lost:", E)
+                return False
+            if not n:
+                return False
+            got += n
+        return True
+
+
+class FrameReceiver(_ReceiverBase):
+
+    """
+    Reassembles fixed-size, headerless video frames from a stream socket.
+    The data is read straight into preallocated buffers, which are
+    then wrapped by numpy without copying.
+    """
+
+    def __init__(self, sock, frameshape, dtype=DTYPE, buffers=1):
+        """
+        :param sock: connected stream socket to read from
+        :param frameshape: shape of one frame, eg. (480, 640, 3)
+        :param dtype: data type of the frame elements
+        :param buffers: number of buffers to rotate among
+        """
+        self.frameshape = tuple(int(d) for d in frameshape)
+        self.dtype = np.dtype(dtype)
+        self.framesize = int(np.prod(self.frameshape)) * self.dtype.itemsize
+        super(FrameReceiver, self).__init__(sock, self.framesize, buffers)
+        self._frames = [np.frombuffer(buf, dtype=self.dtype).reshape(self.frameshape)
+                        for buf in self._buffers]
+
+    def receive(self):
+        """
+        Receives the next frame into the next buffer in the rotation.
+        Returns a numpy array (a view of the buffer) or None if the
+        connection was closed.
+        """
+        if not self._fill(self._next_buffer(self.framesize)):
+            return None
+        return self._frames[self._current]
+
+    def __iter__(self):
+        while 1:
+            frame = self.receive()
+            if frame is None:
+                break
+            yield frame
+
+
+class PacketReceiver(_ReceiverBase):
+
+    """
+    Reads header-framed packets from a stream socket.
+    Every payload is preceded by a FrameHeader. If the magic marker
+    is not found where a header is expected, the receiver skips bytes
+    until the next valid header, so a corrupted stream recovers
+    instead of staying misaligned. A header announcing a payload longer
+    than payload_limit() is invalid as well.
+    """
+
+    def __init__(self, sock, frameshape=None, buffers=1, dtype=DTYPE):
+        """
+        :param sock: connected stream socket to read from
+        :param frameshape: expected frame shape, used to presize the buffers
+         and to limit the payload length (the header's own shape is used if None)
+        :param buffers: number of payload buffers to rotate among
+        :param dtype: data type of the frame elements
+        """
+        bufsize = int(np.prod(frameshape)) * np.dtype(dtype).itemsize if frameshape else 0
+        super(PacketReceiver, self).__init__(sock, bufsize, buffers)
+        self.max_length = payload_limit(frameshape, dtype) if frameshape else None
+        self._header = bytearray(FrameHeader.size)
+        self._hview = memoryview(self._header)
+        self.skipped = 0
+
+    def _read_header(self):
+        """
+        Reads the next valid header, resynchronizing on the magic marker
+        if needed. Returns None if the connection was closed.
+        """
+        size = FrameHeader.size
+        hbuf, hview = self._header, self._hview
+        if not self._fill(hview):
+            return None
+        skipped = 0
+        while 1:
+            if hbuf[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+                try:
+                    header = FrameHeader.unpack(hbuf)
+                except ValueError:
+                    header = None
+                if header is not None and self._acceptable(header):
+                    if skipped:
+                        print("PACKET_RECEIVER: resynchronized after skipping {} bytes"
+                              .format(skipped))
+                        self.skipped += skipped
+                    return header
+            shift = hbuf.find(FRAME_MAGIC[:1], 1)
+            if shift < 0:
+                shift = size
+            hbuf[:size-shift] = hbuf[shift:]
+            if not self._fill(hview[size-shift:]):
+                return None
+            skipped += shift
+
+    def _acceptable(self, header):
+        limit = self.max_length or payload_limit(header.shape, header.dtype)
+        return header.length <= limit
+
+    def receive(self):
+        """
+        Receives the next packet. The payload is read into the next
+        buffer in the rotation.
+        Returns a (FrameHeader, memoryview) tuple or None if the connection
+        was closed.
+        """
+        header = self._read_header()
+        if header is None:
+            return None
+        payload = self._next_buffer(header.length)
+        if not self._fill(payload):
+            return None
+        return header, payload
+
+    def __iter__(self):
+        while 1:
+            packet = self.receive()
+            if packet is None:
+                break
+            yield packet
+
+
+class FragmentHeader(object):
+
+    """
+    Header of a datagram carrying one fragment of a packet.
+    Layout, in network byte order:
+    magic (4 bytes), frame ID (uint32), fragment index, fragment count (uint16 each)
+    The concatenated fragments give the FrameHeader and the payload.
+    """
+
+    layout = struct.Struct("!4sIHH")
+    size = layout.size
+
+    @classmethod
+    def pack(cls, frameID, index, count):
+        return cls.layout.pack(FRAGMENT_MAGIC, frameID & 0xFFFFFFFF, index, count)
+
+    @classmethod
+    def unpack(cls, data):
+        """Returns (frameID, index, count). Raises ValueError on invalid data."""
+        magic, frameID, index, count = cls.layout.unpack(bytes(data[:cls.size]))
+        if magic != FRAGMENT_MAGIC or index >= count:
+            raise ValueError("Invalid fragment header!")
+        return frameID, index, count
+
+
+class DatagramSender(object):
+
+    """
+    Splits packets into datagrams of at most DATAGRAM_SIZE bytes,
+    each tagged with a FragmentHeader, and sends them over a
+    connected UDP socket.
+    """
+
+    def __init__(self, sock, datagram_size=DATAGRAM_SIZE):
+        """
+        :param sock: UDP socket, connected to the receiver
+        :param datagram_size: maximal size of a datagram, headers included
+        """
+        self.sock = sock
+        self.chunk = datagram_size - FragmentHeader.size
+
+    def send(self, header, payload):
+        payload = memoryview(payload).cast("B")
+        header.length = len(payload)
+        data = memoryview(header.pack() + payload.tobytes())
+        count = -(-len(data) // self.chunk)
+        if count > 0xFFFF:
+            raise ValueError("Packet too large for fragmentation: {} bytes".format(len(data)))
+        for index in range(count):
+            fragment = data[index*self.chunk:(index+1)*self.chunk]
+            self.sock.sendmsg([FragmentHeader.pack(header.seq, index, count), fragment])
+
+
+class DatagramReassembler(object):
+
+    """
+    Collects the fragments of packets. A packet is completed when all
+    of its fragments arrived. Incomplete packets older than a completed
+    one and fragments of already completed or dropped packets are discarded.
+    A packet more than RESYNC_GAP behind the newest completed one or
+    RESYNC_FRAMES packets in a row behind it mean that the sender
+    restarted, the reassembler starts over.
+    """
+
+    def __init__(self, max_pending=8):
+        """
+        :param max_pending: maximal number of incomplete packets held
+        """
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # frameID -> [received count, fragment list]
+        self._newest_done = None
+        self._stale_IDs = set()  # of the stale packets in a row
+        self.dropped = 0
+
+    def _stale(self, frameID):
+        if self._newest_done is None:
+            return False
+        behind = -seq_diff(frameID, self._newest_done)
+        if behind < 0:
+            self._stale_IDs.clear()
+            return False
+        self._stale_IDs.add(frameID)
+        if behind > RESYNC_GAP or len(self._stale_IDs) > RESYNC_FRAMES:
+            self._newest_done = None
+            self._stale_IDs.clear()
+            self.dropped += len(self._pending)
+            self._pending.clear()
+            return False
+        return True
+
+    def feed(self, datagram):
+        """
+        Processes one datagram. Returns a (FrameHeader, memoryview) tuple
+        if it completed a packet, None otherwise.
+        """
+        try:
+            frameID, index, count = FragmentHeader.unpack(datagram)
+        except (ValueError, struct.error):
+            return None
+        if self._stale(frameID):
+            return None
+        if frameID not in self._pending:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[frameID] = [0, [None] * count]
+        entry = self._pending[frameID]
+        if len(entry[1]) != count or entry[1][index] is not None:
+            return None
+        entry[1][index] = bytes(datagram[FragmentHeader.size:])
+        entry[0] += 1
+        if entry[0] < count:
+            return None
+
+        del self._pending[frameID]
+        for ID in [ID for ID in self._pending if seq_diff(ID, frameID) < 0]:
+            del self._pending[ID]
+            self.dropped += 1
+        self._newest_done = frameID
+        data = memoryview(b"".join(entry[1]))
+        try:
+            header = FrameHeader.unpack(data[:FrameHeader.size])
+        except (ValueError, struct.error):
+            return None
+        return header, data[FrameHeader.size:FrameHeader.size+header.length]
+
+
+class JitterBuffer(object):
+
+    """
+    Small playout buffer, which smooths out the arrival jitter of
+    datagram-transported frames. A frame is released in sequence
+    order, once it spent <delay> seconds in the buffer or when the
+    buffer holds more than <depth> frames. Frames arriving after a
+    later frame has already been released are dropped. Sequence numbers
+    are ordered across their wraparound. A frame more than RESYNC_GAP
+    behind the last released one or RESYNC_FRAMES late frames in a row
+    restart the buffer (the sender restarted).
+    """
+
+    def __init__(self, delay=JITTER_DELAY, depth=3):
+        self.delay = delay
+        self.depth = depth
+        self._heap = []
+        self._last_released = None
+        self._newest = None  # (sequence number, unwrapped sequence number)
+        self._late_run = 0
+        self.late = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _unwrap(self, seq):
+        """The sequence number counted on from the newest one, without the wraparound"""
+        if self._newest is None:
+            self._newest = seq, seq
+            return seq
+        newest, unwrapped = self._newest
+        unwrapped += seq_diff(seq, newest)
+        if unwrapped > self._newest[1]:
+            self._newest = seq, unwrapped
+        return unwrapped
+
+    def push(self, seq, item, now=None):
+        key = self._unwrap(seq)
+        if self._last_released is not None and key <= self._last_released:
+            self._late_run += 1
+            if self._last_released - key <= RESYNC_GAP and self._late_run <= RESYNC_FRAMES:
+                self.late += 1
+                return
+            # The sender restarted, the buffered frames belong to its previous run
+            self._heap, self._last_released, self._newest = [], None, None
+            key = self._unwrap(seq)
+        self._late_run = 0
+        arrival = time.time() if now is None else now
+        heapq.heappush(self._heap, (key, arrival, item))
+
+    def next_release(self):
+        """Time of the next scheduled release or None if the buffer is empty"""
+        if not self._heap:
+            return None
+        return min(arrival for seq, arrival, item in self._heap) + self.delay
+
+    def pop(self, now=None):
+        """Returns the next frame due for playout or None"""
+        if not self._heap:
+            return None
+        now = time.time() if now is None else now
+        if len(self._heap) <= self.depth and self.next_release() > now:
+            return None
+        seq, arrival, item = heapq.heappop(self._heap)
+        self._last_released = seq
+        return item
+
+
+class DatagramReceiver(object):
+
+    """
+    Reads fragmented packets from a UDP socket and yields them
+    in sequence order through a jitter buffer.
+    Iterating yields (FrameHeader, memoryview) tuples, like PacketReceiver.
+    """
+
+    def __init__(self, sock, delay=JITTER_DELAY, depth=3, datagram_size=DATAGRAM_SIZE):
+        """
+        :param sock: bound UDP socket
+        :param delay: playout delay of the jitter buffer in seconds
+        :param depth: frames held at most by the jitter buffer
+        """
+        self.sock = sock
+        self.reassembler = DatagramReassembler()
+        self.jitter = JitterBuffer(delay, depth)
+        self._buffer = bytearray(datagram_size)
+        self._view = memoryview(self._buffer)
+        self.running = True
+
+    def _wait_time(self):
+        release = self.jitter.next_release()
+        if release is None:
+            return 1.
+        return min(1., max(0., release - time.time()))
+
+    def __iter__(self):
+        while self.running:
+            packet = self.jitter.pop()
+            if packet is not None:
+                yield packet
+                continue
+            self.sock.settimeout(self._wait_time() or 1e-4)
+            try:
+                n = self.sock.recv_into(self._buffer)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            packet = self.reassembler.feed(self._view[:n])
+            if packet is not None:
+                self.jitter.push(packet[0].seq, packet)
@@ -2,7 +2,17 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 import time
 import socket
+import selectors
 import threading as thr
+from collections import deque
+
+import numpy as np
+
+from .codec import FrameDecoder
+from .const import (SUBSCRIBER_DEPTH, SUBSCRIBER_POLICY, KEYFRAME_INTERVAL, DTYPE,
+                    MOSAIC_SIZE, MOSAIC_FPS)
+from .metrics import Meter
+from .stream import FrameRing, send_packet
 
 
 class StreamDisplayer(thr.Thread):
@@ -21,6 +31,7 @@ class StreamDisplayer(thr.Thread):
         thr.Thread.__init__(self, name="Streamer-of-{}".format(carint.ID))
         self.running = False
         self.interface = carint
+        self.subscription = None  # type: StreamSubscription
         self.start()
 
     def run(self):
@@ -28,7 +39,9 @@ class StreamDisplayer(thr.Thread):
         Displays the remote car's stream with cv2.imshow()
         """
         import cv2
-        stream = self.interface.framestream()
+        self.subscription = self.interface.subscribe(depth=2, policy="drop-oldest",
+                                                     name="Display")
+        stream = self.interface.process(self.subscription.frames())
         print("STREAM_DISPLAYER: online")
         self.running = True
         for i, pic in enumerate(stream, start=1):
@@ -36,14 +49,18 @@ class StreamDisplayer(thr.Thread):
             #                    .format(i, pic.shape), end="")
             cv2.imshow("{} Stream".format(self.interface.ID), pic)
             keypress = cv2.waitKey(10)
+            self.interface.mark_displayed()
             if not self.running or keypress == 27:
                 break
+        self.subscription.close()
         cv2.destroyWindow("{} Stream".format(self.interface.ID))
         print("STREAM_DISPLAYER: Exiting...")
         self.teardown(0)
 
     def teardown(self, sleep=0):
         self.running = False
+        if self.subscription is not None:
+            self.subscription.close()
         time.sleep(sleep)
 
     def __del__(self):
@@ -51,40 +68,811 @@ class StreamDisplayer(thr.Thread):
             self.teardown(sleep=1)
 
 
-class Forwarder(object):
+class _MosaicTile(object):
 
-    def __init__(self, srcsock, trgsock, name=""):
-        self.srcsock = srcsock
+    """One car's tile of a MosaicDisplayer"""
+
+    def __init__(self, mosaic, carint):
+        self.mosaic = mosaic
+        self.interface = carint
+        self.subscription = carint.subscribe(depth=SUBSCRIBER_DEPTH, policy="keyframe",
+                                             name="Mosaic")
+        self.decoder = FrameDecoder()
+        self.rect = None  # x, y, width, height on the canvas
+        self._shape = None
+        self._index = None
+        self._view = None
+        self._last = None
+
+    def place(self, x, y, width, height):
+        self.rect = x, y, width, height
+        self._shape = None
+
+    def _latest(self):
+        """Decodes the packets queued since the last refresh, returns the latest frame or None"""
+        subscription = self.subscription
+        if not hasattr(subscription, "drain"):
+            return subscription.latest()  # not a hub subscription, eg. a shared memory ring
+        packets = subscription.drain()
+        # Packets before the latest keyframe are not needed to decode the latest frame
+        start = 0
+        for i, (header, payload) in enumerate(packets):
+            if header.keyframe:
+                start = i
+        frame = None
+        for header, payload in packets[start:]:
+            frame = self.decoder.decode(header, payload)
+        return frame
+
+    def _scale(self, shape):
+        """Nearest neighbour sampling indices of a frame shape, letterboxed into the tile"""
+        x, y, width, height = self.rect
+        self.mosaic.canvas[y:y + height, x:x + width] = 0
+        fh, fw = shape[:2]
+        scale = min(float(width) / fw, float(height) / fh)
+        ow, oh = max(1, int(fw * scale)), max(1, int(fh * scale))
+        rows = np.arange(oh) * fh // oh
+        cols = np.arange(ow) * fw // ow
+        self._index = rows[:, None] * fw + cols[None, :]
+        x0, y0 = x + (width - ow) // 2, y + (height - oh) // 2
+        self._view = self.mosaic.canvas[y0:y0 + oh, x0:x0 + ow]
+        self._shape = shape
+
+    def refresh(self):
+        """Draws the latest frame of the car into its tile. Returns whether there was a new one."""
+        frame = self._latest()
+        if frame is None:
+            if self._shape is not None or self._last is None:
+                return False
+            frame = self._last  # rearranged, the last frame is drawn again
+        self._last = frame
+        if frame.shape != self._shape:
+            self._scale(frame.shape)
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            # One gather straight into the canvas, no intermediate image
+            np.take(frame.reshape(-1, 3), self._index, axis=0, out=self._view, mode="clip")
+        else:
+            self._view[...] = np.take(frame.reshape(-1), self._index, mode="clip")[..., None]
+        return True
+
+    def teardown(self, sleep=0):
+        self.mosaic.remove(self)
+        time.sleep(sleep)
+
+
+class MosaicDisplayer(thr.Thread):
+
+    """
+    Displays the streams of every watched car in one window. The latest
+    frame of every car is scaled into its tile of a preallocated canvas,
+    which is shown MOSAIC_FPS times a second, regardless of the frame
+    rates of the cars. Packets are decoded at refresh time and the ones
+    before the latest keyframe are skipped, so a full fleet costs one
+    imshow() per refresh instead of one window and one waitKey() per frame.
+    The frames are shown as received, without the cars' processing pipelines.
+    """
+
+    window = "FIPER Mosaic"
+    _shared = None
+    _shared_lock = thr.Lock()
+
+    def __init__(self, size=MOSAIC_SIZE, fps=MOSAIC_FPS):
+        """
+        :param size: (width, height) of the window in pixels
+        :param fps: refresh rate of the window
+        """
+        thr.Thread.__init__(self, name="Mosaic")
+        self.daemon = True
+        self.width, self.height = size
+        self.fps = fps
+        self.canvas = np.zeros((self.height, self.width, 3), dtype=DTYPE)
+        self.tiles = []
+        self.running = False
+        self._relayout = False
+        self._cond = thr.Condition()
+
+    @classmethod
+    def shared(cls, create=True):
+        """The process-wide mosaic, started on first use. None if not <create> and not started yet."""
+        with cls._shared_lock:
+            if not create:
+                return cls._shared
+            if cls._shared is None or not cls._shared.is_alive():
+                cls._shared = cls()
+                cls._shared.running = True
+                cls._shared.start()
+            return cls._shared
+
+    def add(self, carint):
+        """Adds a tile for the car's stream. Returns the tile, its teardown() removes it."""
+        tile = _MosaicTile(self, carint)
+        with self._cond:
+            self.tiles.append(tile)
+            self._relayout = True
+            self._cond.notify()
+        return tile
+
+    def remove(self, tile):
+        with self._cond:
+            if tile in self.tiles:
+                self.tiles.remove(tile)
+                self._relayout = True
+        tile.subscription.close()
+
+    def _arrange(self, tiles):
+        """Splits the canvas into a grid of equal tiles"""
+        self.canvas[...] = 0
+        if not tiles:
+            return
+        cols = int(np.ceil(np.sqrt(len(tiles))))
+        rows = int(np.ceil(len(tiles) / float(cols)))
+        width, height = self.width // cols, self.height // rows
+        for i, tile in enumerate(tiles):
+            tile.place((i % cols) * width, (i // cols) * height, width, height)
+
+    def run(self):
+        import cv2
+        print("MOSAIC: online")
+        period = 1. / self.fps
+        shown = False
+        while self.running:
+            with self._cond:
+                if not self.tiles:
+                    if shown:
+                        cv2.destroyWindow(self.window)
+                        shown = False
+                    self._cond.wait(1)
+                    continue
+                tiles = list(self.tiles)
+                relayout, self._relayout = self._relayout, False
+            start = time.time()
+            if relayout:
+                self._arrange(tiles)
+            updated = [tile for tile in tiles if tile.refresh()]
+            if updated or relayout:
+                for tile in tiles:
+                    x, y = tile.rect[:2]
+                    cv2.putText(self.canvas, tile.interface.ID, (x + 8, y + 24),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+                cv2.imshow(self.window, self.canvas)
+                shown = True
+            cv2.waitKey(1)
+            for tile in updated:
+                tile.interface.mark_displayed()
+            time.sleep(max(0., period - (time.time() - start)))
+        with self._cond:
+            tiles, self.tiles = self.tiles, []
+        for tile in tiles:
+            tile.subscription.close()
+        if shown:
+            cv2.destroyWindow(self.window)
+        print("MOSAIC: Exiting...")
+
+    def teardown(self, sleep=0):
+        self.running = False
+        with self._cond:
+            self._cond.notify()
+        time.sleep(sleep)
+
+
+class StreamSubscription(FrameRing):
+
+    """
+    Bounded packet queue of one subscriber of a StreamHub.
+    Items are (header, payload) tuples. When the queue is full:
+    - policy="drop-oldest" discards the oldest packet,
+    - policy="keyframe" discards the whole queue and skips packets
+      until the next keyframe, so delta coded streams resume cleanly.
+    """
+
+    POLICIES = ("drop-oldest", "keyframe")
+
+    def __init__(self, hub, depth=SUBSCRIBER_DEPTH, policy=SUBSCRIBER_POLICY, name=""):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown subscriber policy: {}".format(policy))
+        super(StreamSubscription, self).__init__(capacity=depth)
+        self.hub = hub
+        self.policy = policy
+        self.name = name
+        self.received = 0
+        self._waiting = False
+        self._primed = deque()
+
+    def put(self, item):
+        header = item[0]
+        with self._cond:
+            self.received += 1
+            if self.policy == "keyframe":
+                if self._waiting and not header.keyframe:
+                    self.dropped += 1
+                    return
+                self._waiting = False
+                if len(self._items) >= self.capacity:
+                    self.dropped += len(self._items)
+                    self._items.clear()
+                    if not header.keyframe:
+                        self.dropped += 1
+                        self._waiting = True
+                        return
+            elif len(self._items) >= self.capacity:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def drain(self):
+        """Returns every queued packet without blocking, the primed ones first"""
+        with self._cond:
+            items = list(self._primed) + list(self._items)
+            self._primed.clear()
+            self._items.clear()
+        return items
+
+    def packets(self):
+        """Generator of the (header, payload) packets, until the subscription is closed"""
+        while not self.closed:
+            item = self._primed.popleft() if self._primed else self.get(timeout=0.5)
+            if item is not None:
+                yield item
+
+    def frames(self):
+        """Generator of the decoded frames, until the subscription is closed"""
+        decoder = FrameDecoder()
+        timing = getattr(self.hub.interface, "decode_time", None)
+        for header, payload in self.packets():
+            start = time.time()
+            frame = decoder.decode(header, payload)
+            if timing is not None:
+                timing.observe(time.time() - start)
+            if frame is not None:
+                yield frame
+
+    def prime(self, items):
+        """
+        Passes the packets of the hub's frame cache. They are kept apart from
+        the queue, so they don't count against the depth and are read first.
+        """
+        with self._cond:
+            self._primed.extend(items)
+            self._cond.notify()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+        super(StreamSubscription, self).close()
+
+
+class FrameCache(object):
+
+    """
+    The latest frame of a car's stream, kept as the packets since the
+    latest keyframe (only the latest one with intra-only codecs). The
+    packets are referenced, not copied. A frame can be decoded from them
+    at any time and new subscribers of the stream are primed with them,
+    so they don't have to wait for the next keyframe.
+    """
+
+    # Without a keyframe in this many packets, the chain is given up
+    limit = 4 * KEYFRAME_INTERVAL
+
+    def __init__(self):
+        self._chain = []
+        self._decoded = None  # (seq, frame)
+        self._cond = thr.Condition()
+
+    def update(self, header, payload):
+        with self._cond:
+            chain = self._chain
+            if header.keyframe:
+                self._chain = [(header, payload)]
+            elif chain and header.seq == chain[-1][0].seq + 1 and len(chain) < self.limit:
+                # A new list, so the lists handed out by packets() stay intact
+                self._chain = chain + [(header, payload)]
+            else:
+                self._chain = []  # broken chain, wait for the next keyframe
+            self._cond.notify_all()
+
+    @property
+    def latest(self):
+        """Header of the latest decodable frame or None"""
+        chain = self._chain
+        return chain[-1][0] if chain else None
+
+    @property
+    def keyframe(self):
+        """The (header, payload) of the latest keyframe or None"""
+        chain = self._chain
+        return chain[0] if chain else None
+
+    def packets(self):
+        """The packets needed to decode the latest frame, keyframe first"""
+        return self._chain
+
+    def wait(self, timeout):
+        """Waits until a frame is available, returns its header or None"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._chain:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._chain[-1][0]
+
+    def frame(self):
+        """
+        Decodes the latest frame. Returns (header, frame) or None if no
+        frame is available. The frame is read-only and shared by the callers.
+        """
+        chain = self._chain
+        if not chain:
+            return None
+        header = chain[-1][0]
+        decoded = self._decoded
+        if decoded is None or decoded[0] is not header:
+            decoder = FrameDecoder()
+            frame = None
+            for packet in chain:
+                frame = decoder.decode(*packet)
+            if frame is None:
+                return None
+            # The decoder is a fresh one, nobody else references the frame
+            frame.flags.writeable = False
+            decoded = self._decoded = header, frame
+        return decoded
+
+    def clear(self):
+        with self._cond:
+            self._chain = []
+            self._decoded = None
+
+
+class StreamHub(thr.Thread):
+
+    """
+    Reads a car's stream once and distributes its packets to any
+    number of subscribers. Every subscriber has its own bounded queue
+    (see StreamSubscription), so a slow subscriber only loses its own
+    packets and never slows down the car or the other subscribers.
+    If the car's frames are shared in memory, the hub publishes them.
+    The latest frame is kept in a FrameCache, new subscribers get the
+    packets of the latest frame first.
+    """
+
+    def __init__(self, carint):
+        """
+        :param carint: CarInterface instance
+        """
+        thr.Thread.__init__(self, name="Hub-of-{}".format(carint.ID))
+        self.daemon = True
+        self.interface = carint
+        self.subscribers = []
+        self.running = False
+        self._lock = thr.Lock()
+        self._decoder = FrameDecoder()
+        self.cache = FrameCache()
+
+    def subscribe(self, depth=SUBSCRIBER_DEPTH, policy=SUBSCRIBER_POLICY, name=""):
+        """Returns a new StreamSubscription"""
+        return self.attach(StreamSubscription(self, depth, policy, name))
+
+    def attach(self, subscriber, prime=True):
+        """
+        Adds a subscriber. Any object with a non-blocking put((header, payload))
+        and a close() method will do. Returns the subscriber.
+
+        :param prime: pass the cached packets of the latest frame first, with
+         the subscriber's prime(items) method if it has one, put() otherwise
+        """
+        with self._lock:
+            packets = self.cache.packets() if prime else ()
+            if packets:
+                if hasattr(subscriber, "prime"):
+                    subscriber.prime(packets)
+                else:
+                    for packet in packets:
+                        subscriber.put(packet)
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self.subscribers:
+                self.subscribers.remove(subscription)
+
+    def run(self):
+        print("STREAM_HUB: online")
+        self.running = True
+        try:
+            for header, payload in self.interface.packets():
+                if not self.running:
+                    break
+                # Receive buffers are reused, subscribers get their own copy
+                self.distribute(header, bytes(payload))
+        except Exception as E:
+            print("STREAM_HUB: receiving failed:", E)
+        finally:
+            self.running = False
+            # Wakes up the subscribers waiting in packets()
+            self.close_subscriptions()
+        print("STREAM_HUB: Exiting...")
+
+    def distribute(self, header, payload):
+        """Passes a packet to the subscribers and to the shared memory ring, if any"""
+        if self.interface.shmring is not None:
+            frame = self._decoder.decode(header, payload)
+            if frame is not None:
+                self.interface.shmring.publish(frame, header.timestamp)
+        with self._lock:
+            # Updated under the lock, so attach() primes with a consistent chain
+            self.cache.update(header, payload)
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.put((header, payload))
+
+    def close_subscriptions(self):
+        with self._lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscription in subscribers:
+            subscription.close()
+
+    def teardown(self, sleep=0):
+        self.running = False
+        time.sleep(sleep)
+
+
+class PacketSender(object):
+
+    """
+    Sends the packets of a StreamSubscription to a socket in a separate thread.
+    Used to pass a car's stream to a client.
+    """
+
+    def __init__(self, hub, trgsock, name="", depth=SUBSCRIBER_DEPTH, policy=SUBSCRIBER_POLICY,
+                 cork=False):
+        """
+        :param cork: whether to cork the socket around the packets, see routine.tune_socket
+        """
+        self.hub = hub
         self.trgsock = trgsock
-        self.tag = "-".join((name, "Forwarder"))
+        self.cork = cork
+        self.tag = "-".join((name, "PacketSender"))
+        self.depth = depth
+        self.policy = policy
+        self.subscription = None  # type: StreamSubscription
         self.worker = None
-        self.running = False
 
     def start(self):
         if self.worker is not None:
-            print("{}: already forwarding from {0[0]}:{0[1]} to {1[0]}:{1[1]}"
-                  .format(self.tag, self.srcsock.getsockname(), self.trgsock.getsockname()))
+            print("{}: already sending".format(self.tag))
             return
-        self.worker = thr.Thread(target=self.run, name="ClientInterface-rc_job")
+        self.subscription = self.hub.subscribe(self.depth, self.policy, name=self.tag)
+        self.worker = thr.Thread(target=self.run, name=self.tag)
         self.worker.start()
 
     def run(self):
         print("{} starts working".format(self.tag))
+        for header, payload in self.subscription.packets():
+            try:
+                send_packet(self.trgsock, header, payload, self.cork)
+            except socket.error as E:
+                print("{}: send failed: {}".format(self.tag, E))
+                break
+        self.subscription.close()
+        print("{} exiting...".format(self.tag))
+
+    def teardown(self, sleep=1):
+        if self.subscription is not None:
+            self.subscription.close()
+        time.sleep(sleep)
+        self.worker = None
+
+
+class RelayPair(object):
+
+    """
+    One direction of a relayed connection: bytes read from <src> are written to <trg>.
+    Holds the pair's write queue and its throughput counters.
+    """
+
+    def __init__(self, src, trg, name=""):
+        self.src = src
+        self.trg = trg
+        self.name = name
+        self.queue = deque()
+        self.queued = 0
+        self.received = 0
+        self.written = Meter()  # bytes written to the target
+        self.eof = False
+
+    @property
+    def sent(self):
+        return self.written.total
+
+    def rate(self):
+        """Bytes/sec written to the target over the last few seconds"""
+        return self.written.rate()
+
+
+class Relay(thr.Thread):
+
+    """
+    Moves data between any number of socket pairs in a single thread,
+    multiplexed with selectors (epoll/kqueue/select, whichever is best).
+
+    Sources are read with recv_into() into a large preallocated buffer.
+    Whatever a target doesn't accept right away is kept in the pair's
+    write queue and written when the target becomes writable, so partial
+    writes never lose data. A source is not read while its queue holds more
+    than <highwater> bytes, so a slow target throttles its source.
+
+    Pairs may be added and removed from any thread, the changes are
+    carried out by the relay's own thread.
+    """
+
+    _shared = None
+    _shared_lock = thr.Lock()
+
+    def __init__(self, bufsize=1 << 16, highwater=1 << 22, name="Relay"):
+        """
+        :param bufsize: size of the receive buffer, the maximal size of one read
+        :param highwater: maximal number of bytes queued for a target
+        """
+        thr.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.bufsize = bufsize
+        self.highwater = highwater
+        self.pairs = []
+        self.running = False
+        self._selector = selectors.DefaultSelector()
+        self._buffer = bytearray(bufsize)
+        self._view = memoryview(self._buffer)
+        self._sockets = {}  # socket: [reader pair, writer pair]
+        self._timeouts = {}
+        self._pending = deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    @classmethod
+    def shared(cls, create=True):
+        """The process-wide relay, started on first use. None if not <create> and not started yet."""
+        with cls._shared_lock:
+            if not create:
+                return cls._shared
+            if cls._shared is None or not cls._shared.is_alive():
+                cls._shared = cls()
+                cls._shared.start()
+            return cls._shared
+
+    def add(self, src, trg, name=""):
+        """Starts relaying from socket <src> to socket <trg>. Returns the RelayPair."""
+        pair = RelayPair(src, trg, name)
+        self._call(self._add, pair)
+        return pair
+
+    def remove(self, pair):
+        """Stops relaying a pair. Data still in its write queue is discarded."""
+        self._call(self._remove, pair)
+
+    def stats(self):
+        """Throughput counters of the relayed pairs"""
+        return [{"name": pair.name, "received": pair.received, "sent": pair.sent,
+                 "queued": pair.queued, "rate": pair.rate()} for pair in list(self.pairs)]
+
+    def teardown(self, sleep=0):
+        self._call(self._stop)
+        time.sleep(sleep)
+
+    def _call(self, method, *args):
+        self._pending.append((method, args))
+        try:
+            self._wakeup_w.send(b"x")
+        except socket.error:
+            pass  # The wakeup socket is full, the relay is being woken up anyway
+
+    def run(self):
+        print("RELAY: online")
         self.running = True
         while self.running:
+            for key, events in self._selector.select(timeout=1):
+                if key.fileobj is self._wakeup_r:
+                    self._drain_wakeup()
+                    continue
+                entry = self._sockets.get(key.fileobj)
+                if entry is None:
+                    continue  # Released by an earlier event of this batch
+                try:
+                    self._serve(entry, events)
+                except Exception as E:
+                    print("RELAY: dropping the pairs of a failed socket:", E)
+                    self._drop(entry)
+            while self._pending:
+                method, args = self._pending.popleft()
+                try:
+                    method(*args)
+                except Exception as E:
+                    print("RELAY: {} failed: {}".format(method.__name__, E))
+        for pair in list(self.pairs):
+            self._remove(pair)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        print("RELAY: exiting...")
+
+    def _stop(self):
+        self.running = False
+
+    def _serve(self, entry, events):
+        """entry is the [reader pair, writer pair] of a socket, it is updated in place"""
+        if events & selectors.EVENT_WRITE and entry[1] is not None:
+            self._flush(entry[1])
+        if events & selectors.EVENT_READ and entry[0] is not None:
+            self._read(entry[0])
+
+    def _drop(self, entry):
+        for pair in [pair for pair in entry if pair is not None]:
             try:
-                data = self.srcsock.recv(1024)
-            except socket.timeout:
+                self._remove(pair)
+            except Exception as E:
+                print("RELAY: couldn't remove {}: {}".format(pair.name, E))
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
                 pass
+        except socket.error:
+            pass
+
+    def _read(self, pair):
+        try:
+            received = pair.src.recv_into(self._view)
+        except (socket.timeout, BlockingIOError, InterruptedError):
+            return
+        except socket.error as E:
+            print("RELAY: {} source failed: {}".format(pair.name, E))
+            self._remove(pair)
+            return
+        if not received:
+            pair.eof = True
+            if not pair.queued:
+                self._remove(pair)
             else:
-                self.trgsock.send(data)
-        print("{} exiting...".format(self.tag))
+                self._update(pair.src)
+            return
+        pair.received += received
+        data = self._view[:received]
+        if not pair.queued:
+            # Fast path: write straight from the receive buffer
+            try:
+                written = pair.trg.send(data)
+            except (socket.timeout, BlockingIOError, InterruptedError):
+                written = 0
+            except socket.error as E:
+                print("RELAY: {} target failed: {}".format(pair.name, E))
+                self._remove(pair)
+                return
+            pair.written.mark(written)
+            if written == received:
+                return
+            data = data[written:]
+        pair.queue.append(bytes(data))
+        pair.queued += len(data)
+        self._update(pair.src)
+        self._update(pair.trg)
+
+    def _flush(self, pair):
+        while pair.queue:
+            chunk = pair.queue[0]
+            try:
+                written = pair.trg.send(chunk)
+            except (socket.timeout, BlockingIOError, InterruptedError):
+                break
+            except socket.error as E:
+                print("RELAY: {} target failed: {}".format(pair.name, E))
+                self._remove(pair)
+                return
+            pair.written.mark(written)
+            pair.queued -= written
+            if written < len(chunk):
+                pair.queue[0] = chunk[written:]
+                break
+            pair.queue.popleft()
+        if pair.eof and not pair.queued:
+            self._remove(pair)
+            return
+        self._update(pair.src)
+        self._update(pair.trg)
+
+    def _update(self, sock):
+        """(Re)registers a socket with the events its pairs are waiting for"""
+        reader, writer = self._sockets.get(sock, (None, None))
+        events = 0
+        if reader is not None and not reader.eof and reader.queued < self.highwater:
+            events |= selectors.EVENT_READ
+        if writer is not None and writer.queued:
+            events |= selectors.EVENT_WRITE
+        registered = sock in self._selector.get_map()
+        if events and registered:
+            self._selector.modify(sock, events)
+        elif events:
+            self._selector.register(sock, events)
+        elif registered:
+            self._selector.unregister(sock)
+
+    def _add(self, pair):
+        for sock in (pair.src, pair.trg):
+            if sock not in self._sockets:
+                self._sockets[sock] = [None, None]
+                self._timeouts[sock] = sock.gettimeout()
+                sock.setblocking(False)
+        if self._sockets[pair.src][0] is not None or self._sockets[pair.trg][1] is not None:
+            print("RELAY: {} conflicts with a relayed pair, not relaying!".format(pair.name))
+            self._release(pair.src)
+            self._release(pair.trg)
+            return
+        self._sockets[pair.src][0] = pair
+        self._sockets[pair.trg][1] = pair
+        self.pairs.append(pair)
+        self._update(pair.src)
+        self._update(pair.trg)
+
+    def _remove(self, pair):
+        if pair not in self.pairs:
+            return
+        self.pairs.remove(pair)
+        pair.queue.clear()
+        pair.queued = 0
+        self._sockets[pair.src][0] = None
+        self._sockets[pair.trg][1] = None
+        for sock in (pair.src, pair.trg):
+            self._release(sock)
+
+    def _release(self, sock):
+        """Forgets a socket, which is not part of any pair anymore"""
+        if self._sockets[sock] != [None, None]:
+            self._update(sock)
+            return
+        del self._sockets[sock]
+        if sock in self._selector.get_map():
+            self._selector.unregister(sock)
+        try:
+            sock.settimeout(self._timeouts.pop(sock))
+        except socket.error:
+            pass  # Closed meanwhile
+
+
+class Forwarder(object):
+
+    """
+    Forwards the data of one socket to another socket.
+    The forwarding is done by the shared Relay, so no thread is used per pair.
+    """
+
+    def __init__(self, srcsock, trgsock, name=""):
+        self.srcsock = srcsock
+        self.trgsock = trgsock
+        self.tag = "-".join((name, "Forwarder"))
+        self.pair = None  # type: RelayPair
+        self.running = False
+
+    def start(self):
+        if self.pair is not None:
+            print("{}: already forwarding from {}:{} to {}:{}"
+                  .format(self.tag, *(self.srcsock.getsockname() + self.trgsock.getsockname())))
+            return
+        self.pair = Relay.shared().add(self.srcsock, self.trgsock, name=self.tag)
+        self.running = True
+        print("{} starts working".format(self.tag))
 
     def teardown(self, sleep=1):
+        if self.pair is not None:
+            Relay.shared().remove(self.pair)
+            self.pair = None
         self.running = False
         time.sleep(sleep)
-        self.worker = None
 
     def __del__(self):
         if self.running:
-            self.teardown()
+            self.teardown(0)
@@ -0,0 +1,603 @@
+"""
+asyncio runtime of the server.
+
+The threaded FleetHandler runs a Listener thread, two threads for every
+Messaging channel and threads for the forwarded streams, so its thread
+count grows with the fleet. AsyncFleetHandler runs all the network I/O
+of the fleet (listening, handshakes, messaging, stream reception and
+forwarding to clients) as coroutines of one event loop in a single thread.
+The console stays in the main thread and has the same commands.
+
+Needs Python 3.7+.
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import time
+import asyncio
+import threading as thr
+from collections import deque
+from functools import partial
+
+from FIPER.generic.const import HANDSHAKE_TIMEOUT, LISTEN_BACKLOG, MESSAGE_FRAMING, SUBSCRIBER_POLICY
+from FIPER.generic.interface import InterfaceFactory, _CarInterface
+from FIPER.generic.latency import LatencyTracker
+from FIPER.generic.messaging import Messaging, MessageParser, message_parts
+from FIPER.generic.metrics import REGISTRY
+from FIPER.generic.routine import srvsock
+from FIPER.generic.rpc import RPCEndpoint
+from FIPER.generic.session import PREAMBLE_SIZE, parse_preamble
+from FIPER.generic.stream import (
+    FRAME_MAGIC, FrameHeader, DatagramReassembler, JitterBuffer, payload_limit
+)
+from FIPER.generic.subsystem import StreamHub
+from FIPER.host.bridge import FleetHandler
+
+
+def _peer_ip(writer):
+    return writer.get_extra_info("peername")[0]
+
+
+class AsyncMessaging(Messaging):
+
+    """
+    Messaging over asyncio streams, with the wire format and the interface
+    of generic.messaging.Messaging, but without threads. flow_in() is a
+    coroutine and send() writes through the event loop, so it can be called
+    from any thread. Blocking recv() calls with a timeout must not be made
+    in the event loop's thread, coroutines await wait() instead.
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, reader, writer, loop, tag=b"", framing=MESSAGE_FRAMING):
+        self.tag = tag
+        self.framing = framing
+        self.remote_tag = ""
+        self.recvbuffer = deque()
+        self.handlers = {}
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.sock = writer.get_extra_info("socket")
+        self.running = True
+        self._cond = thr.Condition()
+        self._arrived = asyncio.Event()
+
+    async def flow_in(self):
+        """Receives and chops up the incoming messages until the connection is closed"""
+        parser = MessageParser()
+        while self.running:
+            try:
+                chunk = await self.reader.read(1 << 16)
+                if not chunk:
+                    break
+                messages = parser.feed(chunk)
+            except (ConnectionError, OSError) as E:
+                print("MESSENGER: caught socket exception:", E)
+                break
+            except ValueError as E:
+                print("MESSENGER: invalid message:", E)
+                break
+            self._check_framing(parser)
+            for msg in messages:
+                self._deliver(msg)
+        self.running = False
+        with self._cond:
+            self._cond.notify_all()
+        self._arrived.set()
+
+    def _store(self, msg):
+        super(AsyncMessaging, self)._store(msg)
+        self._arrived.set()
+
+    async def wait(self, timeout):
+        """Returns the next message from the receive buffer or None after <timeout> seconds"""
+        deadline = self.loop.time() + timeout
+        while True:
+            self._arrived.clear()
+            with self._cond:
+                if self.recvbuffer:
+                    return self.recvbuffer.popleft()
+            remaining = deadline - self.loop.time()
+            if remaining <= 0 or not self.running:
+                return None
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    def send(self, *msgs):
+        assert all(isinstance(m, bytes) for m in msgs)
+        buffers = []
+        for m in msgs:
+            buffers.extend(message_parts(m, self.tag, self.framing))
+        self.loop.call_soon_threadsafe(self._write, buffers)
+
+    def _write(self, buffers):
+        if not self.writer.is_closing():
+            self.writer.writelines(buffers)
+
+    def teardown(self, sleep=0):
+        self.running = False
+        self.loop.call_soon_threadsafe(self.writer.close)
+        time.sleep(sleep)
+
+    def __del__(self):
+        pass
+
+
+class _DatagramStream(asyncio.DatagramProtocol):
+
+    """Reassembles a car's datagrams and releases the packets through a jitter buffer"""
+
+    def __init__(self, carint):
+        self.interface = carint
+        self.reassembler = DatagramReassembler()
+        self.jitter = JitterBuffer()
+        self._timer = None
+
+    def datagram_received(self, data, addr):
+        packet = self.reassembler.feed(data)
+        if packet is not None:
+            self.jitter.push(packet[0].seq, packet)
+        self._release()
+
+    def _release(self):
+        packet = self.jitter.pop()
+        while packet is not None:
+            self.interface.dispatch(*packet)
+            packet = self.jitter.pop()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        release = self.jitter.next_release()
+        if release is not None:
+            self._timer = self.interface.loop.call_later(
+                max(0., release - time.time()), self._release)
+
+
+class AsyncCarInterface(_CarInterface):
+
+    """
+    CarInterface of the asyncio runtime. The car's stream is read by the
+    receive() coroutine, which feeds the StreamHub directly, the hub has
+    no thread of its own. Subscriptions, latency statistics and the shared
+    memory ring work the same way as with the threaded CarInterface.
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, ID, messenger, frameshape, codec, dconn, rcconn, udpsock=None):
+        """
+        :param ID: the ID of the remote car
+        :param messenger: an AsyncMessaging instance
+        :param frameshape: the video frame shape as a list: [Y, X, C]
+        :param codec: name of the codec negotiated in the handshake
+        :param dconn: (reader, writer) of the data connection
+        :param rcconn: (reader, writer) of the RC connection
+        :param udpsock: bound UDP socket, if the stream is transported over UDP
+        """
+        self.ID = ID
+        self.messenger = messenger
+        self.messenger.remote_tag = "{}-{}:".format(self.entity_type, ID)
+        self.send = messenger.send
+        self.recv = messenger.recv
+        self.loop = messenger.loop
+        self.rpc = RPCEndpoint(messenger)
+        self.dreader, self.dwriter = dconn
+        self.rcreader, self.rcwriter = rcconn
+        self.remote_ip = _peer_ip(self.dwriter)
+        self.initiated = True
+        self.datagrams = None
+        self._setup_stream(frameshape, codec, udpsock)
+        self.hub = StreamHub(self)
+
+    def _start_hub(self):
+        """The hub is fed by receive(), there is nothing to start"""
+
+    def dispatch(self, header, payload):
+        """Bookkeeping and distribution of a received packet"""
+        self._received(header)
+        self.hub.distribute(header, bytes(payload))
+
+    async def receive(self):
+        """Receives the car's stream until the data connection is closed"""
+        if self.udpsock is not None:
+            self.datagrams, _ = await self.loop.create_datagram_endpoint(
+                partial(_DatagramStream, self), sock=self.udpsock)
+        self.sync_clock()
+        try:
+            while True:
+                header = await self._read_header()
+                payload = await self.dreader.readexactly(header.length)
+                self.dispatch(header, payload)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.hub.close_subscriptions()
+            self.out("Stream closed")
+
+    async def _read_header(self):
+        """Reads the next valid header, resynchronizing on the magic marker if needed"""
+        data = await self.dreader.readexactly(FrameHeader.size)
+        limit = payload_limit(self.frameshape)
+        skipped = 0
+        while 1:
+            if data.startswith(FRAME_MAGIC):
+                try:
+                    header = FrameHeader.unpack(data)
+                except ValueError:
+                    header = None
+                if header is not None and header.length <= limit:
+                    if skipped:
+                        self.out("Resynchronized after skipping {} bytes".format(skipped))
+                    return header
+            shift = data.find(FRAME_MAGIC[:1], 1)
+            if shift < 0:
+                shift = len(data)
+            data = data[shift:] + await self.dreader.readexactly(shift)
+            skipped += shift
+
+    def teardown(self, sleep=3):
+        success = self.perform_remote_shutdown(await_remote=2)
+        self.rpc.close()
+        self.messenger.teardown(0)
+        self.loop.call_soon_threadsafe(self._close)
+        self.unpublish_shm()
+        self.stop_recording()
+        self.set_pipeline()
+        REGISTRY.remove("car", self.ID)
+        time.sleep(max(0, sleep-2))
+        self.out("Teardown finished!")
+        return success
+
+    def _close(self):
+        self.dwriter.close()
+        self.rcwriter.close()
+        if self.datagrams is not None:
+            self.datagrams.close()
+        elif self.udpsock is not None:
+            self.udpsock.close()
+
+    def __del__(self):
+        pass
+
+
+class _WriterSink(object):
+
+    """
+    StreamHub subscriber of the asyncio runtime, writes the packets to a
+    client's data connection. While the connection's write buffer holds
+    more than <limit> bytes, packets are dropped instead of buffered.
+    With the keyframe policy the writing resumes at the next keyframe.
+    """
+
+    def __init__(self, hub, writer, policy=SUBSCRIBER_POLICY, limit=1 << 20):
+        self.hub = hub
+        self.writer = writer
+        self.policy = policy
+        self.limit = limit
+        self.sent = 0
+        self.dropped = 0
+        self._waiting = False
+
+    def put(self, item):
+        header, payload = item
+        if self.writer.is_closing():
+            self.close()
+            return
+        if self._waiting and not header.keyframe:
+            self.dropped += 1
+            return
+        if self.writer.transport.get_write_buffer_size() > self.limit:
+            self.dropped += 1
+            self._waiting = self.policy == "keyframe"
+            return
+        self._waiting = False
+        header.length = len(payload)
+        self.writer.writelines([header.pack(), payload])
+        self.sent += 1
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class AsyncClientInterface(object):
+
+    """
+    ClientInterface of the asyncio runtime. Commands arrive on the
+    messaging channel: cars, connect <carID> and disconnect, either as calls
+    (see generic/rpc.py) or as plain messages, answered by plain messages,
+    and watch <carID> (stream only, no RC) as a call.
+    The connected car's stream is written to the client's data connection,
+    the client's RC connection is piped to the car.
+    """
+
+    entity_type = "client"
+
+    def __init__(self, ID, messenger, dconn, rcconn, master):
+        """
+        :param ID: the client's unique ID
+        :param messenger: an AsyncMessaging instance
+        :param dconn: (reader, writer) of the data connection
+        :param rcconn: (reader, writer) of the RC connection
+        :param master: the AsyncFleetHandler, which holds the cars
+        """
+        self.ID = ID
+        self.messenger = messenger
+        self.messenger.remote_tag = "{}-{}:".format(self.entity_type, ID)
+        self.send = messenger.send
+        self.recv = messenger.recv
+        self.loop = messenger.loop
+        self.dreader, self.dwriter = dconn
+        self.rcreader, self.rcwriter = rcconn
+        self.master = master
+        self.carifc = None  # type: AsyncCarInterface
+        self.sink = None  # type: _WriterSink
+        self.rcpipe = None  # type: asyncio.Task
+        self.rpc = RPCEndpoint(messenger, cars=self.list_cars, connect=self.connect,
+                               watch=self.watch, disconnect=self.detach)
+        self.messenger.subscribe("cars", self._on_cars)
+        self.messenger.subscribe("connect", self._on_connect)
+        self.messenger.subscribe("disconnect", lambda message: self.detach())
+
+    def out(self, *args, **kw):
+        sep, end = kw.get("sep", " "), kw.get("end", "\n")
+        print("CLIENTIFACE {}: ".format(self.ID), *args, sep=sep, end=end)
+
+    def list_cars(self):
+        """IDs of the cars available on the server"""
+        return sorted(self.master.cars)
+
+    def connect(self, ID, control=True):
+        """Attaches the client to a car, returns the car's frame shape"""
+        if ID not in self.master.cars:
+            raise KeyError("no such car: {}".format(ID))
+        self.attach(self.master.cars[ID], control)
+        return list(self.carifc.frameshape)
+
+    def watch(self, ID):
+        """Attaches the client to a car's stream only, the client can't control the car"""
+        return self.connect(ID, control=False)
+
+    def _on_cars(self, message):
+        self.send(", ".join(self.list_cars()).encode())
+
+    def _on_connect(self, message):
+        ID = message.split(" ")[1] if " " in message else ""
+        if ID not in self.master.cars:
+            self.send("no such car: {}".format(ID).encode())
+            return
+        try:
+            frameshape = self.connect(ID)
+        except RuntimeError as E:
+            self.out(E)
+            return
+        self.send("x".join(str(d) for d in frameshape).encode())
+
+    def attach(self, carifc, control=True):
+        if self.carifc is not None:
+            raise RuntimeError("already connected to {}".format(self.carifc.ID))
+        self.carifc = carifc
+        carifc.acquire_stream("client-{}".format(self.ID))
+        self.sink = carifc.hub.attach(_WriterSink(carifc.hub, self.dwriter))
+        if control:
+            self.rcpipe = self.loop.create_task(self._pipe(self.rcreader, carifc.rcwriter))
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        while True:
+            data = await reader.read(1 << 16)
+            if not data or writer.is_closing():
+                break
+            writer.write(data)
+            await writer.drain()
+
+    def detach(self):
+        if self.carifc is None:
+            return
+        self.sink.close()
+        if self.rcpipe is not None:
+            self.rcpipe.cancel()
+        self.carifc.release_stream("client-{}".format(self.ID))
+        self.carifc = self.sink = self.rcpipe = None
+
+    def _close(self):
+        self.detach()
+        self.dwriter.close()
+        self.rcwriter.close()
+
+    def teardown(self, sleep=1):
+        self.rpc.close()
+        self.messenger.teardown(0)
+        self.loop.call_soon_threadsafe(self._close)
+        time.sleep(sleep)
+
+
+class AsyncListener(object):
+
+    """
+    Runs the event loop of the server in a single thread. Listens for cars
+    and clients, performs their handshakes and receives the cars' streams.
+    Handshakes run concurrently, the data and RC connections are matched
+    to them by their session tokens (see generic/session.py).
+    """
+
+    def __init__(self, master, mlistener=None, dlistener=None, rclistener=None):
+        """
+        :param master: the server, its cars and clients dictionaries are filled
+        :param mlistener, dlistener, rclistener: listening sockets of the messaging,
+        data and RC channels, by default bound to the channels' ports of master.ip
+        """
+        self.master = master
+        self.loop = asyncio.new_event_loop()
+        self.mlistener = mlistener or srvsock(master.ip, "messaging")
+        self.dlistener = dlistener or srvsock(master.ip, "stream")
+        self.rclistener = rclistener or srvsock(master.ip, "rc")
+        self.announce = {}  # extra options of the HELLO responses
+        self.on_car_closed = None  # callback(carifc), called in the loop when a stream ends
+        self.worker = None
+        self.running = False
+        self.tasks = set()
+        self._servers = []
+        self._awaited = {}  # (token, type): future of the connection
+        self.handshakes = LatencyTracker()
+        self._stopped = None  # type: asyncio.Event
+
+    def start(self):
+        if self.worker is not None:
+            print("ASYNC_LISTENER: Attempted start while already running!")
+            return
+        self.worker = thr.Thread(target=self.mainloop, name="Server-EventLoop")
+        self.worker.start()
+
+    def mainloop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve())
+        self.loop.close()
+        print("ASYNC_LISTENER: Exiting...")
+
+    async def serve(self):
+        self._stopped = asyncio.Event()
+        self._servers = [
+            await asyncio.start_server(self._on_messaging, sock=self.mlistener,
+                                       backlog=LISTEN_BACKLOG),
+            await asyncio.start_server(partial(self._on_connection, "Data"), sock=self.dlistener,
+                                       backlog=LISTEN_BACKLOG),
+            await asyncio.start_server(partial(self._on_connection, "RC"), sock=self.rclistener,
+                                       backlog=LISTEN_BACKLOG)
+        ]
+        self.running = True
+        print("ASYNC_LISTENER: online")
+        await self._stopped.wait()
+        self._close_servers()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.running = False
+
+    def spawn(self, coro):
+        """Runs a coroutine as a task of the event loop. Call it from the loop's thread."""
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _on_connection(self, typ, reader, writer):
+        """Reads the session token of a data or RC connection and hands it to its handshake"""
+        try:
+            preamble = await asyncio.wait_for(reader.readexactly(PREAMBLE_SIZE),
+                                              HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            preamble = b""
+        future = self._awaited.get((parse_preamble(preamble), typ))
+        if future is None or future.done():
+            print("ASYNC_LISTENER: {} connection from {} without a valid session token!"
+                  .format(typ, _peer_ip(writer)))
+            writer.close()
+            return
+        future.set_result((reader, writer))
+
+    async def _on_messaging(self, reader, writer):
+        print("ASYNC_LISTENER: received connection from {}:{}"
+              .format(*writer.get_extra_info("peername")[:2]))
+        start = time.time()
+        messenger = AsyncMessaging(reader, writer, self.loop)
+        self.spawn(messenger.flow_in())
+        ifc = await self._build_interface(messenger)
+        self.handshakes.add("handshake" if ifc else "failed", time.time() - start)
+        if ifc is None:
+            print("ASYNC_LISTENER: no interface received!")
+            messenger.teardown()
+            return
+        print("ASYNC_LISTENER: received {} interface: {}".format(ifc.entity_type, ifc.ID))
+        if ifc.entity_type == "car":
+            self.master.cars[ifc.ID] = ifc
+            task = self.spawn(ifc.receive())
+            if self.on_car_closed is not None:
+                task.add_done_callback(lambda _: self.on_car_closed(ifc))
+        else:
+            self.master.clients[ifc.ID] = ifc
+
+    async def _build_interface(self, messenger):
+        """Coroutine version of InterfaceFactory.get()"""
+        factory = InterfaceFactory(None, None, messenger=messenger)
+        factory.announce = self.announce
+        introduction = await messenger.wait(HANDSHAKE_TIMEOUT)
+        if introduction is None:
+            print("IFC_BUILDER: didn't receive an introduction!")
+            return None
+        response = factory.accept_introduction(introduction)
+        if response is None:
+            return None
+        for typ in ("Data", "RC"):
+            self._awaited[(factory.token, typ)] = self.loop.create_future()
+        messenger.send(response)
+        remote_ip = _peer_ip(messenger.writer)
+        dconn = await self._accept(factory.token, "Data", remote_ip)
+        rcconn = await self._accept(factory.token, "RC", remote_ip) if dconn else None
+        self._awaited.pop((factory.token, "RC"), None)
+        if not rcconn:
+            for conn in (dconn, rcconn):
+                if conn:
+                    conn[1].close()
+            if factory.udpsock is not None:
+                factory.udpsock.close()
+            return None
+        print("IFC_BUILDER: valid introduction!")
+        if factory.etype == "car":
+            return AsyncCarInterface(factory.ID, messenger, factory.info, factory.codec,
+                                     dconn, rcconn, factory.udpsock)
+        return AsyncClientInterface(factory.ID, messenger, dconn, rcconn, self.master)
+
+    async def _accept(self, token, typ, remote_ip):
+        """Awaits the data or RC connection of a session, it has to come from <remote_ip>"""
+        future = self._awaited[(token, typ)]
+        try:
+            reader, writer = await asyncio.wait_for(future, HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("IFC_BUILDER: no {} connection from {}".format(typ, remote_ip))
+            return None
+        finally:
+            del self._awaited[(token, typ)]
+        if _peer_ip(writer) != remote_ip:
+            print("IFC_BUILDER: {} connection from {} instead of {}!"
+                  .format(typ, _peer_ip(writer), remote_ip))
+            writer.close()
+            return None
+        return reader, writer
+
+    def _close_servers(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+
+    def teardown(self, sleep=2):
+        """Stops accepting connections. The event loop keeps running, see stop()."""
+        if self.running:
+            self.loop.call_soon_threadsafe(self._close_servers)
+        time.sleep(sleep)
+
+    def stop(self, sleep=1):
+        """Cancels every task and stops the event loop"""
+        if self._stopped is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        time.sleep(sleep)
+        self.worker = None
+
+
+class AsyncFleetHandler(FleetHandler):
+
+    """
+    FleetHandler, which runs the network I/O of the fleet on an asyncio
+    event loop (see AsyncListener). Only the console and the event loop
+    have a thread of their own, the displays still run in threads.
+    """
+
+    listener_type = AsyncListener
+
+    def shutdown(self, *args):
+        """Shuts the server down, terminating all connections nicely"""
+        super(AsyncFleetHandler, self).shutdown(*args)
+        for ID, client in list(self.clients.items()):
+            client.teardown(0)
+        self.listener.stop()
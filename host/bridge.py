@@ -2,10 +2,15 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 # stdlib imports
 import time
+import threading as thr
 from datetime import datetime
 
 # project imports
-from FIPER.generic.subsystem import StreamDisplayer
+from FIPER.generic.const import HANDSHAKE_TIMEOUT, MOSAIC_DISPLAY, METRICS_PORT
+from FIPER.generic.metrics import REGISTRY, MetricsServer
+from FIPER.generic.pipeline import Pipeline, parse_stages
+from FIPER.generic.recording import RecordingWriter
+from FIPER.generic.subsystem import StreamDisplayer, MosaicDisplayer, Relay
 from FIPER.generic.util import Table
 from FIPER.generic.probeclient import Probe
 from FIPER.host.component import Listener, Console
@@ -21,13 +26,14 @@ class FleetHandler(object):
     - Listener is listening for incomming car connections in a separate thread.
     It also coordinates the creation and validation of new car interfaces.
     - CarInterface instances are stored in the .cars dictionary.
-    - StreamDisplayer objects can be attached to CarInterface objects and
-    are run in a separate thread each.
+    - Watched cars are shown in the tiles of a MosaicDisplayer or by
+    StreamDisplayer objects, which are run in a separate thread each.
     - FleetHandler itself is responsible for sending commands to CarInterfaces
     and to coordinate the shutdown of the cars on this side, etc.
     """
 
     the_one = None
+    listener_type = Listener
 
     def __init__(self, myIP):
         self.clients = {}
@@ -45,6 +51,12 @@ class FleetHandler(object):
                 "kill": self.kill_car,
                 "watch": self.watch_car,
                 "unwatch": self.stop_watch,
+                "share": self.share_car,
+                "record": self.record_car,
+                "pipeline": self.pipeline_car,
+                "snapshot": self.snapshot_car,
+                "metrics": self.print_metrics,
+                "profile": self.profile_car,
                 "shutdown": self.shutdown,
                 "status": self.report,
                 "message": self.message,
@@ -54,8 +66,10 @@ class FleetHandler(object):
             }
         )
 
-        self.listener = Listener(self)
+        self.listener = self.listener_type(self)
         self.listener.start()
+        REGISTRY.collector("relay", self._relay_metrics)
+        self.metrics_server = MetricsServer.launch(METRICS_PORT)
         print("SERVER: online")
 
     def mainloop(self):
@@ -108,29 +122,142 @@ class FleetHandler(object):
             self.stop_watch(ID)
         success = self.cars[ID].teardown(sleep=1)
         if success:
-            del self.cars[ID]
+            self.cars.pop(ID, None)
 
     def watch_car(self, ID, *args):
-        """Launches the stream display in a separate thread"""
+        """
+        Shows the car's stream: in a tile of the mosaic window or,
+        if MOSAIC_DISPLAY is off, in a window of its own
+        """
         if ID not in self.cars:
             print("SERVER: no such car:", ID)
             return
         if ID in self.watchers:
             print("SERVER: already watching", ID)
             return
-        self.cars[ID].send(b"stream on")
+        self.cars[ID].acquire_stream("watch")
         time.sleep(1)
-        self.watchers[ID] = StreamDisplayer(self.cars[ID])
+        if MOSAIC_DISPLAY:
+            self.watchers[ID] = MosaicDisplayer.shared().add(self.cars[ID])
+        else:
+            self.watchers[ID] = StreamDisplayer(self.cars[ID])
 
     def stop_watch(self, ID, *args):
-        """Tears down the StreamDisplayer and shuts down a stream"""
+        """Removes the car's tile or display window, the stream stops if nothing else uses it"""
         if ID not in self.watchers:
             print("SERVER: {} is not being watched!".format(ID))
             return
-        self.cars[ID].send(b"stream off")
+        self.cars[ID].release_stream("watch")
         self.watchers[ID].teardown(sleep=1)
         del self.watchers[ID]
 
+    def share_car(self, ID, switch="on", *args):
+        """
+        Publishes the car's decoded frames into shared memory for local consumers
+        (see generic.shmring).
+        Usage: share <ID> [on/off]
+        """
+        if ID not in self.cars:
+            print("SERVER: no such car:", ID)
+            return
+        if switch == "off":
+            self.cars[ID].unpublish_shm()
+            print("SERVER: stopped sharing", ID)
+            return
+        print("SERVER: sharing {} as {}".format(ID, self.cars[ID].publish_shm()))
+
+    def record_car(self, ID, switch="on", mode="encoded", *args):
+        """
+        Records the car's stream to disk, as received (encoded) or decoded (raw),
+        see generic.recording.
+        Usage: record <ID> [on/off] [encoded/raw]
+        """
+        if ID not in self.cars:
+            print("SERVER: no such car:", ID)
+            return
+        if switch == "off":
+            self.cars[ID].stop_recording()
+            print("SERVER: stopped recording", ID)
+            return
+        print("SERVER: recording {} into {}".format(ID, self.cars[ID].record(mode)))
+
+    def pipeline_car(self, ID, *stages):
+        """
+        Sets the host-side processing of the car's frames, run in a process pool
+        (see generic.pipeline). Stages: resize:WxH, gray, edges[:low,high], overlay[:text].
+        Usage: pipeline <ID> [stage ...] or pipeline <ID> off
+        """
+        if ID not in self.cars:
+            print("SERVER: no such car:", ID)
+            return
+        if not stages:
+            pipeline = self.cars[ID].pipeline
+            print("SERVER: pipeline of {}: {}".format(ID, pipeline.spec if pipeline else "none"))
+            return
+        if stages == ("off",):
+            stages = ()
+        try:
+            parse_stages(*stages)
+        except ValueError as E:
+            print("SERVER:", E)
+            return
+        self.cars[ID].set_pipeline(*stages)
+        print("SERVER: pipeline of {}: {}".format(ID, " ".join(stages) or "none"))
+
+    def snapshot(self, ID, timeout=HANDSHAKE_TIMEOUT):
+        """
+        Returns the latest frame of a car as (header, frame) from the frame cache
+        of its stream, or None. If nothing is cached, the snapshot is a consumer
+        of the stream until a frame arrives.
+        """
+        car = self.cars[ID]
+        snap = car.snapshot()
+        if snap is not None:
+            return snap
+        consumer = "snapshot-{}".format(thr.current_thread().ident)
+        car.acquire_stream(consumer)
+        try:
+            return car.snapshot(timeout)
+        finally:
+            car.release_stream(consumer)
+
+    def snapshot_car(self, ID, path=None, *args):
+        """
+        Gets the latest frame of a car instantly and saves it, if a path is given.
+        Usage: snapshot <ID> [path.png]
+        """
+        if ID not in self.cars:
+            print("SERVER: no such car:", ID)
+            return
+        snap = self.snapshot(ID)
+        if snap is None:
+            print("SERVER: no frame of", ID)
+            return
+        header, frame = snap
+        # Remote cars of the sharded server have no clock estimate here
+        clock = getattr(self.cars[ID], "clock", None)
+        captured = header.timestamp if clock is None else clock.to_local(header.timestamp)
+        print("SERVER: snapshot of {}: frame #{}, {}, captured {:.1f}s ago"
+              .format(ID, header.seq, "x".join(str(d) for d in frame.shape),
+                      time.time() - captured))
+        if path is not None:
+            import cv2
+            cv2.imwrite(path, frame)
+            print("SERVER: saved", path)
+
+    def profile_car(self, ID, *spec):
+        """
+        Switches the stream profile of a car: resolution, colour mode and region of interest.
+        Usage: profile <ID> [WxH] [gray/color] [roi:WxH+X+Y] or profile <ID> full
+        """
+        if ID not in self.cars:
+            print("SERVER: no such car:", ID)
+            return
+        if not spec:
+            print("SERVER: please specify a profile, eg. profile {} 320x240 gray".format(ID))
+            return
+        self.cars[ID].send(" ".join(("profile",) + spec).encode())
+
     def shutdown(self, *args):
         """Shuts the server down, terminating all threads nicely"""
 
@@ -152,8 +279,48 @@ class FleetHandler(object):
         else:
             print("SERVER: All cars shut down correctly!")
 
+        writer = RecordingWriter.shared(create=False)
+        if writer is not None:
+            writer.teardown()
+        Pipeline.shutdown()
+        mosaic = MosaicDisplayer.shared(create=False)
+        if mosaic is not None:
+            mosaic.teardown()
+        if self.metrics_server is not None:
+            self.metrics_server.teardown()
         print("SERVER: Exiting...")
 
+    @staticmethod
+    def _relay_metrics():
+        """Throughput counters of the relayed connections, kept by the Relay's loop"""
+        relay = Relay.shared(create=False)
+        return {} if relay is None else {st["name"]: st for st in relay.stats()}
+
+    def print_metrics(self, ID=None, *args):
+        """
+        Prints the metrics of the cars' streams, served as JSON on
+        http://127.0.0.1:METRICS_PORT/metrics as well.
+        Usage: metrics [ID]
+        """
+        cars = REGISTRY.collect().get("car", {})
+        if ID is not None:
+            cars = {ID: cars[ID]} if ID in cars else {}
+
+        def mean(histogram, scale, fmt="{:.1f}"):
+            return "-" if histogram["mean"] is None else fmt.format(histogram["mean"] * scale)
+
+        tab = Table(["ID", "fps", "kB/s", "frames", "size kB", "decode ms", "queued", "dropped",
+                     "rtt ms"],
+                    [max([4] + [len(ID) + 2 for ID in cars]), 7, 9, 9, 9, 11, 8, 9, 8])
+        for ID, m in sorted(cars.items()):
+            tab.add(ID, m["frames"]["rate"], "{:.1f}".format(m["bytes"]["rate"] / 1024),
+                    m["frames"]["total"], mean(m["frame_size"], 1. / 1024),
+                    mean(m["decode_time"], 1000., "{:.2f}"), sum((m["queue_depth"] or {}).values()),
+                    m["dropped"], "-" if m["rtt"] is None else "{:.1f}".format(m["rtt"] * 1000))
+        print(tab.get() + "\n")
+        if self.metrics_server is not None:
+            print("SERVER: metrics on http://{}:{}/metrics".format(*self.metrics_server.address))
+
     def report(self, *args):
         """
         Prints a nice server status report
@@ -162,7 +329,98 @@ class FleetHandler(object):
         repchain += "-" * (len(repchain) - 1) + "\n"
         repchain += "Up since " + self.since.strftime("%Y.%m.%d %H:%M:%S") + "\n"
         repchain += "Cars online: {}\n".format(len(self.cars))
-        print("\n" + repchain + "\n")
+        print("\n" + repchain)
+        self._report_opstates()
+        self._report_latencies()
+        self._report_handshakes()
+        self._report_relay()
+        self._report_recordings()
+        self._report_pipelines()
+
+    def _report_opstates(self):
+        """Prints the operating points of the cars' adaptive streams"""
+        fields = ["fps", "quality", "scale", "lag", "send_ms"]
+        tab = Table(["ID"] + fields, [max([4] + [len(ID) + 2 for ID in self.cars])] + [9] * 5)
+        for ID, car in sorted(self.cars.items()):
+            tab.add(ID, *[car.opstate.get(k, "-") for k in fields])
+        print(tab.get() + "\n")
+
+    def _report_latencies(self):
+        """Prints the latency percentiles of the cars' streams in milliseconds"""
+
+        def ms(value):
+            return "-" if value is None else "{:.1f}".format(value * 1000)
+
+        tab = Table(["ID", "cap->host p50", "p90", "p99", "host->disp p50", "p99",
+                     "offset", "rtt"],
+                    [max([4] + [len(ID) + 2 for ID in self.cars]), 15, 8, 8, 16, 8, 9, 8])
+        for ID, car in sorted(self.cars.items()):
+            lat = car.latencies()
+            cap, disp = lat["capture->host"], lat["host->display"]
+            tab.add(ID, ms(cap.get("p50")), ms(cap.get("p90")), ms(cap.get("p99")),
+                    ms(disp.get("p50")), ms(disp.get("p99")),
+                    ms(lat["clock_offset"]), ms(lat["rtt"]))
+        print(tab.get() + "\n")
+
+    def _report_handshakes(self):
+        """Prints the durations of the handshakes in milliseconds"""
+        tracker = getattr(self.listener, "handshakes", None)
+        if tracker is None:
+            return
+        tab = Table(["Handshakes", "n", "p50", "p90", "p99"], [12, 6, 9, 9, 9])
+        for name in ("handshake", "failed"):
+            rep = tracker.report(name)
+            tab.add(name, rep["n"], *["{:.1f}".format(rep[p] * 1000) if p in rep else "-"
+                                      for p in ("p50", "p90", "p99")])
+        print(tab.get() + "\n")
+
+    @staticmethod
+    def _report_relay():
+        """Prints the throughput of the streams relayed to clients"""
+        relay = Relay.shared(create=False)
+        stats = [] if relay is None else relay.stats()
+        if not stats:
+            return
+        tab = Table(["Relayed pair", "received", "sent", "queued", "kB/s"],
+                    [max(14, max(len(st["name"]) for st in stats) + 2), 12, 12, 10, 10])
+        for st in stats:
+            tab.add(st["name"], st["received"], st["sent"], st["queued"],
+                    "{:.1f}".format(st["rate"] / 1024))
+        print(tab.get() + "\n")
+
+    @staticmethod
+    def _report_recordings():
+        """Prints the progress of the running recordings"""
+        writer = RecordingWriter.shared(create=False)
+        stats = [] if writer is None else writer.stats()
+        if not stats:
+            return
+        tab = Table(["Recording", "mode", "frames", "MB", "segments", "dropped"],
+                    [max(11, max(len(st["name"]) for st in stats) + 2), 9, 9, 9, 10, 9])
+        for st in stats:
+            tab.add(st["name"], st["mode"], st["frames"], "{:.1f}".format(st["written"] / 1e6),
+                    st["segments"], st["dropped"])
+        print(tab.get() + "\n")
+
+    def _report_pipelines(self):
+        """Prints the timing of the cars' processing pipelines in milliseconds"""
+        pipelines = [(ID, car.pipeline) for ID, car in sorted(self.cars.items())
+                     if getattr(car, "pipeline", None) is not None]
+        if not pipelines:
+            return
+        tab = Table(["ID", "stage", "p50", "p90", "p99", "in flight", "processed", "failed"],
+                    [max([4] + [len(ID) + 2 for ID, p in pipelines]), 10, 8, 8, 8, 11, 11, 8])
+        for ID, pipeline in pipelines:
+            stats = pipeline.stats()
+            for stage, rep in stats["stages"].items():
+                tab.add(ID, stage, *(["{:.1f}".format(rep[p] * 1000) if p in rep else "-"
+                                      for p in ("p50", "p90", "p99")] +
+                                     [stats["inflight"], stats["processed"], stats["failed"]]))
+        print(tab.get())
+        for ID, pipeline in pipelines:
+            if pipeline.last_error is not None:
+                print("Pipeline {} last failure: {}".format(ID, pipeline.last_error))
+        print()
 
     def __enter__(self, srvinstance):
         """Context enter method"""
@@ -39,17 +39,20 @@ class Listener(AbstractListener):
         Builds an interface and puts it into the server's appropriate
         container for later usage.
         :param msock: connected socket used for message connection
+        :return: the interface or None, if the handshake failed
         """
         print("LISTENER: called callback on incoming connection!")
-        ifc = InterfaceFactory(msock, self.dlistener, self.rclistener).get()
+        ifc = InterfaceFactory(msock, self.broker).get()
         if not ifc:
             print("LISTENER: no interface received!")
-            return
+            return None
         print("LISTENER: received {} interface: {}".format(ifc.entity_type, ifc))
         if ifc.entity_type == "car":
             self.master.cars[ifc.ID] = ifc
         else:
+            ifc.cars = self.master.cars
             self.master.clients[ifc.ID] = ifc
+        return ifc
 
 
 class Console(AbstractCommander):
@@ -2,9 +2,24 @@ from __future__ import print_function, unicode_literals, absolute_import
 
 import time
 
+from FIPER.generic.const import ASYNC_SERVER, SHARD_WORKERS
 from FIPER.host.bridge import FleetHandler
 
 
+def server_type():
+    """
+    The sharded server if SHARD_WORKERS is set, the asyncio server
+    if ASYNC_SERVER is set, the threaded one otherwise
+    """
+    if SHARD_WORKERS:
+        from FIPER.host.shard import ShardedFleetHandler
+        return ShardedFleetHandler
+    if ASYNC_SERVER:
+        from FIPER.host.asyncbridge import AsyncFleetHandler
+        return AsyncFleetHandler
+    return FleetHandler
+
+
 def readargs():
     import sys
 
@@ -18,7 +33,7 @@ def debugmain():
     """Launches the server on localhost"""
 
     # No context manager in debugmain, I want to see the exceptions,
-    server = FleetHandler("127.0.0.1")
+    server = server_type()("127.0.0.1")
     server.mainloop()  # enter the console mainloop
     time.sleep(3)
     print("OUTSIDE: Exiting...")
@@ -30,7 +45,7 @@ def main():
 
     # Context manager ensures proper shutdown of threads
     # see FleetHandler.__enter__ and __exit__ methods!
-    with FleetHandler(serverIP) as server:
+    with server_type()(serverIP) as server:
         server.mainloop()
 
     time.sleep(3)
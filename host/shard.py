@@ -0,0 +1,420 @@
+"""
+Multi-process server.
+
+ShardedFleetHandler runs SHARD_WORKERS worker processes, each of them an
+asyncio server (see asyncbridge.py). The workers share the messaging port
+through SO_REUSEPORT, so the kernel spreads the connecting cars among them.
+The data and RC connections can't be spread independently of the messaging
+connection, so every worker listens on data and RC ports of its own and
+announces them to its cars in the HELLO response.
+
+The coordinator process runs the console and keeps the registry of the cars
+of all the workers, which report their cars coming online and going offline
+(when the car's stream ends or it is killed). Console commands are forwarded to the worker owning the
+car, streams are watched through the workers' shared memory frame rings.
+Clients can only connect to the cars of the worker they landed on.
+
+Needs Python 3.8+ and SO_REUSEPORT (Linux, BSD, macOS).
+"""
+
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import time
+import signal
+import threading as thr
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+from FIPER.generic.const import SHARD_WORKERS
+from FIPER.generic.interface import _CarInterface
+from FIPER.generic.metrics import REGISTRY
+from FIPER.generic.recording import RecordingWriter
+from FIPER.generic.routine import srvsock
+from FIPER.generic.shmring import SharedFrameRing
+from FIPER.host.asyncbridge import AsyncListener
+from FIPER.host.bridge import FleetHandler
+
+
+class _Registry(dict):
+
+    """Car registry of a worker, reports the new and the removed cars to the coordinator"""
+
+    def __init__(self, index, events):
+        super(_Registry, self).__init__()
+        self.index = index
+        self.events = events
+        self._lock = thr.Lock()
+
+    def __setitem__(self, ID, carifc):
+        with self._lock:
+            super(_Registry, self).__setitem__(ID, carifc)
+            self.events.send(("online", self.index, ID, list(carifc.frameshape)))
+
+    def remove(self, ID, carifc=None):
+        """Removes the car (only if it is still <carifc>, if given), returns whether it was removed"""
+        with self._lock:
+            if ID not in self or (carifc is not None and self[ID] is not carifc):
+                return False
+            super(_Registry, self).__delitem__(ID)
+            self.events.send(("offline", self.index, ID))
+        return True
+
+
+class ShardWorker(object):
+
+    """
+    One worker process of the sharded server. The event loop of an
+    AsyncListener serves the worker's cars, the main thread of the
+    process answers the coordinator's requests.
+    """
+
+    def __init__(self, index, ip, control, events):
+        """
+        :param index: index of the worker
+        :param ip: IP address of the server
+        :param control: Connection for the coordinator's requests
+        :param events: Connection for the worker's events
+        """
+        self.index = index
+        self.ip = ip
+        self.control = control
+        self.cars = _Registry(index, events)
+        self.clients = {}
+        mlistener = srvsock(ip, "messaging", reuse_port=True)
+        dlistener = srvsock(ip, "stream", port=0)
+        rclistener = srvsock(ip, "rc", port=0)
+        self.listener = AsyncListener(self, mlistener, dlistener, rclistener)
+        self.listener.announce = {"dport": dlistener.getsockname()[1],
+                                  "rcport": rclistener.getsockname()[1]}
+        self.listener.on_car_closed = self._car_closed
+        self.requests = {
+            "send": self.send,
+            "kill": self.kill,
+            "opstate": lambda ID: self.cars[ID].opstate,
+            "latencies": lambda ID: self.cars[ID].latencies(),
+            "share": self.share,
+            "record": self.record,
+            "snapshot": lambda ID, timeout: self.cars[ID].snapshot(timeout),
+            "stream": self.stream,
+            "metrics": REGISTRY.collect,
+            "close": self.listener.teardown,
+            "stop": self.stop
+        }
+
+    def send(self, ID, msgs):
+        self.cars[ID].send(*msgs)
+
+    def kill(self, ID, sleep):
+        success = self.cars[ID].teardown(sleep)
+        if success:
+            self.cars.remove(ID)
+        return success
+
+    def _car_closed(self, carifc):
+        """The car's stream ended, it is dropped unless it was replaced meanwhile"""
+        if self.cars.remove(carifc.ID, carifc):
+            carifc.unpublish_shm()
+            print("SHARD {}: car {} went offline".format(self.index, carifc.ID))
+
+    def share(self, ID, switch):
+        """Returns the name of the car's shared memory frame ring"""
+        if not switch:
+            self.cars[ID].unpublish_shm()
+            return None
+        return self.cars[ID].publish_shm()
+
+    def stream(self, ID, consumer, switch):
+        if switch:
+            self.cars[ID].acquire_stream(consumer)
+        else:
+            self.cars[ID].release_stream(consumer)
+
+    def record(self, ID, switch, mode):
+        """Returns the path of the car's recording"""
+        if not switch:
+            self.cars[ID].stop_recording()
+            return None
+        return self.cars[ID].record(mode)
+
+    def stop(self):
+        for client in list(self.clients.values()):
+            client.teardown(0)
+        for carifc in list(self.cars.values()):
+            carifc.unpublish_shm()
+        writer = RecordingWriter.shared(create=False)
+        if writer is not None:
+            writer.teardown()
+        self.listener.stop()
+
+    def mainloop(self):
+        print("SHARD {}: online, data port {dport}, RC port {rcport}"
+              .format(self.index, **self.listener.announce))
+        self.listener.start()
+        while 1:
+            try:
+                request = self.control.recv()
+            except (EOFError, OSError):
+                self.stop()
+                break
+            command, args = request[0], request[1:]
+            try:
+                self.control.send(("ok", self.requests[command](*args)))
+            except Exception as E:
+                self.control.send(("error", "{}: {}".format(E.__class__.__name__, E)))
+            if command == "stop":
+                break
+        print("SHARD {}: Exiting...".format(self.index))
+
+
+def _worker_main(index, ip, control, events):
+    # Ctrl-C is handled by the coordinator
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ShardWorker(index, ip, control, events).mainloop()
+
+
+class _WorkerHandle(object):
+
+    """The coordinator's end of a worker process"""
+
+    def __init__(self, index, ip):
+        self.index = index
+        self.control, remote_control = mp.Pipe()
+        self.events, remote_events = mp.Pipe(duplex=False)
+        self.process = mp.Process(target=_worker_main, name="FIPER-shard-{}".format(index),
+                                  args=(index, ip, remote_control, remote_events))
+        self._lock = thr.Lock()
+
+    def request(self, command, *args):
+        """Sends a request to the worker and returns its answer"""
+        with self._lock:
+            self.control.send((command,) + args)
+            status, value = self.control.recv()
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+
+class _RingSubscription(object):
+
+    """
+    Reads the frames of a worker's shared memory frame ring,
+    stands in for a StreamSubscription in the coordinator process.
+    """
+
+    def __init__(self, ring, on_close=None):
+        """
+        :param ring: the attached SharedFrameRing
+        :param on_close: called when the subscription is closed
+        """
+        self.ring = ring
+        self.on_close = on_close
+        self.closed = False
+        self._last = None
+        self._reading = False
+
+    def frames(self, poll=0.005):
+        self._reading = True
+        last = self.ring.latest_seq
+        try:
+            while not self.closed:
+                seq = self.ring.latest_seq
+                if seq == last:
+                    time.sleep(poll)
+                    continue
+                last = seq
+                got = self.ring.read(seq)
+                if got is not None:
+                    # A copy, so the ring can be closed while the frame is displayed
+                    yield got[1].copy()
+        finally:
+            self.ring.close()
+
+    def latest(self):
+        """The latest frame of the ring as a view or None, if there is no new one"""
+        seq = self.ring.latest_seq
+        if self.closed or seq == self._last:
+            return None
+        self._last = seq
+        got = self.ring.read(seq)
+        return None if got is None else got[1]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self._reading:
+            self.ring.close()
+        if self.on_close is not None:
+            self.on_close()
+
+
+class RemoteCar(object):
+
+    """
+    Stand-in of a CarInterface, which is owned by a worker process.
+    Supports what the console commands use, by forwarding requests to the worker.
+    """
+
+    entity_type = "car"
+
+    def __init__(self, worker, ID, frameshape):
+        self.worker = worker
+        self.ID = ID
+        self.frameshape = frameshape
+        self.pipeline = None
+        self.shared = False  # published by the share command
+        self.online = True  # False after the worker dropped the car
+        self._readers = 0  # subscriptions reading the worker's ring
+
+    # Processing pipelines run in the coordinator, on the frames read from the ring
+    set_pipeline = _CarInterface.set_pipeline
+    process = _CarInterface.process
+
+    def send(self, *msgs):
+        self.worker.request("send", self.ID, msgs)
+
+    def acquire_stream(self, consumer):
+        self.worker.request("stream", self.ID, consumer, True)
+
+    def release_stream(self, consumer):
+        self.worker.request("stream", self.ID, consumer, False)
+
+    @property
+    def opstate(self):
+        return self.worker.request("opstate", self.ID)
+
+    def latencies(self):
+        return self.worker.request("latencies", self.ID)
+
+    def publish_shm(self, slots=4):
+        self.shared = True
+        return self.worker.request("share", self.ID, True)
+
+    def unpublish_shm(self):
+        self.shared = False
+        if not self._readers:
+            self.worker.request("share", self.ID, False)
+
+    def record(self, mode="encoded"):
+        return self.worker.request("record", self.ID, True, mode)
+
+    def stop_recording(self):
+        self.worker.request("record", self.ID, False, None)
+
+    def snapshot(self, timeout=0.):
+        """The latest frame from the worker's frame cache of the car, copied through the pipe"""
+        return self.worker.request("snapshot", self.ID, timeout)
+
+    def subscribe(self, *args, **kw):
+        """Frames are read from the worker's shared memory ring of the car"""
+        ring = SharedFrameRing.attach(self.worker.request("share", self.ID, True))
+        self._readers += 1
+        return _RingSubscription(ring, on_close=self._reader_closed)
+
+    def _reader_closed(self):
+        """The ring is unpublished after its last reader, unless it is shared"""
+        self._readers -= 1
+        if not self._readers and not self.shared and self.online:
+            self.worker.request("share", self.ID, False)
+
+    def mark_displayed(self):
+        """The host->display latency is not measured across processes"""
+
+    def teardown(self, sleep=3):
+        return self.worker.request("kill", self.ID, sleep)
+
+
+class WorkerPool(object):
+
+    """
+    Starts the worker processes and collects their events.
+    Takes the place of the Listener in a ShardedFleetHandler.
+    """
+
+    def __init__(self, master, workers=SHARD_WORKERS):
+        """
+        :param master: the ShardedFleetHandler
+        :param workers: number of worker processes, 0 means one per CPU core
+        """
+        self.master = master
+        self.workers = [_WorkerHandle(i, master.ip) for i in range(workers or os.cpu_count())]
+        self.collector = None
+        self.running = False
+
+    def start(self):
+        for worker in self.workers:
+            worker.process.start()
+        self.running = True
+        self.collector = thr.Thread(target=self._collect_events, name="Server-Shards")
+        self.collector.start()
+
+    def _collect_events(self):
+        connections = {worker.events: worker for worker in self.workers}
+        while self.running and connections:
+            for conn in wait(list(connections), timeout=1):
+                try:
+                    event = conn.recv()
+                except EOFError:
+                    del connections[conn]
+                    continue
+                self._handle(event)
+
+    def _handle(self, event):
+        kind, index, ID = event[:3]
+        if kind == "online":
+            self.master.cars[ID] = RemoteCar(self.workers[index], ID, event[3])
+            print("SHARDS: car {} online on worker {}".format(ID, index))
+        elif kind == "offline":
+            car = self.master.cars.get(ID)
+            if not isinstance(car, RemoteCar) or car.worker is not self.workers[index]:
+                return
+            car.online = False
+            self.master.cars.pop(ID, None)
+            watcher = self.master.watchers.pop(ID, None)
+            if watcher is not None:
+                watcher.teardown(sleep=0)
+            print("SHARDS: car {} offline on worker {}".format(ID, index))
+
+    def teardown(self, sleep=2):
+        """Stops accepting new connections, the workers keep serving their cars"""
+        for worker in self.workers:
+            worker.request("close", 0)
+        time.sleep(sleep)
+
+    def stop(self, sleep=1):
+        """Stops the worker processes"""
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.request("stop")
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+        self.running = False
+        time.sleep(sleep)
+
+
+class ShardedFleetHandler(FleetHandler):
+
+    """
+    FleetHandler, which spreads the cars among worker processes (see WorkerPool).
+    The console commands work on every car, regardless of its worker.
+    """
+
+    listener_type = WorkerPool
+
+    def __init__(self, myIP):
+        super(ShardedFleetHandler, self).__init__(myIP)
+        REGISTRY.collector("car", self._car_metrics)
+
+    def _car_metrics(self):
+        """The metrics of the cars are kept by the workers"""
+        metrics = {}
+        for worker in self.listener.workers:
+            if worker.process.is_alive():
+                metrics.update(worker.request("metrics").get("car", {}))
+        return metrics
+
+    def shutdown(self, *args):
+        """Shuts the server and its worker processes down"""
+        super(ShardedFleetHandler, self).shutdown(*args)
+        self.listener.stop()
@@ -3,9 +3,10 @@ from __future__ import unicode_literals, print_function, absolute_import
 import time
 import socket
 
-import numpy as np
 import cv2
 
+from FIPER.generic.stream import FrameReceiver
+
 
 # Ports
 MESSAGE_SERVER_PORT = 1234
@@ -54,13 +55,8 @@ def listen(myaddr="127.0.0.1"):
 
 
 def framestream(dconn, frameshape):
-    datalen = np.prod(frameshape)
-    data = b""
-    while 1:
-        while len(data) < datalen:
-            data += dconn.recv(1024)
-        yield np.fromstring(data[:datalen], dtype="uint8").reshape(frameshape)
-        data = data[datalen:]
+    for frame in FrameReceiver(dconn, frameshape, dtype="uint8", buffers=2):
+        yield frame
 
 
 def display(mconn, dconn):
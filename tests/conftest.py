@@ -0,0 +1,18 @@
+"""
+The modules of FIPER import each other as FIPER.<package>.<module>,
+so the checkout is registered as the FIPER package, whatever the name
+of its directory is.
+"""
+
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "FIPER" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        "FIPER", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    _module = importlib.util.module_from_spec(_spec)
+    sys.modules["FIPER"] = _module
+    _spec.loader.exec_module(_module)
@@ -0,0 +1,80 @@
+import socket
+import threading as thr
+import time
+
+from FIPER.car.channel import TCPStreamer
+from FIPER.car.component import CaptureDevice
+from FIPER.generic.const import FPS
+from FIPER.generic.stream import PacketReceiver
+from FIPER.generic.util import CaptureDeviceMocker
+
+
+def _streamer_threads():
+    return [t for t in thr.enumerate() if t.name.startswith("Streamer")]
+
+
+class _Counter(object):
+
+    """Counts the packets arriving on the accepted data connection"""
+
+    def __init__(self, sock):
+        self.packets = 0
+        self.worker = thr.Thread(target=self.run, args=(sock,))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def run(self, sock):
+        for _ in PacketReceiver(sock):
+            self.packets += 1
+
+    def count_during(self, seconds):
+        start = self.packets
+        time.sleep(seconds)
+        return self.packets - start
+
+
+def _connected_streamer():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    streamer = TCPStreamer(eye=CaptureDevice(CaptureDeviceMocker), ID="test")
+    streamer.connect("127.0.0.1", listener.getsockname()[1])
+    conn, _ = listener.accept()
+    listener.close()
+    return streamer, conn
+
+
+def test_toggled_stream_has_one_sender():
+    streamer, conn = _connected_streamer()
+    counter = _Counter(conn)
+    try:
+        streamer.start()
+        time.sleep(0.5)
+        streamer.stop()
+        assert _streamer_threads() == []
+        streamer.start()
+        streamer.start()  # already running, no-op
+        time.sleep(0.5)
+        assert sorted(t.name for t in _streamer_threads()) == ["Streamer", "Streamer-capture"]
+        packets = counter.count_during(2.)
+        assert packets <= 2 * FPS * 1.25
+        assert packets >= 2 * FPS * 0.5
+    finally:
+        streamer.teardown()
+        conn.close()
+    assert _streamer_threads() == []
+
+
+def test_sender_failure_stops_capture():
+    streamer, conn = _connected_streamer()
+    try:
+        streamer.start()
+        time.sleep(0.3)
+        conn.close()
+        deadline = time.time() + 5
+        while _streamer_threads() and time.time() < deadline:
+            time.sleep(0.05)
+        assert _streamer_threads() == []
+        assert not streamer.running
+    finally:
+        streamer.teardown()
@@ -0,0 +1,95 @@
+import threading as thr
+import time
+
+import pytest
+
+from FIPER.car.car import TCPCar
+from FIPER.car.component import CaptureDevice
+from FIPER.client.indirect import ServerConnection
+from FIPER.generic.routine import srvsock
+from FIPER.generic.stream import PacketReceiver
+from FIPER.generic.util import CaptureDeviceMocker
+from FIPER.host.asyncbridge import AsyncListener
+
+IP = "127.0.0.1"
+
+
+class _Server(object):
+
+    """Stands in for the FleetHandler, the listener fills its registries"""
+
+    ip = IP
+
+    def __init__(self):
+        self.cars = {}
+        self.clients = {}
+
+
+def _wait(condition, timeout=5.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    master = _Server()
+    # Ephemeral ports, the data and RC ports are announced in the HELLO response
+    mlistener = srvsock(IP, "messaging", port=0)
+    dlistener = srvsock(IP, "stream", port=0)
+    rclistener = srvsock(IP, "rc", port=0)
+    listener = AsyncListener(master, mlistener, dlistener, rclistener)
+    listener.announce = {"dport": dlistener.getsockname()[1],
+                         "rcport": rclistener.getsockname()[1]}
+    monkeypatch.setattr("FIPER.generic.messaging.MESSAGE_SERVER_PORT",
+                        mlistener.getsockname()[1])
+    listener.start()
+    assert _wait(lambda: listener.running)
+    yield master
+    for client in list(master.clients.values()):
+        client.teardown(0)
+    listener.teardown(0)
+    listener.stop(0.5)
+
+
+@pytest.fixture
+def car(server):
+    car = TCPCar("T1", IP, eye=CaptureDevice(CaptureDeviceMocker))
+    assert car.connect(IP)
+    commander = thr.Thread(target=car.commander.mainloop)
+    commander.start()
+    assert _wait(lambda: "T1" in server.cars)
+    yield car
+    car.commander.teardown()
+    commander.join()
+
+
+def test_client_lists_and_connects_to_car(server, car):
+    conn = ServerConnection(IP, "C1")
+    try:
+        assert _wait(lambda: "C1" in server.clients)
+        assert conn.request_car_list() == ["T1"]
+        frameshape = conn.request_car_connection("T1")
+        assert tuple(frameshape) == car.streamer._frameshape
+
+        received = []
+        receiver = thr.Thread(target=lambda: received.append(
+            PacketReceiver(conn.dsocket, frameshape).receive()))
+        receiver.daemon = True
+        receiver.start()
+        receiver.join(10)
+        assert received and received[0] is not None
+        header, payload = received[0]
+        assert header.shape == tuple(frameshape)
+    finally:
+        conn.teardown()
+
+
+def test_unknown_car_is_an_error(server, car):
+    conn = ServerConnection(IP, "C2")
+    try:
+        with pytest.raises(Exception, match="no such car"):
+            conn.request_car_connection("nope")
+    finally:
+        conn.teardown()
@@ -0,0 +1,94 @@
+import socket
+
+import pytest
+
+from FIPER.generic.messaging import DELIMITER, Messaging, MessageParser, frame_message
+
+
+def _feed_bytewise(parser, data):
+    msgs = []
+    for i in range(len(data)):
+        msgs.extend(parser.feed(data[i:i+1]))
+    return msgs
+
+
+@pytest.mark.parametrize("framing", ["length", "delimited"])
+def test_round_trip(framing):
+    msgs = [b"hello", b"", b"car-1:stream on", "árvíztűrő".encode("utf8")]
+    data = b"".join(frame_message(msg, framing) for msg in msgs)
+    parser = MessageParser()
+    assert parser.feed(data) == msgs
+    assert parser.pending == b""
+
+
+@pytest.mark.parametrize("framing", ["length", "delimited"])
+def test_messages_split_anywhere(framing):
+    msgs = [b"first", b"second message", b"x" * 300]
+    data = b"".join(frame_message(msg, framing) for msg in msgs)
+    assert _feed_bytewise(MessageParser(size=16), data) == msgs
+
+
+def test_split_length_prefix():
+    parser = MessageParser()
+    data = frame_message(b"payload", "length")
+    assert parser.feed(data[:2]) == []
+    assert parser.feed(data[2:4]) == []
+    assert parser.feed(data[4:]) == [b"payload"]
+    assert parser.pending == b""
+
+
+def test_length_prefixed_payload_may_contain_the_delimiter():
+    msg = b"before" + DELIMITER + b"after" + DELIMITER
+    parser = MessageParser()
+    assert parser.feed(frame_message(msg, "length")) == [msg]
+    assert not parser.delimited
+
+
+def test_mixed_framings():
+    msgs = [b"legacy", b"prefixed", b"legacy again", b"prefixed" + DELIMITER]
+    framings = ["delimited", "length", "delimited", "length"]
+    data = b"".join(frame_message(msg, framing) for msg, framing in zip(msgs, framings))
+    parser = MessageParser()
+    assert parser.feed(data) == msgs
+    assert parser.delimited
+    assert _feed_bytewise(MessageParser(size=8), data) == msgs
+
+
+def test_incomplete_message_is_pending():
+    parser = MessageParser()
+    assert parser.feed(b"no delimiter yet") == []
+    assert parser.pending == b"no delimiter yet"
+    assert parser.feed(DELIMITER) == [b"no delimiter yet"]
+
+
+def test_oversized_length_is_rejected():
+    parser = MessageParser(limit=1024)
+    with pytest.raises(ValueError):
+        parser.feed(frame_message(b"x" * 1025, "length")[:5])
+
+
+def test_oversized_delimited_message_is_rejected():
+    parser = MessageParser(size=64, limit=1024)
+    with pytest.raises(ValueError):
+        parser.feed(b"x" * 2048)
+
+
+def test_buffer_grows_to_fit_large_message():
+    msg = b"y" * 100000
+    parser = MessageParser(size=16)
+    assert parser.feed(frame_message(msg, "length")) == [msg]
+    assert parser.feed(frame_message(msg, "delimited")) == [msg]
+
+
+def test_invalid_utf8_message_is_dropped():
+    local, remote = socket.socketpair()
+    messenger = Messaging(local)
+    try:
+        remote.sendall(frame_message(b"\xff\xfe broken", "length") +
+                       frame_message(b"intact", "length"))
+        assert messenger.recv(timeout=2) == "intact"
+        assert messenger.running
+        assert messenger.recv(timeout=0.2) is None
+    finally:
+        messenger.teardown(0)
+        remote.close()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from FIPER.generic import pipeline as pl
+from FIPER.generic.pipeline import Pipeline, parse_stages
+from FIPER.generic.shmring import shared_memory
+
+SHAPE = (24, 32, 3)
+
+
+@pytest.fixture(autouse=True)
+def _shutdown():
+    yield
+    Pipeline.shutdown()
+
+
+def _frames(count, shape=SHAPE):
+    return [np.full(shape, i, dtype="uint8") for i in range(count)]
+
+
+def test_frames_are_processed_in_order():
+    pipeline = Pipeline("1", SHAPE, parse_stages("gray"), depth=4)
+    results = [(frame.shape, int(frame[0, 0])) for frame in pipeline.map(_frames(20))]
+    assert results == [(SHAPE[:2], i) for i in range(20)]
+    assert pipeline.processed == 20 and pipeline.failed == 0
+    assert pipeline.inflight == 0
+
+
+def test_results_larger_than_the_slot_are_returned_through_the_pool():
+    pipeline = Pipeline("1", SHAPE, parse_stages("resize:64x48"), depth=3)
+    results = [frame.copy() for frame in pipeline.map(_frames(6))]
+    assert [frame.shape for frame in results] == [(48, 64, 3)] * 6
+    assert [int(frame[0, 0, 0]) for frame in results] == list(range(6))
+
+
+def test_failed_frames_are_skipped_with_context():
+    frames = _frames(5)
+    frames[2] = np.full(SHAPE[:2] + (2,), 2, dtype="uint8")  # Not a BGR frame
+    pipeline = Pipeline("1", SHAPE, parse_stages("gray"), depth=2)
+    results = [int(frame[0, 0]) for frame in pipeline.map(frames)]
+    assert results == [0, 1, 3, 4]
+    assert pipeline.failed == 1
+    assert pipeline.last_error.startswith("frame #2: stage gray failed")
+    assert pipeline.stats()["last_error"] == pipeline.last_error
+
+
+def test_oversized_input_frames_are_skipped():
+    frames = _frames(3)
+    frames[1] = np.zeros((48, 64, 3), dtype="uint8")
+    pipeline = Pipeline("1", SHAPE, parse_stages("gray"))
+    assert [int(frame[0, 0]) for frame in pipeline.map(frames)] == [0, 2]
+    assert pipeline.failed == 1 and pipeline.last_error.startswith("frame #1:")
+
+
+def test_workers_detach_from_finished_blocks():
+    pipeline = Pipeline("1", SHAPE, parse_stages("gray"))
+    before = set(pl._released)
+    for _ in range(2):
+        frames = pipeline.map(_frames(4))
+        next(frames)
+        frames.close()
+    # The blocks of both calls are handed to the workers to detach from
+    assert len(set(pl._released) - before) == 2
+    # The worker side, run in this process
+    blocks = [shared_memory.SharedMemory(create=True, size=2 * pipeline.slot_size) for _ in range(2)]
+    try:
+        for block in blocks:
+            pl._process(block.name, 0, pipeline.slot_size, SHAPE, "|u1", [], {"ID": "1", "n": 0})
+        assert blocks[0].name in pl._attached
+        pl._process(blocks[1].name, 0, pipeline.slot_size, SHAPE, "|u1", [], {"ID": "1", "n": 1},
+                    released=(blocks[0].name,))
+        assert blocks[0].name not in pl._attached and blocks[1].name in pl._attached
+        pl._detach([blocks[1].name])
+        assert not pl._attached
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,139 @@
+import time
+
+import numpy as np
+import pytest
+
+from FIPER.generic.codec import get_codec
+from FIPER.generic.recording import (
+    StreamRecorder, RecordingReader, RecordingCapture, RecordingWriter
+)
+from FIPER.generic.stream import FrameHeader
+
+SHAPE = (16, 20, 3)
+COUNT = 40
+INTERVAL = 0.05
+T0 = 1000.
+
+
+class _Interface(object):
+
+    def __init__(self, codec):
+        self.ID = "1"
+        self.frameshape = SHAPE
+        self.codec = codec
+
+
+class _Hub(object):
+
+    """Stands in for the car's StreamHub, the packets are put() by the test"""
+
+    def __init__(self, codec):
+        self.interface = _Interface(codec)
+
+    def unsubscribe(self, subscriber):
+        pass
+
+
+def _frames():
+    ramp = np.add.outer(np.arange(SHAPE[0]), np.arange(SHAPE[1]))
+    ramp = np.repeat(ramp[..., None], SHAPE[2], axis=2)
+    return [((ramp + 3 * i) % 256).astype("uint8") for i in range(COUNT)]
+
+
+def _record(directory, codec_name, **params):
+    """Writes the frames into a recording of several segments"""
+    codec = get_codec(codec_name, **params)
+    recorder = StreamRecorder(_Hub(codec_name), str(directory), segment_size=1024)
+    for seq, frame in enumerate(_frames()):
+        payload, flags = codec.encode(frame)
+        payload = bytes(payload)
+        recorder.put((FrameHeader(seq, T0 + seq * INTERVAL, frame.shape, frame.dtype,
+                                  codec=codec.ID, length=len(payload), flags=flags), payload))
+    recorder.close()
+    writer = RecordingWriter.shared()
+    deadline = time.time() + 5
+    while recorder in writer.recorders and time.time() < deadline:
+        time.sleep(0.01)
+    assert recorder not in writer.recorders
+    return recorder
+
+
+@pytest.fixture(params=[("raw", {}), ("delta", {"keyframe_interval": 5})], ids=["raw", "delta"])
+def recording(request, tmp_path):
+    name, params = request.param
+    recorder = _record(tmp_path / name, name, **params)
+    assert recorder.frames == COUNT and recorder.segments > 1
+    reader = RecordingReader(recorder.directory)
+    yield reader
+    reader.close()
+
+
+def test_index_spans_the_segments(recording):
+    assert len(recording) == COUNT
+    assert list(recording.index["seq"]) == list(range(COUNT))
+    assert len(set(recording.segment)) > 1
+    assert recording.duration == pytest.approx((COUNT - 1) * INTERVAL)
+
+
+def test_seek_finds_the_frame_of_a_timestamp(recording):
+    middle = T0 + 23 * INTERVAL
+    assert recording.seek(middle) == 23
+    assert recording.seek(middle - INTERVAL / 2) == 23
+    assert recording.position_at(middle + INTERVAL / 2) == 23
+    assert recording.seek(T0 + 1000) == COUNT - 1
+    assert recording.position_at(T0 - 1) == -1
+
+
+def test_framestream_starts_at_the_sought_frame(recording):
+    frames = _frames()
+    replayed = [frame.copy() for frame in recording.framestream(start=23 * INTERVAL, speed=0)]
+    assert len(replayed) == COUNT - 23
+    for expected, frame in zip(frames[23:], replayed):
+        assert np.array_equal(frame, expected)
+
+
+def test_delta_seek_decodes_from_the_keyframe(tmp_path):
+    reader = RecordingReader(_record(tmp_path / "delta", "delta", keyframe_interval=5).directory)
+    try:
+        # Keyframes every 6 frames: 23 is a residual, decoding starts at 18
+        assert not reader.index["keyframe"][23]
+        assert reader.keyframe_before(23) == 18
+        frame = next(reader.framestream(start=23 * INTERVAL, speed=0))
+        assert np.array_equal(frame, _frames()[23])
+    finally:
+        reader.close()
+
+
+def test_capture_returns_every_frame(recording):
+    capture = RecordingCapture(recording.directory, speed=0, loop=False)
+    replayed = []
+    while 1:
+        success, frame = capture.read()
+        if not success:
+            break
+        replayed.append(frame)
+    capture.release()
+    # Kept without copying: the frames must not share the decoder's buffer
+    assert len(replayed) == COUNT
+    for expected, frame in zip(_frames(), replayed):
+        assert np.array_equal(frame, expected)
+
+
+def test_capture_replays_faster(recording):
+    capture = RecordingCapture(recording.directory, speed=4, loop=False)
+    frames = _frames()
+    start = time.time()
+    positions = []
+    while 1:
+        success, frame = capture.read()
+        if not success:
+            break
+        positions.append(next(i for i, expected in enumerate(frames)
+                              if np.array_equal(frame, expected)))
+        time.sleep(INTERVAL / 8)
+    elapsed = time.time() - start
+    capture.release()
+    assert positions == sorted(positions) and positions[-1] == COUNT - 1
+    assert len(set(positions)) > COUNT // 2
+    # 40 frames of 50 ms at 4x speed
+    assert COUNT * INTERVAL / 4 * 0.8 < elapsed < COUNT * INTERVAL
@@ -0,0 +1,62 @@
+import socket
+import time
+
+from FIPER.generic.subsystem import Relay
+
+
+class _FaultySocket(socket.socket):
+
+    """Its reads fail with an unexpected exception"""
+
+    def recv_into(self, *args):
+        raise RuntimeError("boom")
+
+
+def _recv_exactly(sock, size, timeout=5.):
+    sock.settimeout(timeout)
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def _relayed(relay, name, srctype=socket.socket):
+    """(source's peer, pair, target's peer): writes to the first arrive on the last"""
+    a1, a2 = socket.socketpair()
+    b1, b2 = socket.socketpair()
+    src = srctype(a2.family, a2.type, fileno=a2.detach())
+    return a1, relay.add(src, b1, name), b2
+
+
+def test_relay_moves_data():
+    relay = Relay(name="test-relay")
+    relay.start()
+    try:
+        feed, pair, out = _relayed(relay, "p")
+        payload = bytes(bytearray(range(256))) * 4096
+        feed.sendall(payload)
+        assert _recv_exactly(out, len(payload)) == payload
+        assert pair.sent == len(payload)
+        assert relay.stats()[0]["sent"] == len(payload)
+    finally:
+        relay.teardown()
+
+
+def test_failing_pair_does_not_stop_relay():
+    relay = Relay(name="test-relay")
+    relay.start()
+    try:
+        ffeed, faulty, _ = _relayed(relay, "faulty", _FaultySocket)
+        feed, pair, out = _relayed(relay, "good")
+        ffeed.sendall(b"trigger")
+        deadline = time.time() + 5
+        while faulty in relay.pairs and time.time() < deadline:
+            time.sleep(0.02)
+        assert faulty not in relay.pairs
+        assert relay.is_alive()
+        feed.sendall(b"still relaying")
+        assert _recv_exactly(out, 14) == b"still relaying"
+    finally:
+        relay.teardown()
@@ -0,0 +1,179 @@
+import random
+import socket
+import threading as thr
+
+import numpy as np
+
+from FIPER.generic.stream import (
+    RESYNC_FRAMES, FrameHeader, DatagramSender, DatagramReassembler, DatagramReceiver,
+    JitterBuffer, seq_diff
+)
+
+SHAPE = (24, 32, 3)
+LAST = (1 << 32) - 1  # the last sequence number before the wraparound
+
+
+class _CollectingSocket(object):
+
+    """Stands in for the connected UDP socket of a DatagramSender"""
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendmsg(self, buffers):
+        self.datagrams.append(b"".join(bytes(buf) for buf in buffers))
+
+
+def _payload(seq):
+    return np.full(int(np.prod(SHAPE)), seq % 251, dtype=np.uint8).tobytes()
+
+
+def _fragments(seq, datagram_size=400):
+    sock = _CollectingSocket()
+    DatagramSender(sock, datagram_size).send(FrameHeader(seq, 0., SHAPE), _payload(seq))
+    return sock.datagrams
+
+
+def _feed(reassembler, datagrams):
+    done = []
+    for datagram in datagrams:
+        packet = reassembler.feed(memoryview(datagram))
+        if packet is not None:
+            done.append((packet[0].seq, bytes(packet[1])))
+    return done
+
+
+def test_seq_diff_orders_across_wraparound():
+    assert seq_diff(5, 3) == 2
+    assert seq_diff(3, 5) == -2
+    assert seq_diff(0, LAST) == 1
+    assert seq_diff(LAST, 0) == -1
+    assert seq_diff(2, LAST - 2) == 5
+
+
+def test_reassembler_completes_reordered_fragments():
+    fragments = _fragments(7)
+    assert len(fragments) > 3
+    random.Random(0).shuffle(fragments)
+    assert _feed(DatagramReassembler(), fragments) == [(7, _payload(7))]
+
+
+def test_reassembler_interleaved_packets():
+    first, second = _fragments(1), _fragments(2)
+    mixed = [datagram for pair in zip(first, second) for datagram in pair]
+    assert _feed(DatagramReassembler(), mixed) == [(1, _payload(1)), (2, _payload(2))]
+
+
+def test_reassembler_drops_incomplete_older_packet():
+    reassembler = DatagramReassembler()
+    lossy = _fragments(1)
+    lost = lossy.pop(1)
+    assert _feed(reassembler, lossy + _fragments(2)) == [(2, _payload(2))]
+    assert reassembler.dropped == 1
+    # The late fragment of the dropped packet doesn't resurrect it
+    assert _feed(reassembler, [lost]) == []
+
+
+def test_reassembler_ignores_duplicates_of_completed_packets():
+    reassembler = DatagramReassembler()
+    fragments = _fragments(3)
+    assert _feed(reassembler, fragments) == [(3, _payload(3))]
+    assert _feed(reassembler, fragments) == []
+
+
+def test_reassembler_across_wraparound():
+    reassembler = DatagramReassembler()
+    stale = _fragments(LAST - 1)
+    done = _feed(reassembler, _fragments(LAST) + _fragments(0) + stale + _fragments(1))
+    assert [seq for seq, _ in done] == [LAST, 0, 1]
+
+
+def test_reassembler_resyncs_after_sender_restart():
+    reassembler = DatagramReassembler()
+    _feed(reassembler, _fragments(100) + _fragments(101))
+    restarted = []
+    for seq in range(RESYNC_FRAMES + 3):
+        restarted += _feed(reassembler, _fragments(seq))
+    assert [seq for seq, _ in restarted] == list(range(RESYNC_FRAMES, RESYNC_FRAMES + 3))
+
+
+def _drain(buffer, now):
+    released = []
+    item = buffer.pop(now=now)
+    while item is not None:
+        released.append(item)
+        item = buffer.pop(now=now)
+    return released
+
+
+def test_jitter_buffer_releases_in_order_after_delay():
+    buffer = JitterBuffer(delay=0.1, depth=10)
+    for seq in (3, 1, 2):
+        buffer.push(seq, seq, now=0.)
+    assert buffer.pop(now=0.05) is None
+    assert _drain(buffer, now=0.2) == [1, 2, 3]
+
+
+def test_jitter_buffer_releases_early_when_full():
+    buffer = JitterBuffer(delay=10., depth=2)
+    for seq in (1, 2, 3):
+        buffer.push(seq, seq, now=0.)
+    assert _drain(buffer, now=0.) == [1]
+
+
+def test_jitter_buffer_drops_late_frames():
+    buffer = JitterBuffer(delay=0., depth=0)
+    buffer.push(5, 5, now=0.)
+    assert _drain(buffer, now=1.) == [5]
+    buffer.push(4, 4, now=1.)
+    assert _drain(buffer, now=2.) == []
+    assert buffer.late == 1
+
+
+def test_jitter_buffer_orders_across_wraparound():
+    buffer = JitterBuffer(delay=0.1, depth=10)
+    for seq in (1, LAST, 0, LAST - 1):
+        buffer.push(seq, seq, now=0.)
+    assert _drain(buffer, now=1.) == [LAST - 1, LAST, 0, 1]
+
+
+def test_jitter_buffer_restarts_with_sender():
+    buffer = JitterBuffer(delay=0., depth=0)
+    released = []
+    for seq in [100, 101, 102] + list(range(RESYNC_FRAMES + 3)):
+        buffer.push(seq, seq, now=0.)
+        released += _drain(buffer, now=1.)
+    assert released == [100, 101, 102] + list(range(RESYNC_FRAMES, RESYNC_FRAMES + 3))
+
+
+def test_datagram_round_trip_over_loopback():
+    rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    rsock.bind(("127.0.0.1", 0))
+    ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ssock.connect(rsock.getsockname())
+    receiver = DatagramReceiver(rsock, delay=0.01)
+    received = []
+
+    def receive():
+        for header, payload in receiver:
+            received.append((header.seq, header.shape, bytes(payload)))
+            if len(received) == 5:
+                break
+
+    worker = thr.Thread(target=receive)
+    worker.daemon = True
+    worker.start()
+    sender = DatagramSender(ssock)
+    try:
+        for seq in range(LAST - 2, LAST + 3):
+            seq &= LAST
+            sender.send(FrameHeader(seq, 0., SHAPE), _payload(seq))
+        worker.join(5)
+    finally:
+        receiver.running = False
+        ssock.close()
+        rsock.close()
+    expected = [seq & LAST for seq in range(LAST - 2, LAST + 3)]
+    assert [seq for seq, _, _ in received] == expected
+    assert all(shape == SHAPE and payload == _payload(seq) for seq, shape, payload in received)